@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from indexer import Indexer, file_type_for
+from query_plan import LANGUAGE_MAP
+
+# Share of each extension in the synthetic corpus, roughly that of a web monorepo
+LANGUAGE_MIX = {
+    '.js': 0.22, '.ts': 0.16, '.py': 0.24, '.html': 0.06, '.css': 0.06, '.json': 0.07,
+    '.yaml': 0.03, '.yml': 0.02, '.sql': 0.04, '.sh': 0.04, '.md': 0.06,
+}
+assert set(LANGUAGE_MIX) <= set(LANGUAGE_MAP)
+
+WORDS = [
+    'user', 'data', 'search', 'config', 'request', 'response', 'cache', 'index', 'session', 'token',
+    'order', 'item', 'payment', 'account', 'event', 'message', 'query', 'result', 'file', 'record',
+    'profile', 'report', 'metric', 'stream', 'job', 'task', 'queue', 'schema', 'model', 'view',
+    'route', 'state', 'store', 'client', 'server', 'router', 'filter', 'batch', 'upload', 'export',
+]
+VERBS = ['get', 'set', 'fetch', 'load', 'save', 'update', 'delete', 'create', 'parse', 'render',
+         'build', 'handle', 'validate', 'format', 'sync', 'resolve']
+CLASS_SUFFIXES = ['Service', 'Handler', 'Manager', 'Client', 'Store', 'Controller']
+# Planted in about one file in RARE_RATE, so they stay selective at every corpus size
+RARE_TERMS = ['quasarFlux', 'zephyrLattice', 'obsidianRelay']
+RARE_RATE = 2000
+# Planted once in the first files of every corpus as well, so the queries for
+# them always time a match and not just an empty candidate list
+PLANTED_TERMS = RARE_TERMS + ['handleRequest']
+# Clients issuing queries at once when measuring throughput
+CLIENTS = 8
+FILES_PER_REPOSITORY = 1000
+BATCH_FILES = 10000
+
+# (name, kind, query, regex) run against every corpus
+QUERY_MIX: List[Tuple[str, str, str, bool]] = [
+    ('common-term', 'common', 'user', False),
+    ('common-pair', 'common', 'fetch data', False),
+    ('rare-term', 'rare', 'quasarFlux', False),
+    ('rare-or', 'rare', 'zephyrLattice OR obsidianRelay', False),
+    ('phrase', 'literal', '"def load_config"', False),
+    ('identifier', 'literal', 'handleRequest', False),
+    ('or-terms', 'literal', 'saveOrder OR deletePayment', False),
+    ('negation', 'literal', 'session -token', False),
+    ('lang-filter', 'filter', 'lang:python cache', False),
+    ('repo-filter', 'filter', 'repo:repo-0000 query', False),
+    ('path-filter', 'filter', 'path:routes response', False),
+    ('definition', 'symbol', 'def:UserService', False),
+    ('symbol-prefix', 'symbol', 'sym:Search', False),
+    ('regex-call', 'regex', r'fetch\w+\(', True),
+    ('regex-class', 'regex', r'class \w+Handler', True),
+]
+
+
+def identifier(rng: random.Random, style: str) -> str:
+    """A verb-noun identifier in camelCase or snake_case; early words are the most common"""
+    verb = VERBS[min(int(rng.paretovariate(1.2)) - 1, len(VERBS) - 1)]
+    noun = WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)]
+    if style == 'snake':
+        return f'{verb}_{noun}'
+    return verb + noun.capitalize()
+
+
+def class_name(rng: random.Random) -> str:
+    return rng.choice(WORDS).capitalize() + rng.choice(CLASS_SUFFIXES)
+
+
+def _python_file(rng: random.Random) -> str:
+    name = class_name(rng)
+    lines = [f'from {rng.choice(WORDS)}.{rng.choice(WORDS)} import {class_name(rng)}', 'import logging', '',
+             f'class {name}:', f'    """{rng.choice(VERBS).capitalize()} {rng.choice(WORDS)} records"""', '',
+             '    def __init__(self, config):', '        self.config = config', '']
+    for _ in range(rng.randint(2, 6)):
+        method = identifier(rng, 'snake')
+        lines += [f'    def {method}(self, {rng.choice(WORDS)}_id):',
+                  f'        result = self.{identifier(rng, "snake")}({rng.choice(WORDS)}_id)',
+                  f'        logging.debug("{method} %s", result)',
+                  '        return result', '']
+    lines += ['def load_config(path):', '    with open(path) as f:', '        return f.read()', '']
+    return '\n'.join(lines)
+
+
+def _script_file(rng: random.Random, typescript: bool) -> str:
+    name = class_name(rng)
+    annotation = ': Promise<void>' if typescript else ''
+    lines = [f"import {{ {identifier(rng, 'camel')} }} from './{rng.choice(WORDS)}';", '',
+             f'export class {name} {{', '  constructor(client) {', '    this.client = client;', '  }', '']
+    for _ in range(rng.randint(2, 6)):
+        method = identifier(rng, 'camel')
+        lines += [f'  async {method}({rng.choice(WORDS)}Id){annotation} {{',
+                  f"    const response = await fetch{rng.choice(WORDS).capitalize()}(`/api/{rng.choice(WORDS)}/${{id}}`);",
+                  f'    return this.{identifier(rng, "camel")}(response);', '  }', '']
+    lines += ['}', '', f'export const {identifier(rng, "camel")} = (value) => value;', '']
+    return '\n'.join(lines)
+
+
+def _markup_file(rng: random.Random, extension: str) -> str:
+    word, other = rng.choice(WORDS), rng.choice(WORDS)
+    if extension == '.html':
+        items = ''.join(f'    <li class="{rng.choice(WORDS)}-item">{identifier(rng, "camel")}</li>\n' for _ in range(8))
+        return f'<div class="{word}-panel">\n  <h2>{word.capitalize()} {other}</h2>\n  <ul>\n{items}  </ul>\n</div>\n'
+    if extension == '.css':
+        return ''.join(f'.{rng.choice(WORDS)}-{rng.choice(WORDS)} {{\n  color: #{rng.randrange(16 ** 6):06x};\n'
+                       f'  margin: {rng.randint(0, 32)}px;\n}}\n\n' for _ in range(6))
+    if extension == '.json':
+        return json.dumps({rng.choice(WORDS): {identifier(rng, 'camel'): rng.randint(0, 1000) for _ in range(6)}
+                           for _ in range(3)}, indent=2) + '\n'
+    if extension in ('.yaml', '.yml'):
+        return ''.join(f'{rng.choice(WORDS)}:\n  {identifier(rng, "snake")}: {rng.randint(1, 100)}\n'
+                       f'  enabled: {rng.choice(["true", "false"])}\n' for _ in range(6))
+    if extension == '.sql':
+        return (f'CREATE TABLE {word}_{other} (\n  id SERIAL PRIMARY KEY,\n  {rng.choice(WORDS)}_id INTEGER,\n'
+                f'  created_at TIMESTAMP\n);\n\nSELECT * FROM {word}_{other} WHERE {rng.choice(WORDS)}_id = $1;\n')
+    if extension == '.sh':
+        return (f'#!/bin/sh\nset -e\nexport {word.upper()}_DIR=/var/lib/{other}\n'
+                f'python -m {word}.{identifier(rng, "snake")} --{other}\n')
+    return (f'# {word.capitalize()} {other}\n\nCall `{identifier(rng, "camel")}` to {rng.choice(VERBS)} the '
+            f'{word} before the {other} is saved.\n\n## {identifier(rng, "snake")}\n\nSee the {other} docs.\n')
+
+
+def synthetic_file(rng: random.Random, extension: str, number: int) -> Dict[str, str]:
+    """One generated source file of the given extension"""
+    if extension == '.py':
+        content = _python_file(rng)
+    elif extension in ('.js', '.ts'):
+        content = _script_file(rng, extension == '.ts')
+    else:
+        content = _markup_file(rng, extension)
+    if rng.randrange(RARE_RATE) == 0:
+        content += f'\n// {rng.choice(RARE_TERMS)}\n'
+    if number < len(PLANTED_TERMS):
+        content += f'\n// {PLANTED_TERMS[number]}\n'
+    directory = rng.choice(['src', 'lib', 'app', 'routes', 'tests', 'scripts'])
+    path = f'{directory}/{rng.choice(WORDS)}/{identifier(rng, "snake")}_{number}{extension}'
+    return {"path": path, "type": file_type_for(path), "content": content}
+
+
+def synthetic_repositories(files: int, seed: int = 42,
+                           files_per_repository: int = FILES_PER_REPOSITORY) -> Iterator[Tuple[str, List[Dict[str, str]]]]:
+    """Yield (repository name, files) pairs adding up to the requested number of files"""
+    rng = random.Random(seed)
+    extensions = list(LANGUAGE_MIX)
+    weights = [LANGUAGE_MIX[extension] for extension in extensions]
+    for number, start in enumerate(range(0, files, files_per_repository)):
+        count = min(files_per_repository, files - start)
+        chosen = rng.choices(extensions, weights, k=count)
+        yield f'repo-{number:04d}', [synthetic_file(rng, extension, start + i) for i, extension in enumerate(chosen)]
+
+
+def peak_rss_kb() -> int:
+    """Peak resident set size of this process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def current_rss_kb() -> Optional[int]:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def latency_stats(samples: List[float]) -> Dict[str, float]:
+    """p50/p99 by nearest rank, mean and single-client rate of latencies in seconds"""
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+    total = sum(ordered)
+    return {
+        "p50_ms": percentile(50) * 1000,
+        "p99_ms": percentile(99) * 1000,
+        "mean_ms": total / len(ordered) * 1000,
+        "sequential_qps": len(ordered) / total if total else 0.0,
+    }
+
+
+def _batches(files: int, seed: int, batch_files: int) -> Iterator[List[Tuple[str, List[Dict[str, str]]]]]:
+    group: List[Tuple[str, List[Dict[str, str]]]] = []
+    size = 0
+    for repository in synthetic_repositories(files, seed):
+        group.append(repository)
+        size += len(repository[1])
+        if size >= batch_files:
+            yield group
+            group, size = [], 0
+    if group:
+        yield group
+
+
+def build_index(directory: str, files: int, seed: int, batch_files: int) -> Dict[str, Any]:
+    """Generate and index a corpus, returning build timings and index size"""
+    indexer = Indexer(directory)
+    generate_seconds = index_seconds = 0.0
+    repositories = 0
+    batches = _batches(files, seed, batch_files)
+    while True:
+        started = time.perf_counter()
+        group = next(batches, None)
+        generated = time.perf_counter()
+        generate_seconds += generated - started
+        if group is None:
+            break
+        with indexer.batch() as batch:
+            for name, repository_files in group:
+                batch.sync_repository(name, repository_files, f'Synthetic repository {name}')
+        repositories += len(group)
+        index_seconds += time.perf_counter() - generated
+
+    merge_started = time.perf_counter()
+    indexer.merge_all()
+    merge_seconds = time.perf_counter() - merge_started
+
+    index = indexer.refresh()
+    index_bytes = sum(os.path.getsize(os.path.join(directory, entry)) for entry in os.listdir(directory))
+    return {
+        "repositories": repositories,
+        "files": index.num_files,
+        "blobs": index.total_blobs,
+        "segments": len(index.segments),
+        "index_bytes": index_bytes,
+        "generate_s": generate_seconds,
+        "index_s": index_seconds,
+        "merge_s": merge_seconds,
+        "build_s": index_seconds + merge_seconds,
+    }
+
+
+async def throughput(q: str, regex: bool, clients: int, iterations: int) -> float:
+    """Queries per second the endpoint answers with clients issuing the query at once"""
+    import codesearch
+
+    async def client():
+        for _ in range(iterations):
+            await codesearch.search_code(q=q, filetypes='', repo='', regex=regex, fuzzy=False)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    return clients * iterations / elapsed if elapsed else 0.0
+
+
+async def run_queries(iterations: int, warmup: int, clients: int = CLIENTS) -> List[Dict[str, Any]]:
+    """Time every query of the mix through the engine, the renderer and the endpoint
+
+    Latencies come from one query at a time; throughput from clients
+    concurrent ones.
+    """
+    # Imported late: the app reads CODESEARCH_INDEX_DIR on import
+    import codesearch
+
+    await codesearch.start_backend()
+    results = []
+    try:
+        for name, kind, q, regex in QUERY_MIX:
+            request = codesearch.search_request(q, None, None, regex, codesearch.MAX_RESULTS,
+                                                codesearch.SEARCH_DEADLINE)
+            engine, render, end_to_end = [], [], []
+            response = None
+            for iteration in range(warmup + iterations):
+                started = time.perf_counter()
+                response = await codesearch.backend.search(request)
+                searched = time.perf_counter()
+                terms, matcher, plan = codesearch.build_highlighter(q, regex)
+                for _, indexed in response.hits:
+                    codesearch.result_context(indexed, q, terms, matcher, plan)
+                rendered = time.perf_counter()
+                await codesearch.search_code(q=q, filetypes='', repo='', regex=regex, fuzzy=False)
+                finished = time.perf_counter()
+                if iteration >= warmup:
+                    engine.append(searched - started)
+                    render.append(rendered - searched)
+                    end_to_end.append(finished - rendered)
+            results.append({
+                "name": name, "kind": kind, "q": q, "regex": regex,
+                "matches": response.total, "truncated": response.truncated,
+                "engine": latency_stats(engine),
+                "render": latency_stats(render),
+                "end_to_end": latency_stats(end_to_end),
+                "qps": await throughput(q, regex, clients, iterations),
+            })
+    finally:
+        await codesearch.backend.close()
+    return results
+
+
+def summarize(queries: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Aggregate end-to-end latency and concurrent throughput per query kind"""
+    kinds: Dict[str, List[Dict[str, Any]]] = {}
+    for query in queries:
+        kinds.setdefault(query["kind"], []).append(query)
+    return {kind: {"p50_ms": max(q["end_to_end"]["p50_ms"] for q in group),
+                   "p99_ms": max(q["end_to_end"]["p99_ms"] for q in group),
+                   "qps": min(q["qps"] for q in group)}
+            for kind, group in kinds.items()}
+
+
+def run_size(files: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Build a corpus of the given size in a scratch directory and benchmark it"""
+    directory = tempfile.mkdtemp(prefix=f'codesearch-bench-{files}-', dir=args.workdir)
+    try:
+        build = build_index(directory, files, args.seed, args.batch_files)
+        rss_after_build = current_rss_kb()
+        os.environ["CODESEARCH_INDEX_DIR"] = directory
+        # Every iteration must do the work, not hit the result cache
+        os.environ["CODESEARCH_CACHE_BYTES"] = "0"
+        if args.workers is not None:
+            os.environ["CODESEARCH_WORKERS"] = str(args.workers)
+        queries = asyncio.run(run_queries(args.iterations, args.warmup, args.clients))
+        return {
+            "files": files,
+            "build": build,
+            "rss": {"after_build_kb": rss_after_build, "current_kb": current_rss_kb(), "peak_kb": peak_rss_kb()},
+            "queries": queries,
+            "summary": summarize(queries),
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_isolated(files: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark one corpus size in a fresh interpreter so RSS is measured per size"""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as out:
+        output = out.name
+    try:
+        command = [sys.executable, os.path.abspath(__file__), '--files', str(files), '--output', output,
+                   '--iterations', str(args.iterations), '--warmup', str(args.warmup), '--seed', str(args.seed),
+                   '--batch-files', str(args.batch_files), '--clients', str(args.clients), '--raw']
+        if args.workers is not None:
+            command += ['--workers', str(args.workers)]
+        if args.workdir:
+            command += ['--workdir', args.workdir]
+        if args.keep:
+            command.append('--keep')
+        subprocess.run(command, check=True)
+        with open(output, encoding='utf-8') as f:
+            return json.load(f)["runs"][0]
+    finally:
+        os.remove(output)
+
+
+def report(results: Dict[str, Any]):
+    """Print a human readable summary of the results to stderr"""
+    for run in results["runs"]:
+        build = run["build"]
+        print(f"{run['files']} files, {build['blobs']} blobs: built in {build['build_s']:.1f}s, "
+              f"index {build['index_bytes'] / 1e6:.1f} MB, peak RSS {run['rss']['peak_kb'] / 1024:.0f} MiB",
+              file=sys.stderr)
+        for query in run["queries"]:
+            stats = query["end_to_end"]
+            print(f"  {query['name']:16} {query['matches']:>8} matches  p50 {stats['p50_ms']:8.2f} ms  "
+                  f"p99 {stats['p99_ms']:8.2f} ms  {query['qps']:8.1f} q/s", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark CodeSearch on synthetic corpora")
+    parser.add_argument('--files', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Corpus sizes to benchmark, up to 1000000")
+    parser.add_argument('--iterations', type=int, default=20, help="Timed runs of every query")
+    parser.add_argument('--warmup', type=int, default=2, help="Untimed runs of every query")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch-files', type=int, default=BATCH_FILES, help="Files per indexing batch")
+    parser.add_argument('--clients', type=int, default=CLIENTS, help="Concurrent clients when measuring q/s")
+    parser.add_argument('--workers', type=int, help="Search worker processes, CODESEARCH_WORKERS by default")
+    parser.add_argument('--workdir', help="Where scratch indexes are built")
+    parser.add_argument('--keep', action='store_true', help="Keep the scratch indexes")
+    parser.add_argument('--output', help="Write JSON results here instead of stdout")
+    parser.add_argument('--raw', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.raw:
+        runs = [run_size(files, args) for files in args.files]
+    else:
+        runs = [run_isolated(files, args) for files in args.files]
+    results = {
+        "benchmark": "codesearch",
+        "started": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {"iterations": args.iterations, "warmup": args.warmup, "seed": args.seed,
+                   "batch_files": args.batch_files, "workers": args.workers, "language_mix": LANGUAGE_MIX},
+        "runs": runs,
+    }
+    if not args.raw:
+        report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,52 @@
-from fastapi import FastAPI, Request, Query
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, Query, HTTPException
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import asyncio
 import re
 import os
 import json
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from pathlib import Path
+from pydantic import BaseModel
 import mimetypes
+import base64
+import hashlib
+import binascii
+from html import escape as html_escape
+
+from indexer import DEFAULT_INDEX_DIR, Indexer, file_type_for
+from parallel_search import ShardedSearcher
+from query_plan import LANGUAGE_MAP, AhoCorasick, RegexMatcher, definition_lines, parse_query
+from search_backend import (BackendError, CursorExpired, InvalidPosition, LocalBackend, ManticoreBackend, SearchBackend,
+                            search_request)
+from search_index import IndexedFile, fold
+from regex_search import RegexError, compile_regex
+from fuzzy import corrected_query, expand_query
+from result_cache import ResultCache, normalize_key
 
 app = FastAPI(title="CodeSearch API")
 
+# Persisted index segments, memory-mapped and shared by every worker
+INDEX_DIR = os.environ.get("CODESEARCH_INDEX_DIR", DEFAULT_INDEX_DIR)
+MERGE_INTERVAL = float(os.environ.get("CODESEARCH_MERGE_INTERVAL", "30"))
+MAX_RESULTS = 20
+# Page sizes of the JSON API, which returns every match through cursors
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Queries fan out over a process pool; past the deadline partial results are returned
+SEARCH_WORKERS = int(os.environ.get("CODESEARCH_WORKERS", str(os.cpu_count() or 1)))
+SEARCH_DEADLINE = float(os.environ.get("CODESEARCH_DEADLINE", "2.0"))
+# "local" serves the segment index in-process; "manticore" talks to a ManticoreSearch node
+SEARCH_BACKEND = os.environ.get("CODESEARCH_BACKEND", "local")
+MANTICORE_HOST = os.environ.get("MANTICORE_HOST", "localhost")
+MANTICORE_PORT = int(os.environ.get("MANTICORE_PORT", "9308"))
+MANTICORE_POOL_SIZE = int(os.environ.get("MANTICORE_POOL_SIZE", "8"))
+# Rendered results keyed on (q, filetypes, repo), dropped whenever the index changes
+CACHE_MAX_BYTES = int(os.environ.get("CODESEARCH_CACHE_BYTES", str(32 * 1024 * 1024)))
+CACHE_TTL = float(os.environ.get("CODESEARCH_CACHE_TTL", "300"))
+
 # Mock data for demonstration - in real implementation, this would connect to ManticoreSearch
 @dataclass
 class SearchResult:
@@ -285,151 +319,496 @@ class TextProcessor:
     ]
 }
 
+class FileIngest(BaseModel):
+    content: str
+    type: Optional[str] = None
+
+class RepositoryFile(BaseModel):
+    path: str
+    content: str
+    type: Optional[str] = None
+
+class RepositoryIngest(BaseModel):
+    description: Optional[str] = None
+    files: List[RepositoryFile] = []
+    replace: bool = True
+
+def build_indexer() -> Indexer:
+    """Open the index directory, seeding it from the mock repositories on first run"""
+    indexer = Indexer(INDEX_DIR)
+    if not indexer.exists():
+        with indexer.batch() as batch:
+            # Another worker may have seeded it while we waited for the lock
+            if not batch.base.generation:
+                for repo in MOCK_REPOSITORIES:
+                    batch.sync_repository(repo['name'], MOCK_CODE_FILES.get(repo['name'], []), repo['description'])
+    return indexer
+
+def build_backend() -> SearchBackend:
+    """Create the search backend selected by CODESEARCH_BACKEND"""
+    if SEARCH_BACKEND == "manticore":
+        return ManticoreBackend(MANTICORE_HOST, MANTICORE_PORT, MANTICORE_POOL_SIZE)
+    return LocalBackend(build_indexer(), ShardedSearcher(INDEX_DIR, SEARCH_WORKERS))
+
+# Built on startup, so importing the app has no side effects on the index directory
+backend: Optional[SearchBackend] = None
+result_cache = ResultCache(CACHE_MAX_BYTES, CACHE_TTL)
+
 def get_file_language(file_path: str) -> str:
     """Determine language from file extension"""
     ext = Path(file_path).suffix.lower()
-    language_map = {
-        '.js': 'javascript',
-        '.ts': 'typescript',
-        '.py': 'python',
-        '.html': 'html',
-        '.css': 'css',
-        '.json': 'json',
-        '.yaml': 'yaml',
-        '.yml': 'yaml',
-        '.sql': 'sql',
-        '.sh': 'bash',
-        '.md': 'markdown'
-    }
-    return language_map.get(ext, 'text')
+    return LANGUAGE_MAP.get(ext, 'text')
 
-def highlight_matches(content: str, query: str) -> str:
-    """Highlight search matches in content"""
+def highlight_matches(content: str, query: str, matcher=None) -> str:
+    """Highlight search matches in content, escaping everything else"""
     if not query.strip():
-        return content
+        return html_escape(content)
     
-    # Simple highlighting - in real implementation, use proper tokenization
-    pattern = re.compile(re.escape(query), re.IGNORECASE)
-    return pattern.sub(f'<span class="match-highlight">{query}</span>', content)
+    if matcher is None:
+        matcher = AhoCorasick([query])
+    html = []
+    last = 0
+    for start, end in matcher.spans(content):
+        html.append(html_escape(content[last:start]))
+        html.append(f'<span class="match-highlight">{html_escape(content[start:end])}</span>')
+        last = end
+    html.append(html_escape(content[last:]))
+    return ''.join(html)
 
-def extract_context(content: str, query: str, context_lines: int = 3) -> List[Dict]:
-    """Extract context around matches"""
-    lines = content.split('\n')
-    matches = []
+def find_match_lines(indexed: IndexedFile, terms: Optional[List[str]], matcher,
+                     max_matches: Optional[int] = None, lines: Optional[List[int]] = None) -> List[int]:
+    """0-based numbers of the lines holding a match of the literal terms, or of the matcher without terms"""
+    segment, doc_id = indexed.segment, indexed.doc_id
+    if lines:
+        return lines[:max_matches] if max_matches else lines
+    if terms is not None:
+        found = set()
+        for term in terms:
+            found.update(segment.match_lines(doc_id, fold(term), max_matches))
+        return sorted(found)[:max_matches] if max_matches else sorted(found)
+    match_lines = []
+    for i, line in enumerate(segment.lines(doc_id)):
+        if matcher.spans(line):
+            match_lines.append(i)
+            if max_matches and len(match_lines) >= max_matches:
+                break
+    return match_lines
+
+def extract_context(indexed: IndexedFile, query: str, context_lines: int = 3,
+                    terms: Optional[List[str]] = None, matcher=None,
+                    max_matches: Optional[int] = None, lines: Optional[List[int]] = None) -> List[Dict]:
+    """Extract context around matches of literal terms or a regex matcher
+
+    Literal terms are located in the folded buffer and mapped to lines
+    through the stored line table, so only the lines shown are decoded.
+    Without terms, lines are located with the matcher instead; lines, when
+    given, are the 0-based lines to show, such as symbol definitions.
+    """
+    segment, doc_id = indexed.segment, indexed.doc_id
+    if terms is None and matcher is None:
+        terms = [query]
+    if matcher is None:
+        matcher = AhoCorasick(terms)
     
-    for i, line in enumerate(lines):
-        if query.lower() in line.lower():
-            start = max(0, i - context_lines)
-            end = min(len(lines), i + context_lines + 1)
-            
-            context_lines_data = []
-            for j in range(start, end):
-                context_lines_data.append({
-                    'line_number': j + 1,
-                    'content': highlight_matches(lines[j], query),
-                    'is_match': j == i
-                })
-            
-            matches.append({
-                'line_number': i + 1,
-                'context': context_lines_data
+    match_lines = find_match_lines(indexed, terms, matcher, max_matches, lines)
+    if not match_lines and terms is not None and not terms:
+        match_lines = [0]  # Filter-only queries show the top of the file
+    
+    line_count = segment.line_count(doc_id)
+    matches = []
+    for i in match_lines:
+        start = max(0, i - context_lines)
+        end = min(line_count, i + context_lines + 1)
+        
+        context_lines_data = []
+        for j, line in enumerate(segment.lines(doc_id, start, end), start):
+            context_lines_data.append({
+                'line_number': j + 1,
+                'content': highlight_matches(line, query, matcher),
+                'is_match': j == i
             })
+        
+        matches.append({
+            'line_number': i + 1,
+            'context': context_lines_data
+        })
     
     return matches
 
 @app.get("/repositories")
 async def get_repositories():
     """Get list of available repositories"""
+    try:
+        repositories = await backend.repositories()
+    except BackendError as e:
+        return HTMLResponse(f'<div class="no-results">{html_escape(str(e))}</div>')
     html = ""
-    for repo in MOCK_REPOSITORIES:
+    for repo in repositories:
+        # Names and descriptions come from whoever ingested the repository
+        name = html_escape(repo['name'], quote=True)
         html += f'''
-        <div class="repo-item" data-repo="{repo['name']}" hx-get="/search" hx-target="#search-results">
-            <strong>{repo['name']}</strong>
+        <div class="repo-item" data-repo="{name}" hx-get="/search" hx-target="#search-results">
+            <strong>{name}</strong>
             <div style="font-size: 0.8rem; color: #8b949e; margin-top: 0.25rem;">
-                {repo['description']}
+                {html_escape(repo['description'] or '')}
             </div>
         </div>
         '''
     return HTMLResponse(html)
 
-@app.get("/search")
-async def search_code(
-    q: str = Query("", description="Search query"),
-    filetypes: str = Query("", description="Comma-separated file types"),
-    repo: str = Query("", description="Repository filter")
-):
-    """Search code with filters"""
-    if not q.strip():
-        return HTMLResponse('<div class="no-results">Enter a search query to see results.</div>')
-    
-    # Parse filters
-    file_type_filter = [ft.strip() for ft in filetypes.split(',') if ft.strip()] if filetypes else []
-    
-    # Mock search implementation
-    results = []
-    repositories_to_search = [repo] if repo else MOCK_CODE_FILES.keys()
-    
-    for repo_name in repositories_to_search:
-        if repo_name not in MOCK_CODE_FILES:
-            continue
-            
-        for file_data in MOCK_CODE_FILES[repo_name]:
-            # Apply file type filter
-            if file_type_filter and file_data['type'] not in file_type_filter:
-                continue
-            
-            # Simple text search
-            if q.lower() in file_data['content'].lower():
-                matches = extract_context(file_data['content'], q)
-                for match in matches[:2]:  # Limit matches per file
-                    results.append({
-                        'file_path': file_data['path'],
-                        'repository': repo_name,
-                        'file_type': file_data['type'],
-                        'match': match,
-                        'language': get_file_language(file_data['path'])
-                    })
-    
-    # Sort by relevance (mock scoring)
-    results.sort(key=lambda x: x['file_path'])
-    
-    if not results:
-        return HTMLResponse('''
+@app.put("/repositories/{name}")
+async def ingest_repository(name: str, payload: RepositoryIngest):
+    """Add or update a repository; only changed files are re-indexed"""
+    files = [file.dict() for file in payload.files]
+    stats = await backend.index_repository(name, files, payload.description, payload.replace)
+    return {"repository": name, **stats, "generation": await backend.generation()}
+
+@app.delete("/repositories/{name}")
+async def delete_repository(name: str):
+    """Remove a repository and all of its files from the index"""
+    deleted = await backend.delete_repository(name)
+    return {"repository": name, "deleted": deleted, "generation": await backend.generation()}
+
+@app.put("/repositories/{name}/files/{path:path}")
+async def ingest_file(name: str, path: str, payload: FileIngest):
+    """Add or update a single file"""
+    changed = await backend.upsert_file(name, path, payload.type or file_type_for(path), payload.content)
+    return {"repository": name, "path": path, "changed": changed, "generation": await backend.generation()}
+
+@app.delete("/repositories/{name}/files/{path:path}")
+async def delete_file(name: str, path: str):
+    """Delete a single file"""
+    if not await backend.delete_file(name, path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return {"repository": name, "path": path, "deleted": True, "generation": await backend.generation()}
+
+async def maintain_backend():
+    """Periodically run backend maintenance, such as merging small segments"""
+    while True:
+        await asyncio.sleep(MERGE_INTERVAL)
+        try:
+            await backend.maintain()
+        except Exception as e:
+            print(f"CodeSearch backend maintenance failed: {e}")
+
+@app.on_event("startup")
+async def start_backend():
+    global backend
+    # The local index seeds itself; a fresh Manticore node gets the mock repositories here
+    backend = await asyncio.to_thread(build_backend)
+    if SEARCH_BACKEND == "manticore":
+        try:
+            if not await backend.repositories():
+                for repo in MOCK_REPOSITORIES:
+                    await backend.index_repository(repo['name'], MOCK_CODE_FILES.get(repo['name'], []), repo['description'])
+        except BackendError as e:
+            print(f"CodeSearch could not seed ManticoreSearch: {e}")
+    asyncio.create_task(maintain_backend())
+
+@app.on_event("shutdown")
+async def stop_backend():
+    await backend.close()
+
+NO_RESULTS_HTML = '''
         <div class="no-results" style="text-align: center; padding: 2rem; color: #8b949e;">
             <div style="font-size: 2rem; margin-bottom: 1rem;">🔍</div>
             <h3>No results found</h3>
             <p>Try adjusting your search query or filters.</p>
         </div>
-        ''')
-    
-    # Generate HTML results
-    html = f'<div class="results-header" style="margin-bottom: 1rem; color: #8b949e;">Found {len(results)} results for "{q}"</div>'
-    
-    for result in results[:20]:  # Limit results
-        context_html = ""
-        for line_data in result['match']['context']:
-            line_class = "match-line" if line_data['is_match'] else "context-line"
-            context_html += f'''
+        '''
+
+def no_results_html(q: str, corrections: Dict[str, List[str]]) -> str:
+    """Render the empty result page, offering the corrected query when there is one"""
+    if not corrections:
+        return NO_RESULTS_HTML
+    suggestion = html_escape(corrected_query(q, corrections))
+    return f'''
+        <div class="no-results" style="text-align: center; padding: 2rem; color: #8b949e;">
+            <div style="font-size: 2rem; margin-bottom: 1rem;">🔍</div>
+            <h3>No results found</h3>
+            <p>Did you mean <a href="#" class="did-you-mean" data-query="{suggestion}">{suggestion}</a>?</p>
+        </div>
+        '''
+
+def results_summary(total: int, q: str, truncated: bool, css_class: str = "results-header",
+                    corrections: Optional[Dict[str, List[str]]] = None) -> str:
+    """Render the line that reports how many files matched"""
+    partial_note = " (search budget exhausted, results are partial)" if truncated else ""
+    if corrections:
+        spellings = ', '.join(dict.fromkeys(word for words in corrections.values() for word in words))
+        partial_note += f" (including {html_escape(spellings)})"
+    return f'<div class="{css_class}" style="margin-bottom: 1rem; color: #8b949e;">Found {total} matching files for "{html_escape(q)}"{partial_note}</div>'
+
+def render_result(indexed: IndexedFile, match: Dict) -> str:
+    """Render one result card"""
+    context_html = []
+    for line_data in match['context']:
+        line_class = "match-line" if line_data['is_match'] else "context-line"
+        context_html.append(f'''
             <div class="code-line {line_class}">
                 <span class="line-number">{line_data['line_number']}</span>
                 <span class="line-content">{line_data['content']}</span>
             </div>
-            '''
-        
-        html += f'''
+            ''')
+    
+    return f'''
         <div class="search-result">
             <div class="result-header">
-                <div class="result-path">{result['file_path']}</div>
-                <div class="result-repo">{result['repository']}</div>
+                <div class="result-path">{html_escape(indexed.path)}</div>
+                <div class="result-repo">{html_escape(indexed.repository)}</div>
             </div>
             <div class="result-content">
-                <pre><code class="language-{result['language']}">{context_html}</code></pre>
+                <pre><code class="language-{html_escape(get_file_language(indexed.path), quote=True)}">{''.join(context_html)}</code></pre>
             </div>
         </div>
         '''
+
+def build_highlighter(q: str, regex: bool):
+    """Return the literal terms, the matcher and the plan used to locate and highlight result lines
+
+    Raises RegexError.
+    """
+    # Built once per query and reused for every result line
+    if regex:
+        return None, RegexMatcher(compile_regex(q).pattern), None
+    plan = parse_query(q)
+    return plan.terms, AhoCorasick(plan.terms), plan
+
+def result_context(indexed: IndexedFile, q: str, terms, matcher, plan) -> List[Dict]:
+    """Context of one result; definition searches show the definitions themselves"""
+    lines = definition_lines(indexed.segment, indexed.doc_id, plan) if plan is not None and plan.symbols else None
+    return extract_context(indexed, q, terms=terms, matcher=matcher, max_matches=2, lines=lines)  # Limit matches per file
+
+async def spelling_corrections(q: str, regex: bool) -> Dict[str, List[str]]:
+    """Suggested spellings of the query terms that match no document
+
+    Raises BackendError.
+    """
+    if regex:
+        return {}
+    return await backend.suggest(parse_query(q).terms)
+
+async def render_search(q: str, file_type_filter: List[str], repositories: Optional[List[str]],
+                        regex: bool, fuzzy: bool = False) -> Tuple[str, bool]:
+    """Run a search through the backend and render the results
+
+    In fuzzy mode misspelled terms also match their likely intended
+    spellings; otherwise an empty result page suggests the corrected query.
+    Returns the HTML and whether it may be cached; partial results cut short
+    by the deadline or the regex budget are not.
+    """
+    try:
+        corrections = await spelling_corrections(q, regex) if fuzzy else {}
+        search_q = expand_query(q, corrections)
+        terms, matcher, plan = build_highlighter(search_q, regex)
+        request = search_request(search_q, file_type_filter, repositories, regex, MAX_RESULTS, SEARCH_DEADLINE)
+        response = await backend.search(request)
+    except RegexError as e:
+        return f'<div class="no-results">{html_escape(str(e))}</div>', True
+    except BackendError as e:
+        return f'<div class="no-results">{html_escape(str(e))}</div>', False
+    
+    # Context is extracted for the best files alone
+    cards = []
+    for score, indexed in response.hits:
+        for match in result_context(indexed, search_q, terms, matcher, plan):
+            if len(cards) < MAX_RESULTS:
+                cards.append(render_result(indexed, match))
+    
+    if not cards:
+        # Suggestions are only looked up once a query has come back empty
+        if not fuzzy and not response.truncated:
+            try:
+                corrections = await spelling_corrections(q, regex)
+            except BackendError:
+                corrections = {}
+        return no_results_html(q, {} if fuzzy else corrections), not response.truncated
     
+    summary = results_summary(response.total, q, response.truncated, corrections=corrections)
+    return summary + ''.join(cards), not response.truncated
+
+async def stream_results(q: str, file_type_filter: List[str], repositories: Optional[List[str]], regex: bool,
+                         fuzzy: bool = False):
+    """Yield (event, html) pairs: each result card as soon as it is found, then the total
+
+    With the local backend cards come out in index order rather than by
+    score, so the first one is sent after verifying just enough candidates
+    to find it. Only one card is held in memory at a time.
+    """
+    if not q.strip():
+        yield "total", '<div class="no-results">Enter a search query to see results.</div>'
+        return
+    try:
+        corrections = await spelling_corrections(q, regex) if fuzzy else {}
+        search_q = expand_query(q, corrections)
+        terms, matcher, plan = build_highlighter(search_q, regex)
+        request = search_request(search_q, file_type_filter, repositories, regex, MAX_RESULTS, SEARCH_DEADLINE)
+        stream = await backend.stream(request)
+    except (RegexError, BackendError) as e:
+        yield "total", f'<div class="no-results">{html_escape(str(e))}</div>'
+        return
+    
+    shown = 0
+    async for score, indexed in stream:
+        for context in result_context(indexed, search_q, terms, matcher, plan):
+            if shown < MAX_RESULTS:
+                shown += 1
+                yield "result", render_result(indexed, context)
+        if shown >= MAX_RESULTS:
+            # The page is full; the rest only needs counting
+            await stream.finish()
+            break
+    
+    if not stream.total:
+        if not fuzzy and not stream.truncated:
+            try:
+                corrections = await spelling_corrections(q, regex)
+            except BackendError:
+                pass
+        yield "total", no_results_html(q, {} if fuzzy else corrections)
+    else:
+        yield "total", results_summary(stream.total, q, stream.truncated, css_class="results-footer",
+                                       corrections=corrections)
+
+def sse_event(event: str, data: str) -> str:
+    """Format a server-sent event, one data field per line"""
+    lines = ''.join(f'data: {line}\n' for line in data.split('\n'))
+    return f'event: {event}\n{lines}\n'
+
+@app.get("/search")
+async def search_code(
+    q: str = Query("", description="Search query"),
+    filetypes: str = Query("", description="Comma-separated file types"),
+    repo: str = Query("", description="Repository filter"),
+    regex: bool = Query(False, description="Treat the query as a regular expression"),
+    fuzzy: bool = Query(False, description="Also match likely intended spellings of misspelled terms")
+):
+    """Search code with filters"""
+    if not q.strip():
+        return HTMLResponse('<div class="no-results">Enter a search query to see results.</div>')
+    
+    # Parse filters
+    file_type_filter = [ft.strip() for ft in filetypes.split(',') if ft.strip()] if filetypes else []
+    repositories = [repo] if repo else None
+    
+    # Repeated keystrokes are answered from the cache; for the local backend
+    # the generation check only stats the manifest
+    generation = await backend.generation()
+    key = normalize_key(q, file_type_filter, repo, regex, fuzzy)
+    html = result_cache.get(key, generation)
+    if html is None:
+        html, cacheable = await render_search(q, file_type_filter, repositories, regex, fuzzy)
+        if cacheable:
+            result_cache.put(key, generation, html)
     return HTMLResponse(html)
 
+@app.get("/search/stream")
+async def stream_search(
+    q: str = Query("", description="Search query"),
+    filetypes: str = Query("", description="Comma-separated file types"),
+    repo: str = Query("", description="Repository filter"),
+    regex: bool = Query(False, description="Treat the query as a regular expression"),
+    fuzzy: bool = Query(False, description="Also match likely intended spellings of misspelled terms"),
+    format: str = Query("html", description="html for chunked HTML, sse for server-sent events")
+):
+    """Stream search results as they are found"""
+    if format not in ("html", "sse"):
+        raise HTTPException(status_code=400, detail="format must be html or sse")
+    file_type_filter = [ft.strip() for ft in filetypes.split(',') if ft.strip()] if filetypes else []
+    repositories = [repo] if repo else None
+    async def body():
+        async for event, html in stream_results(q, file_type_filter, repositories, regex, fuzzy):
+            yield sse_event(event, html) if format == "sse" else html
+        if format == "sse":
+            yield sse_event("done", "")
+    
+    media_type = "text/event-stream" if format == "sse" else "text/html; charset=utf-8"
+    # Keep proxies from buffering the stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+def query_fingerprint(q: str, file_type_filter: List[str], repo: str, regex: bool) -> str:
+    """Short digest binding a cursor to the search it was issued for"""
+    key = repr(normalize_key(q, file_type_filter, repo, regex)).encode('utf-8')
+    return hashlib.blake2b(key, digest_size=8).hexdigest()
+
+def encode_cursor(fingerprint: str, position) -> str:
+    payload = json.dumps({"q": fingerprint, "p": position}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, fingerprint: str):
+    """Return the backend position held by a cursor
+
+    Raises HTTPException for cursors that are malformed or belong to another search.
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        issued_for, position = payload["q"], payload["p"]
+        backend.check_position(position)
+    except InvalidPosition as e:
+        raise HTTPException(status_code=400, detail=f"Malformed cursor: {e}")
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Malformed cursor")
+    if issued_for != fingerprint:
+        raise HTTPException(status_code=400, detail="Cursor belongs to a different search")
+    return position
+
+def api_result(score: float, indexed: IndexedFile, terms, matcher, plan) -> Dict:
+    """JSON record of a matching file with every matching line"""
+    lines = definition_lines(indexed.segment, indexed.doc_id, plan) if plan is not None and plan.symbols else None
+    numbers = find_match_lines(indexed, terms, matcher, lines=lines)
+    return {
+        "repository": indexed.repository,
+        "path": indexed.path,
+        "language": get_file_language(indexed.path),
+        "score": round(score, 4),
+        "matches": [{"line": i + 1, "text": indexed.segment.lines(indexed.doc_id, i, i + 1)[0]} for i in numbers],
+    }
+
+@app.get("/api/search")
+async def api_search(
+    q: str = Query(..., description="Search query"),
+    filetypes: str = Query("", description="Comma-separated file types"),
+    repo: str = Query("", description="Repository filter"),
+    regex: bool = Query(False, description="Treat the query as a regular expression"),
+    limit: int = Query(API_PAGE_SIZE, ge=1, le=API_MAX_PAGE_SIZE, description="Files per page"),
+    cursor: str = Query("", description="next_cursor of the previous page")
+):
+    """Search code as JSON, one page of files in index order at a time
+
+    Every file and every matching line is returned across pages. A cursor
+    resumes from the index position where the previous page stopped, so
+    deep pages cost the same as the first.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="q must not be empty")
+    file_type_filter = [ft.strip() for ft in filetypes.split(',') if ft.strip()] if filetypes else []
+    repositories = [repo] if repo else None
+    fingerprint = query_fingerprint(q, file_type_filter, repo, regex)
+    position = decode_cursor(cursor, fingerprint) if cursor else None
+    
+    try:
+        terms, matcher, plan = build_highlighter(q, regex)
+        request = search_request(q, file_type_filter, repositories, regex, limit, SEARCH_DEADLINE)
+        page = await backend.page(request, position)
+    except (RegexError, InvalidPosition) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except CursorExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except BackendError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    
+    return {
+        "results": [api_result(score, indexed, terms, matcher, plan) for score, indexed in page.hits],
+        "next_cursor": encode_cursor(fingerprint, page.position) if page.position is not None else None,
+        "partial": page.truncated,
+    }
+
+@app.get("/search/cache")
+async def search_cache_stats():
+    """Report result cache statistics"""
+    return result_cache.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,166 @@
+import threading
+import weakref
+from array import array
+from typing import Dict, List, Tuple
+
+from query_plan import QUERY_TOKEN
+from search_index import CodeIndex, Segment, fold, is_vocabulary_word, tokenize
+
+MAX_SUGGESTIONS = 5
+
+
+def max_edits(word: bytes) -> int:
+    """Edit distance tolerated for a word: one typo for short words, two otherwise"""
+    return 1 if len(word) <= 5 else 2
+
+
+def edit_distance(a: bytes, b: bytes, limit: int) -> int:
+    """Levenshtein distance counting adjacent transpositions as one edit
+
+    Gives up as soon as every alignment costs more than limit and returns
+    limit + 1, so scoring a candidate that is far off stays cheap.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        best = i
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            value = min(row[j] + 1, current[j - 1] + 1, row[j - 1] + cost)
+            if (previous is not None and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                value = min(value, previous[j - 2] + 1)
+            current[j] = value
+            best = min(best, value)
+        if best > limit:
+            return limit + 1
+        previous, row = row, current
+    return row[-1]
+
+
+def word_grams(word: bytes) -> set:
+    """Trigrams of a word padded on both ends, so short words still have several"""
+    padded = b'$' + word + b'$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SegmentVocabulary:
+    """Trigram index over the words of one segment, for finding near spellings
+
+    A word within k edits of the query shares at least len - 3k of its padded
+    trigrams, so only words passing that count are compared by edit distance.
+    """
+
+    def __init__(self, segment: Segment):
+        self.words: List[bytes] = []
+        self.dfs = array('I')
+        self.grams: Dict[bytes, array] = {}
+        for word, df in segment.vocabulary():
+            word_id = len(self.words)
+            self.words.append(word)
+            self.dfs.append(df)
+            for gram in word_grams(word):
+                postings = self.grams.get(gram)
+                if postings is None:
+                    postings = self.grams[gram] = array('I')
+                postings.append(word_id)
+
+    def similar(self, word: bytes, limit: int) -> List[Tuple[bytes, int, int]]:
+        """Return (word, distance, document frequency) for words within limit edits"""
+        grams = word_grams(word)
+        required = max(1, len(word) - 3 * limit)
+        counts: Dict[int, int] = {}
+        for gram in grams:
+            for word_id in self.grams.get(gram, ()):
+                counts[word_id] = counts.get(word_id, 0) + 1
+
+        similar = []
+        for word_id, count in counts.items():
+            if count < required:
+                continue
+            candidate = self.words[word_id]
+            distance = edit_distance(word, candidate, limit)
+            if 0 < distance <= limit:
+                similar.append((candidate, distance, self.dfs[word_id]))
+        return similar
+
+
+_vocabularies: "weakref.WeakKeyDictionary[Segment, SegmentVocabulary]" = weakref.WeakKeyDictionary()
+_vocabularies_lock = threading.Lock()
+
+
+def segment_vocabulary(segment: Segment) -> SegmentVocabulary:
+    """Return the vocabulary of a segment, built on first use and kept while it lives"""
+    with _vocabularies_lock:
+        vocabulary = _vocabularies.get(segment)
+        if vocabulary is None:
+            vocabulary = _vocabularies[segment] = SegmentVocabulary(segment)
+        return vocabulary
+
+
+def correctable(term: str) -> bool:
+    """Whether a query term is a single identifier that spelling correction applies to"""
+    folded = fold(term)
+    return is_vocabulary_word(folded) and tokenize(folded) == [folded]
+
+
+def suggest(index: CodeIndex, terms: List[str], limit: int = MAX_SUGGESTIONS) -> Dict[str, List[str]]:
+    """Return likely intended spellings for the terms that appear in no document
+
+    Candidates are ranked by edit distance, then by how many documents use
+    them; terms the index already knows get no entry.
+    """
+    corrections: Dict[str, List[str]] = {}
+    for term in dict.fromkeys(terms):
+        if not correctable(term):
+            continue
+        word = fold(term)
+        if index.document_frequency(word):
+            continue
+        edits = max_edits(word)
+        found: Dict[bytes, Tuple[int, int]] = {}
+        for segment in index.segments:
+            for candidate, distance, df in segment_vocabulary(segment).similar(word, edits):
+                best, total = found.get(candidate, (distance, 0))
+                found[candidate] = (min(best, distance), total + df)
+        ranked = sorted(found, key=lambda w: (found[w][0], -found[w][1], w))[:limit]
+        if ranked:
+            corrections[term] = [candidate.decode('utf-8', 'replace') for candidate in ranked]
+    return corrections
+
+
+def _rewrite(q: str, replace) -> str:
+    parts = []
+    pos = 0
+    for match in QUERY_TOKEN.finditer(q):
+        token = match.group()
+        parts.append(q[pos:match.start()])
+        pos = match.end()
+        parts.append(replace(token))
+    parts.append(q[pos:])
+    return ''.join(parts)
+
+
+def _plain_term(token: str) -> bool:
+    return not token.startswith(('"', '-')) and ':' not in token and token != 'OR'
+
+
+def expand_query(q: str, corrections: Dict[str, List[str]]) -> str:
+    """Rewrite a query so every corrected term also matches its suggested spellings"""
+    def replace(token: str) -> str:
+        if _plain_term(token) and corrections.get(token):
+            return ' OR '.join([token] + corrections[token])
+        return token
+    return _rewrite(q, replace)
+
+
+def corrected_query(q: str, corrections: Dict[str, List[str]]) -> str:
+    """Rewrite a query with the best suggestion in place of every corrected term"""
+    def replace(token: str) -> str:
+        if _plain_term(token) and corrections.get(token):
+            return corrections[token][0]
+        return token
+    return _rewrite(q, replace)
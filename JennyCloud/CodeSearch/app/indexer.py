@@ -0,0 +1,399 @@
+import argparse
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from math import log
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from search_index import CodeIndex, MemorySegment, Segment
+from segment_store import DiskSegment, manifest_path, open_index, write_manifest, write_segment
+
+# Kept with the user's data rather than in the source tree; CODESEARCH_INDEX_DIR overrides it
+DATA_HOME = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+DEFAULT_INDEX_DIR = os.path.join(DATA_HOME, "jennycloud", "codesearch", "index")
+LOCK_FILE = 'index.lock'
+MAX_FILE_SIZE = 1024 * 1024
+# Unreferenced segment files are kept around this long for workers that
+# have not picked up the latest manifest yet
+GARBAGE_GRACE_SECONDS = 60
+
+
+def file_type_for(path: str) -> str:
+    """Derive the file type filter value from a path"""
+    return Path(path).suffix.lstrip('.').lower() or 'text'
+
+
+def read_source_tree(root: str) -> Iterator[Dict[str, str]]:
+    """Yield indexable text files below a directory"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != 'node_modules']
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if os.path.getsize(full_path) > MAX_FILE_SIZE:
+                continue
+            try:
+                with open(full_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except (UnicodeDecodeError, OSError):
+                continue
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            yield {"path": path, "type": file_type_for(path), "content": content}
+
+
+class IndexBatch:
+    """File changes that are committed together as one new segment"""
+
+    def __init__(self, base: CodeIndex):
+        self.base = base
+        self.segment = MemorySegment()
+        self.repositories = [dict(repo) for repo in base.repositories]
+        self.tombstones: Dict[str, Set[int]] = dict(base.tombstones)
+        # A copy: the base snapshot keeps serving searches until the batch commits
+        self.locations = dict(base.locations())
+        self.changed = False
+        self._segments = {segment.name: segment for segment in base.segments}
+        self._segments[self.segment.name] = self.segment
+        self._copied: Set[str] = set()
+
+    def _tombstone(self, name: str, doc_id: int):
+        # Tombstone sets are shared with the base snapshot until first written
+        if name not in self._copied:
+            self.tombstones[name] = set(self.tombstones.get(name, ()))
+            self._copied.add(name)
+        self.tombstones[name].add(doc_id)
+        self.changed = True
+
+    def _repository_files(self, name: str) -> List[Tuple[str, int]]:
+        """Return the live (segment name, doc id) pairs of a repository"""
+        found = []
+        for segment in self._segments.values():
+            deleted = self.tombstones.get(segment.name, ())
+            found.extend((segment.name, doc_id) for doc_id in segment.filter_ids('repo', name)
+                         if doc_id not in deleted)
+        return found
+
+    def set_repository(self, name: str, description: Optional[str] = None):
+        """Register a repository or update its description"""
+        for repo in self.repositories:
+            if repo['name'] == name:
+                if description is not None and repo['description'] != description:
+                    repo['description'] = description
+                    self.changed = True
+                return
+        self.repositories.append({"name": name, "description": description or ""})
+        self.changed = True
+
+    def upsert_file(self, repository: str, path: str, file_type: str, content: str) -> bool:
+        """Add or replace a file, returning False when it is unchanged"""
+        key = (repository, path)
+        location = self.locations.get(key)
+        if location is not None:
+            existing = self._segments[location[0]].file(location[1])
+            if existing.file_type == file_type and existing.content == content:
+                return False
+            self._tombstone(*location)
+
+        self.set_repository(repository)
+        indexed = self.segment.add_file(repository, path, file_type, content)
+        self.locations[key] = (self.segment.name, indexed.doc_id)
+        self.changed = True
+        return True
+
+    def delete_file(self, repository: str, path: str) -> bool:
+        """Tombstone a file, returning False when it is not indexed"""
+        location = self.locations.pop((repository, path), None)
+        if location is None:
+            return False
+        self._tombstone(*location)
+        return True
+
+    def sync_repository(self, name: str, files: Iterable[Dict[str, str]],
+                        description: Optional[str] = None, replace: bool = True) -> Dict[str, int]:
+        """Bring a repository in line with files, touching only what changed"""
+        self.set_repository(name, description)
+        stale = {self._segments[seg].file_key(doc_id)[1] for seg, doc_id in self._repository_files(name)}
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        for file_data in files:
+            path = file_data['path']
+            existed = path in stale
+            stale.discard(path)
+            file_type = file_data.get('type') or file_type_for(path)
+            if not self.upsert_file(name, path, file_type, file_data['content']):
+                stats["unchanged"] += 1
+            else:
+                stats["updated" if existed else "added"] += 1
+        if replace:
+            for path in stale:
+                stats["deleted"] += self.delete_file(name, path)
+        return stats
+
+    def delete_repository(self, name: str) -> int:
+        """Tombstone every file of a repository and unregister it"""
+        removed = 0
+        for seg, doc_id in self._repository_files(name):
+            self.locations.pop(self._segments[seg].file_key(doc_id), None)
+            self._tombstone(seg, doc_id)
+            removed += 1
+        repositories = [repo for repo in self.repositories if repo['name'] != name]
+        if len(repositories) != len(self.repositories):
+            self.repositories = repositories
+            self.changed = True
+        return removed
+
+
+class Indexer:
+    """Incremental writer for an index directory and holder of its live snapshot"""
+
+    def __init__(self, directory: str, merge_factor: int = 8):
+        self.directory = directory
+        self.merge_factor = merge_factor
+        os.makedirs(directory, exist_ok=True)
+        self.index = CodeIndex()
+        self._cache: Dict[str, DiskSegment] = {}
+        self._manifest_stamp = None
+        self._write_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.refresh()
+
+    def exists(self) -> bool:
+        return os.path.exists(manifest_path(self.directory))
+
+    def _stamp(self):
+        try:
+            stat = os.stat(manifest_path(self.directory))
+        except FileNotFoundError:
+            return None
+        # The manifest is replaced atomically, so a new inode means a new commit
+        return stat.st_ino, stat.st_mtime_ns
+
+    def refresh(self) -> CodeIndex:
+        """Return the live snapshot, reloading it if another process committed"""
+        stamp = self._stamp()
+        if stamp is None or stamp == self._manifest_stamp:
+            return self.index
+        with self._refresh_lock:
+            stamp = self._stamp()
+            if stamp != self._manifest_stamp:
+                for attempt in range(3):
+                    try:
+                        index = open_index(self.directory, self._cache)
+                        break
+                    except FileNotFoundError:
+                        # Raced with a merge; the manifest has moved on already
+                        stamp = self._stamp()
+                else:
+                    return self.index
+                self._publish(index, stamp)
+        return self.index
+
+    def _publish(self, index: CodeIndex, stamp):
+        names = {segment.name for segment in index.segments}
+        for name in list(self._cache):
+            if name not in names:
+                del self._cache[name]
+        self._manifest_stamp = stamp
+        self.index = index
+
+    @contextmanager
+    def _locked(self):
+        """Serialize writers within this process and across processes"""
+        with self._write_lock:
+            with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def batch(self) -> Iterator[IndexBatch]:
+        """Collect changes and commit them as a single new segment"""
+        with self._locked():
+            base = self.refresh()
+            batch = IndexBatch(base)
+            yield batch
+            if batch.changed:
+                self._commit(batch)
+
+    def _commit(self, batch: IndexBatch):
+        segments = list(batch.base.segments)
+        if batch.segment.num_files:
+            path = os.path.join(self.directory, batch.segment.name)
+            write_segment(batch.segment, path)
+            segments.append(DiskSegment(path))
+
+        tombstones = {name: ids for name, ids in batch.tombstones.items() if ids}
+        # Segments whose every file is deleted drop out of the snapshot
+        segments = [s for s in segments if len(tombstones.get(s.name, ())) < s.num_files]
+        names = {segment.name for segment in segments}
+        tombstones = {name: ids for name, ids in tombstones.items() if name in names}
+
+        index = CodeIndex(segments, batch.repositories, tombstones, batch.base.generation + 1)
+        index._locations = batch.locations
+        self._write(index)
+        self._collect_garbage()
+
+    def _write(self, index: CodeIndex):
+        write_manifest(index, self.directory)
+        with self._refresh_lock:
+            for segment in index.segments:
+                if isinstance(segment, DiskSegment):
+                    self._cache[segment.name] = segment
+            self._publish(index, self._stamp())
+
+    def merge_candidates(self, index: CodeIndex) -> List[Segment]:
+        """Pick segments of the smallest over-full size tier, plus mostly deleted ones"""
+        tiers: Dict[int, List[Segment]] = {}
+        expunge = []
+        for segment in index.segments:
+            live = segment.num_files - len(index.tombstones.get(segment.name, ()))
+            if live * 2 < segment.num_files:
+                expunge.append(segment)
+                continue
+            tier = int(log(max(live, 1), self.merge_factor))
+            tiers.setdefault(tier, []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier] + expunge
+        return expunge
+
+    def merge(self) -> bool:
+        """Merge one group of segments into a larger one, returning False if there was none"""
+        index = self.refresh()
+        group = self.merge_candidates(index)
+        if not group:
+            return False
+
+        # Rewriting happens outside the lock; writers keep committing meanwhile
+        merged = MemorySegment()
+        id_map: Dict[Tuple[str, int], int] = {}
+        for segment in group:
+            deleted = index.tombstones.get(segment.name, ())
+            for doc_id in range(segment.num_files):
+                if doc_id in deleted:
+                    continue
+                indexed = segment.file(doc_id)
+                new_file = merged.add_file(indexed.repository, indexed.path, indexed.file_type, indexed.content)
+                id_map[(segment.name, doc_id)] = new_file.doc_id
+        merged_path = os.path.join(self.directory, merged.name)
+        if merged.num_files:
+            write_segment(merged, merged_path)
+
+        with self._locked():
+            current = self.refresh()
+            group_names = {segment.name for segment in group}
+            if not group_names <= {segment.name for segment in current.segments}:
+                if merged.num_files:
+                    os.remove(merged_path)
+                return False
+
+            # Carry over deletes that were committed while the merge ran
+            merged_deleted = set()
+            for name in group_names:
+                for doc_id in current.tombstones.get(name, ()):
+                    if (name, doc_id) in id_map:
+                        merged_deleted.add(id_map[(name, doc_id)])
+
+            segments = []
+            for segment in current.segments:
+                if segment.name not in group_names:
+                    segments.append(segment)
+                elif merged.num_files and segment.name == group[0].name:
+                    segments.append(DiskSegment(merged_path))
+            tombstones = {name: ids for name, ids in current.tombstones.items() if name not in group_names}
+            if merged_deleted:
+                tombstones[merged.name] = merged_deleted
+
+            index = CodeIndex(segments, current.repositories, tombstones, current.generation + 1)
+            if current._locations is not None:
+                locations = dict(current._locations)
+                for key, location in locations.items():
+                    if location[0] in group_names:
+                        locations[key] = (merged.name, id_map[location])
+                index._locations = locations
+            self._write(index)
+            self._collect_garbage()
+        return True
+
+    def merge_all(self) -> int:
+        """Merge until no tier is over-full, returning the number of merges"""
+        merges = 0
+        while self.merge():
+            merges += 1
+        return merges
+
+    def _collect_garbage(self):
+        live = {segment.name for segment in self.index.segments}
+        cutoff = time.time() - GARBAGE_GRACE_SECONDS
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('segment-') and entry.name not in live:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Manage the CodeSearch index")
+    parser.add_argument('--index', default=os.environ.get("CODESEARCH_INDEX_DIR", DEFAULT_INDEX_DIR),
+                        help="Index directory")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_repo = commands.add_parser('add-repo', help="Add or update a repository from a directory")
+    add_repo.add_argument('name')
+    add_repo.add_argument('source')
+    add_repo.add_argument('--description')
+    add_repo.add_argument('--keep-missing', action='store_true',
+                          help="Do not delete indexed files missing from the directory")
+
+    add_file = commands.add_parser('add-file', help="Add or update a single file")
+    add_file.add_argument('repository')
+    add_file.add_argument('path')
+    add_file.add_argument('source', help="Local file holding the content")
+    add_file.add_argument('--type')
+
+    delete_file = commands.add_parser('delete-file', help="Delete a single file")
+    delete_file.add_argument('repository')
+    delete_file.add_argument('path')
+
+    delete_repo = commands.add_parser('delete-repo', help="Delete a repository")
+    delete_repo.add_argument('name')
+
+    commands.add_parser('merge', help="Merge small segments")
+    commands.add_parser('status', help="Show index statistics")
+
+    args = parser.parse_args(argv)
+    indexer = Indexer(args.index)
+
+    if args.command == 'add-repo':
+        with indexer.batch() as batch:
+            stats = batch.sync_repository(args.name, read_source_tree(args.source),
+                                          args.description, replace=not args.keep_missing)
+        print(f"{args.name}: " + ", ".join(f"{count} {kind}" for kind, count in stats.items()))
+    elif args.command == 'add-file':
+        with open(args.source, 'r', encoding='utf-8') as f:
+            content = f.read()
+        with indexer.batch() as batch:
+            changed = batch.upsert_file(args.repository, args.path, args.type or file_type_for(args.path), content)
+        print("indexed" if changed else "unchanged")
+    elif args.command == 'delete-file':
+        with indexer.batch() as batch:
+            deleted = batch.delete_file(args.repository, args.path)
+        print("deleted" if deleted else "not found")
+    elif args.command == 'delete-repo':
+        with indexer.batch() as batch:
+            removed = batch.delete_repository(args.name)
+        print(f"deleted {removed} files")
+    elif args.command == 'merge':
+        print(f"{indexer.merge_all()} merges")
+
+    if args.command != 'merge':
+        indexer.merge_all()
+    index = indexer.refresh()
+    print(f"generation {index.generation}: {len(index.segments)} segments, "
+          f"{index.num_files} files, {len(index.repositories)} repositories")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from array import array
+from bisect import bisect_left
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+from query_plan import CompiledPlan, match_plan, plan_candidates
+from ranking import term_weights
+from regex_search import CompiledRegex, scan_regex
+from result_cache import ResultCache
+from search_index import CodeIndex, ScanBudget, Segment
+
+CompiledQuery = Union[CompiledPlan, CompiledRegex]
+# Where a page starts: the segment name and the first doc id to examine
+Position = Tuple[str, int]
+
+
+def segment_candidates(segment: Segment, query: CompiledQuery, repositories: Optional[List[str]],
+                       file_types: Optional[List[str]]) -> List[int]:
+    if isinstance(query, CompiledPlan):
+        return plan_candidates(segment, query)
+    return segment.candidates(query.plan, repositories, file_types)
+
+
+class PageCandidates:
+    """Candidate ids of one paged query, looked up once per segment
+
+    A request reuses the ids of a segment for its weights and its matches.
+    With a cache, later pages of the same query reuse them too, for as long
+    as the index generation they were found in is current.
+    """
+
+    def __init__(self, index: CodeIndex, query: CompiledQuery, repositories: Optional[List[str]],
+                 file_types: Optional[List[str]], cache: Optional[ResultCache] = None, key: Hashable = None):
+        self.index = index
+        self.query = query
+        self.repositories = repositories
+        self.file_types = file_types
+        self.cache = cache
+        self.key = key
+        self._segments: Dict[str, Sequence[int]] = {}
+
+    def __call__(self, segment: Segment) -> Sequence[int]:
+        ids = self._segments.get(segment.name)
+        if ids is not None:
+            return ids
+        cache_key = (self.key, segment.name)
+        if self.cache is not None:
+            ids = self.cache.get(cache_key, self.index.generation)
+        if ids is None:
+            # Packed, so the cache accounts for the ids themselves and not just the list
+            ids = array('q', segment_candidates(segment, self.query, self.repositories, self.file_types))
+            if self.cache is not None:
+                self.cache.put(cache_key, self.index.generation, ids)
+        self._segments[segment.name] = ids
+        return ids
+
+
+def page_weights(candidates: PageCandidates) -> List[float]:
+    """Term weights of a paged query, fixed on its first page so scores agree across pages"""
+    index = candidates.index
+    total = sum(len(candidates(segment)) for segment in index.segments)
+    return term_weights(index, candidates.query.terms, total)
+
+
+def page_matches(candidates: PageCandidates, start: Optional[Position], weights: List[float],
+                 limit: int, budget: ScanBudget) -> Tuple[List[Tuple[float, Segment, int]], Optional[Position], bool]:
+    """Collect up to limit matches in index order, resuming at a position
+
+    Candidates are taken one segment at a time, from the start segment on,
+    and the ids before the start are skipped by bisection; with cached
+    candidates a page costs the same however deep it is. Returns the
+    matches, the position of the next page (None once the index is
+    exhausted) and whether the page is partial: cut short by the budget, or
+    with lines too long to search in full. Raises KeyError when the start
+    segment is gone.
+    """
+    index, query = candidates.index, candidates.query
+    names = [segment.name for segment in index.segments]
+    if start is not None and start[0] not in names:
+        raise KeyError(start[0])
+    first = names.index(start[0]) if start is not None else 0
+    average_length = index.average_length
+    hits: List[Tuple[float, Segment, int]] = []
+
+    for segment in index.segments[first:]:
+        ids = candidates(segment)
+        if start is not None and segment.name == start[0]:
+            ids = ids[bisect_left(ids, start[1]):]
+        if not ids:
+            continue
+        deleted = index.tombstones.get(segment.name, frozenset())
+        # The id being examined when the budget runs out is where the next page starts
+        current = [ids[0]]
+
+        def tracked():
+            for doc_id in ids:
+                current[0] = doc_id
+                yield doc_id
+
+        if isinstance(query, CompiledPlan):
+            scan = match_plan(query, segment, tracked(), deleted, weights, average_length, budget)
+        else:
+            scan = scan_regex(query, segment, tracked(), deleted, weights, average_length, budget)
+        while True:
+            try:
+                score, doc_id = next(scan)
+            except StopIteration as stop:
+                if stop.value:
+                    return hits, (segment.name, current[0]), True
+                break
+            hits.append((score, segment, doc_id))
+            if len(hits) >= limit:
+                return hits, (segment.name, doc_id + 1), budget.clipped
+    return hits, None, budget.clipped
@@ -0,0 +1,170 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from query_plan import CompiledPlan, match_plan, plan_candidates
+from ranking import TopK, term_weights
+from regex_search import CompiledRegex, scan_regex
+from search_index import CodeIndex, IndexedFile, ScanBudget, Segment
+from segment_store import DiskSegment
+
+# Candidates verified per task; large segments are split into several shards
+SHARD_SIZE = 20000
+# Below this many candidates a pool round trip costs more than it saves
+MIN_PARALLEL_CANDIDATES = 2000
+
+CompiledQuery = Union[CompiledPlan, CompiledRegex]
+
+# Per worker process: the index directory and the segments mapped so far
+_directory: Optional[str] = None
+_segments: Dict[str, DiskSegment] = {}
+
+
+def _init_worker(directory: str):
+    global _directory
+    _directory = directory
+
+
+def _open_segment(name: str, live: Sequence[str]) -> DiskSegment:
+    segment = _segments.get(name)
+    if segment is None:
+        # Segments merged away since the last task are unmapped first
+        for stale in set(_segments) - set(live):
+            del _segments[stale]
+        segment = _segments[name] = DiskSegment(os.path.join(_directory, name))
+    return segment
+
+
+def scan_shard(query: CompiledQuery, segment: Segment, ids: Iterable[int], weights: List[float],
+               average_length: float, k: int, budget: ScanBudget) -> Tuple[int, List[Tuple[float, int]], bool]:
+    """Verify one shard of live candidates and keep its k best
+
+    Returns the number of matching files, their best (score, doc_id) pairs
+    and whether they are partial, because the budget cut the scan short or
+    lines were too long to search in full.
+    """
+    if budget.exhausted:
+        return 0, [], True
+    if isinstance(query, CompiledRegex):
+        scan = scan_regex(query, segment, ids, frozenset(), weights, average_length, budget)
+    else:
+        scan = match_plan(query, segment, ids, frozenset(), weights, average_length, budget)
+    best = TopK(k)
+    while True:
+        try:
+            score, doc_id = next(scan)
+        except StopIteration as stop:
+            return best.total, [(score, doc_id) for score, _, doc_id in best.ranked()], bool(stop.value) or budget.clipped
+        best.push(score, segment, doc_id)
+
+
+def search_shard(query: CompiledQuery, segment_name: str, ids: array, weights: List[float],
+                 average_length: float, k: int, budget: ScanBudget,
+                 live: Sequence[str]) -> Tuple[int, List[Tuple[float, int]], bool]:
+    """Pool task: scan a shard of a segment mapped in this worker"""
+    return scan_shard(query, _open_segment(segment_name, live), ids, weights, average_length, k, budget)
+
+
+class ShardedSearcher:
+    """Fans queries out over shards of their candidates and merges the partial top-k lists
+
+    Candidates are gathered from the trigram postings in the calling
+    process, split per segment and per SHARD_SIZE files, and verified in a
+    pool of worker processes that map the same segment files. Shards still
+    running at the deadline are dropped and the results flagged as partial.
+    """
+
+    def __init__(self, directory: str, workers: Optional[int] = None, shard_size: int = SHARD_SIZE,
+                 min_parallel: int = MIN_PARALLEL_CANDIDATES):
+        self.directory = directory
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.shard_size = shard_size
+        self.min_parallel = min_parallel
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Spawned workers do not inherit the event loop or index locks
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.directory,),
+            )
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def shards(self, index: CodeIndex, query: CompiledQuery, repositories: Optional[List[str]],
+               file_types: Optional[List[str]]) -> List[Tuple[Segment, array]]:
+        """Split the live candidates of a query into (segment, doc ids) shards"""
+        shards = []
+        for segment in index.segments:
+            if isinstance(query, CompiledPlan):
+                ids = plan_candidates(segment, query)
+            else:
+                ids = segment.candidates(query.plan, repositories, file_types)
+            deleted = index.tombstones.get(segment.name)
+            if deleted:
+                ids = [doc_id for doc_id in ids if doc_id not in deleted]
+            for start in range(0, len(ids), self.shard_size):
+                shards.append((segment, array('I', ids[start:start + self.shard_size])))
+        return shards
+
+    async def top_k(self, index: CodeIndex, query: CompiledQuery, repositories: Optional[List[str]] = None,
+                    file_types: Optional[List[str]] = None, k: int = 20, timeout: float = 2.0,
+                    max_bytes: Optional[int] = None) -> Tuple[int, List[Tuple[float, IndexedFile]], bool]:
+        """Return the total matches, the k best (score, file) pairs and whether they are partial"""
+        budget = ScanBudget(timeout, max_bytes)
+        shards = await asyncio.to_thread(self.shards, index, query, repositories, file_types)
+        candidates = sum(len(ids) for _, ids in shards)
+        weights = term_weights(index, query.terms, candidates)
+        average_length = index.average_length
+
+        parallel = (self.workers > 1 and len(shards) > 1 and candidates >= self.min_parallel
+                    and all(isinstance(segment, DiskSegment) for segment, _ in shards))
+        if not parallel:
+            return await asyncio.to_thread(self._top_k_inline, shards, query, weights, average_length, k, budget)
+
+        # Every shard gets the full deadline and an even share of the bytes
+        shard_budget = ScanBudget(max_bytes=max_bytes // len(shards) if max_bytes is not None else None)
+        shard_budget.deadline = budget.deadline
+        live = [segment.name for segment in index.segments]
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.pool, search_shard, query, segment.name, ids,
+                                        weights, average_length, k, shard_budget, live)
+                   for segment, ids in shards]
+        done, pending = await asyncio.wait(futures, timeout=max(0.0, budget.deadline - time.time()))
+        for future in pending:
+            future.cancel()
+
+        best = TopK(k)
+        truncated = bool(pending)
+        # Merging in shard order keeps ties in index order, as in a serial scan
+        for (segment, _), future in zip(shards, futures):
+            if future in done:
+                total, scored, cut = future.result()
+                best.merge(total, ((score, segment, doc_id) for score, doc_id in scored))
+                truncated = truncated or cut
+        return best.total, best.results(), truncated
+
+    @staticmethod
+    def _top_k_inline(shards: List[Tuple[Segment, array]], query: CompiledQuery, weights: List[float],
+                      average_length: float, k: int,
+                      budget: ScanBudget) -> Tuple[int, List[Tuple[float, IndexedFile]], bool]:
+        best = TopK(k)
+        truncated = False
+        for segment, ids in shards:
+            total, scored, partial = scan_shard(query, segment, ids, weights, average_length, k, budget)
+            best.merge(total, ((score, segment, doc_id) for score, doc_id in scored))
+            # Shards after the budget ran out return at once, flagged as partial
+            truncated = truncated or partial
+        return best.total, best.results(), truncated
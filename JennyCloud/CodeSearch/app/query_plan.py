@@ -0,0 +1,380 @@
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, Generator, Iterable, Iterator, List, Optional, Set, Tuple
+
+from ranking import PATH_BOOST, TopK, bm25, term_weights
+from regex_search import MAX_LINE_LENGTH
+from search_index import CodeIndex, IndexedFile, ScanBudget, Segment, TrigramQuery, fold, tokenize
+from symbols import CLASS_KINDS, FUNCTION_KINDS
+
+LANGUAGE_MAP = {
+    '.js': 'javascript',
+    '.ts': 'typescript',
+    '.py': 'python',
+    '.html': 'html',
+    '.css': 'css',
+    '.json': 'json',
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.sql': 'sql',
+    '.sh': 'bash',
+    '.md': 'markdown'
+}
+
+# field:value operators; file: is accepted as an alias of path:
+FILTER_FIELDS = {'repo': 'repositories', 'lang': 'languages', 'path': 'paths', 'file': 'paths'}
+# Symbol operators answered from the definition index: (prefix match, allowed kinds)
+SYMBOL_OPERATORS = {
+    'def': (False, None),
+    'sym': (True, None),
+    'class': (False, CLASS_KINDS),
+    'function': (False, FUNCTION_KINDS),
+}
+QUERY_TOKEN = re.compile(r'(-?)(?:(\w+):)?(?:"([^"]*)"?|(\S+))')
+# How many candidates are verified between two deadline checks
+FILES_PER_CHECK = 64
+
+
+def language_types(language: str) -> List[str]:
+    """Return the file types of a language name, or the value itself as a type"""
+    language = language.lower()
+    types = [ext.lstrip('.') for ext, name in LANGUAGE_MAP.items() if name == language]
+    return types or [language.lstrip('.')]
+
+
+@dataclass
+class QueryPlan:
+    """Parsed search query: AND of OR-clauses, exclusions and metadata filters"""
+    clauses: List[List[str]] = field(default_factory=list)
+    excluded: List[str] = field(default_factory=list)
+    repositories: List[str] = field(default_factory=list)
+    languages: List[str] = field(default_factory=list)
+    paths: List[str] = field(default_factory=list)
+    excluded_repositories: List[str] = field(default_factory=list)
+    excluded_languages: List[str] = field(default_factory=list)
+    excluded_paths: List[str] = field(default_factory=list)
+    symbols: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def terms(self) -> List[str]:
+        """Every positive term and symbol name, in query order"""
+        names = (name for _, name in self.symbols)
+        return list(dict.fromkeys([term for clause in self.clauses for term in clause] + list(names)))
+
+    @property
+    def file_types(self) -> List[str]:
+        return [t for language in self.languages for t in language_types(language)]
+
+    @property
+    def excluded_types(self) -> List[str]:
+        return [t for language in self.excluded_languages for t in language_types(language)]
+
+    def trigram_query(self) -> TrigramQuery:
+        clauses = tuple(TrigramQuery('or', children=tuple(TrigramQuery.literal(term) for term in clause))
+                        for clause in self.clauses)
+        return TrigramQuery('and', children=tuple(c for c in clauses if not c.matches_all))
+
+
+def parse_query(query: str) -> QueryPlan:
+    """Parse terms, "quoted phrases", OR, NOT/-term and repo:/lang:/path: operators
+
+    Adjacent terms are ANDed; OR binds tighter, so `a b OR c` means a AND (b OR c).
+    """
+    plan = QueryPlan()
+    negate_next = False
+    or_next = False
+    for match in QUERY_TOKEN.finditer(query):
+        dash, name, quoted, bare = match.groups()
+        value = quoted if quoted is not None else bare
+        if quoted is None and not name and not dash:
+            if value == 'OR':
+                or_next = bool(plan.clauses)
+                continue
+            if value == 'AND':
+                continue
+            if value == 'NOT':
+                negate_next = True
+                continue
+        negate = bool(dash) or negate_next
+        negate_next = False
+
+        if name and name.lower() in SYMBOL_OPERATORS:
+            # Definitions cannot be excluded; a negated operator is dropped
+            if value and not negate:
+                plan.symbols.append((name.lower(), value))
+            or_next = False
+            continue
+
+        if name and name.lower() in FILTER_FIELDS:
+            target = FILTER_FIELDS[name.lower()]
+            if value:
+                getattr(plan, ('excluded_' + target) if negate else target).append(value)
+            or_next = False
+            continue
+
+        term = f'{name}:{value}' if name else value
+        if not term:
+            continue
+        if negate:
+            plan.excluded.append(term)
+        elif or_next:
+            plan.clauses[-1].append(term)
+        else:
+            plan.clauses.append([term])
+        or_next = False
+    return plan
+
+
+def _fold_char(ch: str) -> str:
+    # Keep positions aligned with the original text when lowering would
+    # expand a character
+    lowered = ch.lower()
+    return lowered if len(lowered) == 1 else ch
+
+
+class AhoCorasick:
+    """Case-insensitive multi-pattern matcher, built once per query and reused per line"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        for pattern in dict.fromkeys(''.join(map(_fold_char, p)) for p in patterns if p):
+            node = 0
+            for ch in pattern:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = self._goto[node][ch] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = nxt
+            self._out[node].append(len(pattern))
+
+        # Breadth-first failure links; outputs inherit those of their fallback
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(ch, 0)
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    @property
+    def empty(self) -> bool:
+        return len(self._goto) == 1
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        """Return leftmost-longest, non-overlapping (start, end) matches in one pass"""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        node = 0
+        for i, ch in enumerate(text):
+            ch = _fold_char(ch)
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length in out[node]:
+                found.append((i - length + 1, i + 1))
+        return _non_overlapping(found)
+
+
+class RegexMatcher:
+    """Span provider with the same interface as AhoCorasick for regex queries"""
+
+    def __init__(self, pattern: re.Pattern):
+        self.pattern = pattern
+        self.empty = False
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        # Bounded like the scan, which is what the pattern was vetted for; the
+        # scan reports files whose long lines it could not search in full
+        return [m.span() for m in self.pattern.finditer(text, 0, MAX_LINE_LENGTH) if m.end() > m.start()]
+
+
+def _non_overlapping(spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    spans.sort(key=lambda span: (span[0], -span[1]))
+    selected = []
+    last_end = 0
+    for start, end in spans:
+        if start >= last_end:
+            selected.append((start, end))
+            last_end = end
+    return selected
+
+
+@dataclass
+class CompiledPlan:
+    """A query plan narrowed by the request filters and folded for matching"""
+    plan: TrigramQuery
+    terms: List[bytes]
+    repositories: Optional[List[str]]
+    file_types: Optional[List[str]]
+    clauses: List[List[bytes]]
+    excluded: List[bytes]
+    needles: List[bytes]
+    paths: List[bytes]
+    excluded_paths: List[bytes]
+    excluded_repositories: Set[str]
+    excluded_types: Set[str]
+    symbols: List[Tuple[bytes, bool, Optional[FrozenSet[int]]]] = field(default_factory=list)
+
+
+def compile_plan(plan: QueryPlan, repositories: Optional[List[str]] = None,
+                 file_types: Optional[List[str]] = None) -> Optional[CompiledPlan]:
+    """Fold a plan for matching, or return None when its filters exclude everything"""
+    # Operators narrow the request filters; an empty intersection matches nothing
+    if plan.repositories:
+        repositories = [r for r in plan.repositories if not repositories or r in repositories]
+        if not repositories:
+            return None
+    if plan.languages:
+        types = plan.file_types
+        file_types = [t for t in types if not file_types or t in file_types]
+        if not file_types:
+            return None
+
+    needles = [fold(term) for term in plan.terms]
+    return CompiledPlan(
+        plan=plan.trigram_query(),
+        terms=list(dict.fromkeys(token for needle in needles for token in tokenize(needle))) or needles,
+        repositories=repositories,
+        file_types=file_types,
+        clauses=[[fold(term) for term in clause] for clause in plan.clauses],
+        excluded=[fold(term) for term in plan.excluded],
+        needles=needles,
+        paths=[fold(path) for path in plan.paths],
+        excluded_paths=[fold(path) for path in plan.excluded_paths],
+        excluded_repositories=set(plan.excluded_repositories),
+        excluded_types=set(plan.excluded_types),
+        symbols=symbol_queries(plan),
+    )
+
+
+def symbol_queries(plan: QueryPlan) -> List[Tuple[bytes, bool, Optional[FrozenSet[int]]]]:
+    """Fold the symbol operators of a plan into (name, prefix, kinds) lookups"""
+    return [(fold(name),) + SYMBOL_OPERATORS[operator] for operator, name in plan.symbols]
+
+
+def symbol_matches(segment: Segment, symbols) -> Optional[Dict[int, List[int]]]:
+    """Map the files of a segment that define every queried symbol to the definition lines
+
+    Returns None when the plan has no symbol operators.
+    """
+    found: Optional[Dict[int, List[int]]] = None
+    for name, prefix, kinds in symbols:
+        lines: Dict[int, List[int]] = {}
+        for _, blob_id, line, kind in segment.find_symbols(name, prefix):
+            if kinds is None or kind in kinds:
+                lines.setdefault(blob_id, []).append(line)
+        if found is None:
+            found = lines
+        else:
+            found = {blob_id: found[blob_id] + lines[blob_id] for blob_id in lines if blob_id in found}
+    if found is None:
+        return None
+    # Symbols belong to blobs; every file stored as the blob defines them
+    return {doc_id: blob_lines for blob_id, blob_lines in found.items() for doc_id in segment.blob_docs(blob_id)}
+
+
+def plan_candidates(segment: Segment, compiled: CompiledPlan) -> List[int]:
+    """Candidate ids of a segment: symbol definitions first, then trigrams and filters"""
+    defined = symbol_matches(segment, compiled.symbols)
+    within = sorted(defined) if defined is not None else None
+    return segment.candidates(compiled.plan, compiled.repositories, compiled.file_types, within)
+
+
+def definition_lines(segment: Segment, doc_id: int, plan: QueryPlan) -> List[int]:
+    """0-based lines where a file defines the symbols a plan asks for"""
+    lines = set()
+    blob_id = segment.blob_id(doc_id)
+    for name, prefix, kinds in symbol_queries(plan):
+        for _, symbol_blob, line, kind in segment.find_symbols(name, prefix):
+            if symbol_blob == blob_id and (kinds is None or kind in kinds):
+                lines.add(line - 1)
+    return sorted(lines)
+
+
+def match_plan(compiled: CompiledPlan, segment: Segment, ids: Iterable[int], deleted: Set[int],
+               weights: List[float], average_length: float,
+               budget: Optional[ScanBudget] = None) -> Generator[Tuple[float, int], None, bool]:
+    """Verify and score candidate files of one segment, yielding (score, doc_id)
+
+    Content is verified and scored once per blob; further locations of the
+    same content only check their path filters. Returns whether the budget
+    cut the scan short.
+    """
+    clauses, excluded, terms = compiled.clauses, compiled.excluded, compiled.terms
+    # Content score of every blob verified so far, None when it did not match
+    scanned: Dict[int, Optional[float]] = {}
+    for checked, doc_id in enumerate(ids, 1):
+        if budget is not None and checked % FILES_PER_CHECK == 0 and budget.exhausted:
+            return True
+        if doc_id in deleted:
+            continue
+        repository, path = segment.file_key(doc_id)
+        folded_path = fold(path)
+        if any(p not in folded_path for p in compiled.paths) or any(p in folded_path for p in compiled.excluded_paths):
+            continue
+        if repository in compiled.excluded_repositories:
+            continue
+        if compiled.excluded_types and segment.file(doc_id).file_type in compiled.excluded_types:
+            continue
+
+        blob_id = segment.blob_id(doc_id)
+        if blob_id in scanned:
+            score = scanned[blob_id]
+        else:
+            score = None
+            if (all(any(segment.contains(doc_id, term) for term in clause) for clause in clauses)
+                    and not any(segment.contains(doc_id, term) for term in excluded)):
+                score = bm25(segment, doc_id, terms, weights, average_length) if terms else 0.0
+            scanned[blob_id] = score
+        if score is None:
+            continue
+        if any(needle in folded_path for needle in compiled.needles):
+            score *= PATH_BOOST
+        yield score, doc_id
+    return False
+
+
+def plan_matches(index: CodeIndex, plan: QueryPlan, repositories: Optional[List[str]] = None,
+                 file_types: Optional[List[str]] = None) -> Iterator[Tuple[float, Segment, int]]:
+    """Evaluate a query plan, yielding (score, segment, doc_id) as files match
+
+    Files come out in index order, so the first match is found without
+    verifying the rest of the candidates.
+    """
+    compiled = compile_plan(plan, repositories, file_types)
+    if compiled is not None:
+        yield from compiled_plan_matches(index, compiled)
+
+
+def compiled_plan_matches(index: CodeIndex, compiled: CompiledPlan) -> Iterator[Tuple[float, Segment, int]]:
+    """Evaluate a compiled plan over every segment of an index, in index order"""
+    candidates = [(segment, plan_candidates(segment, compiled))
+                  for segment in index.segments]
+    weights = term_weights(index, compiled.terms, sum(len(ids) for _, ids in candidates))
+    average_length = index.average_length
+
+    for segment, ids in candidates:
+        deleted = index.tombstones.get(segment.name, frozenset())
+        for score, doc_id in match_plan(compiled, segment, ids, deleted, weights, average_length):
+            yield score, segment, doc_id
+
+
+def plan_top_k(index: CodeIndex, plan: QueryPlan, repositories: Optional[List[str]] = None,
+               file_types: Optional[List[str]] = None, k: int = 20) -> Tuple[int, List[Tuple[float, IndexedFile]]]:
+    """Evaluate a query plan and keep the k best files by BM25 on a bounded heap
+
+    Returns the total number of matching files and the (score, file) pairs of
+    the best ones, highest score first.
+    """
+    best = TopK(k)
+    for score, segment, doc_id in plan_matches(index, plan, repositories, file_types):
+        best.push(score, segment, doc_id)
+    return best.total, best.results()
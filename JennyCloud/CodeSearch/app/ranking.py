@@ -0,0 +1,71 @@
+import heapq
+from math import log
+from typing import Iterable, List, Sequence, Tuple
+
+from search_index import CodeIndex, IndexedFile, Segment
+
+# Okapi BM25 parameters
+K1 = 1.2
+B = 0.75
+# Files whose path contains the query are usually what the user is after
+PATH_BOOST = 2.0
+
+
+def idf(total_files: int, df: int) -> float:
+    """BM25 inverse document frequency, always positive"""
+    return log(1 + (total_files - df + 0.5) / (df + 0.5))
+
+
+def term_weights(index: CodeIndex, terms: Sequence[bytes], estimated_df: int) -> List[float]:
+    """Return the IDF of every term from the stats stored in the index
+
+    Terms that are not whole tokens have no stored df; the trigram candidate
+    count is a tight upper bound for them.
+    """
+    total_blobs = index.total_blobs
+    return [idf(total_blobs, index.document_frequency(term) or estimated_df) for term in terms]
+
+
+def bm25(segment: Segment, doc_id: int, terms: Sequence[bytes], weights: Sequence[float],
+         average_length: float) -> float:
+    """Score a file against the query terms"""
+    norm = K1 * (1 - B + B * segment.doc_length(doc_id) / average_length)
+    score = 0.0
+    for term, weight in zip(terms, weights):
+        tf = segment.count(doc_id, term)
+        score += weight * tf * (K1 + 1) / (tf + norm)
+    return score
+
+
+class TopK:
+    """Bounded min-heap that keeps the k best scored files"""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.total = 0
+        self._heap = []
+
+    def push(self, score: float, segment: Segment, doc_id: int):
+        self.total += 1
+        # Earlier files win ties, which keeps the order stable between calls
+        item = (score, -self.total, segment, doc_id)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, item)
+
+    def merge(self, total: int, scored: Iterable[Tuple[float, Segment, int]]):
+        """Fold in the partial top-k list of a shard that matched total files"""
+        seen = self.total
+        for score, segment, doc_id in scored:
+            self.push(score, segment, doc_id)
+        self.total = seen + total
+
+    def ranked(self) -> List[Tuple[float, Segment, int]]:
+        """Return (score, segment, doc_id) triples, highest score first"""
+        ranked = sorted(self._heap, key=lambda item: item[:2], reverse=True)
+        return [(score, segment, doc_id) for score, _, segment, doc_id in ranked]
+
+    def results(self) -> List[Tuple[float, IndexedFile]]:
+        """Return (score, file) pairs, highest score first"""
+        return [(score, segment.file(doc_id)) for score, segment, doc_id in self.ranked()]
@@ -0,0 +1,370 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from math import log1p
+from typing import Dict, FrozenSet, Generator, Iterable, List, Optional, Set, Tuple
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+from ranking import TopK, bm25, term_weights
+from search_index import CodeIndex, IndexedFile, ScanBudget, Segment, TrigramQuery, extract_trigrams, fold, tokenize
+
+MAX_PATTERN_LENGTH = 512
+# Per-query budget: wall time and bytes of candidate content scanned
+REGEX_TIMEOUT = 2.0
+MAX_SCAN_BYTES = 64 * 1024 * 1024
+# How many lines are matched between two deadline checks
+LINES_PER_CHECK = 256
+# Characters of a line handed to the regex engine; longer lines are matched
+# on their start alone, so the engine's time per line stays bounded
+MAX_LINE_LENGTH = 4096
+# Lines long enough to check the deadline right after matching them
+LONG_LINE = 256
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+# Possessive repeats and atomic groups (3.11+) never backtrack into their body
+_POSSESSIVE = getattr(sre_constants, 'POSSESSIVE_REPEAT', None)
+_ATOMIC = getattr(sre_constants, 'ATOMIC_GROUP', None)
+_ASSERTS = (sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+
+# Characters the backtracking check tells character classes apart by
+_PROBES = frozenset(map(chr, range(1, 256))) | frozenset('\u0100\u0416\u0436\u4e2d\u0663\u2003\u200b')
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: re.compile(r'\d'),
+    sre_constants.CATEGORY_NOT_DIGIT: re.compile(r'\D'),
+    sre_constants.CATEGORY_SPACE: re.compile(r'\s'),
+    sre_constants.CATEGORY_NOT_SPACE: re.compile(r'\S'),
+    sre_constants.CATEGORY_WORD: re.compile(r'\w'),
+    sre_constants.CATEGORY_NOT_WORD: re.compile(r'\W'),
+}
+
+
+class RegexError(ValueError):
+    pass
+
+
+@dataclass
+class CompiledRegex:
+    pattern: re.Pattern
+    plan: TrigramQuery
+    terms: List[bytes]
+
+
+def _literal_runs(items, runs: List[str]) -> TrigramQuery:
+    """Build the trigram query a parsed pattern sequence requires
+
+    Consecutive literal characters form runs whose trigrams are all required;
+    groups, mandatory repeats and alternations contribute nested queries and
+    everything else just ends the current run.
+    """
+    run: List[str] = []
+    trigrams = set()
+    children = []
+
+    def flush():
+        if run:
+            text = ''.join(run)
+            runs.append(text)
+            trigrams.update(extract_trigrams(fold(text)))
+            run.clear()
+
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+        elif op is sre_constants.AT:
+            continue  # Anchors are zero-width and do not split a run
+        elif op is sre_constants.SUBPATTERN:
+            flush()
+            children.append(_literal_runs(av[-1], runs))
+        elif op is _ATOMIC:
+            flush()
+            children.append(_literal_runs(av, runs))
+        elif op in _REPEATS or op is _POSSESSIVE:
+            flush()
+            low, _, sub = av
+            if low >= 1:
+                children.append(_literal_runs(sub, runs))
+        elif op is sre_constants.BRANCH:
+            flush()
+            # Literals inside alternatives are not required, keep them out of runs
+            branches = tuple(_literal_runs(branch, []) for branch in av[1])
+            children.append(TrigramQuery('or', children=branches))
+        else:
+            flush()
+    flush()
+    children = tuple(child for child in children if not child.matches_all)
+    return TrigramQuery('and', frozenset(trigrams), children)
+
+
+def _folded(char: str) -> FrozenSet[str]:
+    # Patterns are compiled with IGNORECASE
+    return frozenset(ch for ch in _PROBES if ch.lower() == char.lower()) | {char}
+
+
+def _class_chars(items) -> FrozenSet[str]:
+    chars = set()
+    negate = False
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = True
+        elif op is sre_constants.LITERAL:
+            chars |= _folded(chr(av))
+        elif op is sre_constants.RANGE:
+            low, high = av
+            chars |= {ch for ch in _PROBES
+                      if any(len(case) == 1 and low <= ord(case) <= high for case in (ch, ch.lower(), ch.upper()))}
+            chars.add(chr(low))
+        elif op is sre_constants.CATEGORY and av in _CATEGORIES:
+            chars |= {ch for ch in _PROBES if _CATEGORIES[av].match(ch)}
+        else:
+            chars |= _PROBES
+    return _PROBES - chars if negate else frozenset(chars)
+
+
+def _char_set(op, av) -> Optional[FrozenSet[str]]:
+    """Characters a single-character item can match, None for anything else"""
+    if op is sre_constants.LITERAL:
+        return _folded(chr(av))
+    if op is sre_constants.NOT_LITERAL:
+        return _PROBES - _folded(chr(av))
+    if op is sre_constants.ANY:
+        return _PROBES
+    if op is sre_constants.IN:
+        return _class_chars(av)
+    return None
+
+
+def _chars(items) -> FrozenSet[str]:
+    """Every character some part of a pattern sequence can match"""
+    chars = frozenset()
+    for op, av in items:
+        single = _char_set(op, av)
+        if single is not None:
+            chars |= single
+        elif op is sre_constants.SUBPATTERN:
+            chars |= _chars(av[-1])
+        elif op is _ATOMIC:
+            chars |= _chars(av)
+        elif op in _REPEATS or op is _POSSESSIVE:
+            chars |= _chars(av[2])
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= _chars(branch)
+        elif op is sre_constants.GROUPREF:
+            chars |= _PROBES
+    return chars
+
+
+def _first(items) -> Tuple[FrozenSet[str], bool]:
+    """Characters a pattern sequence can start with, and whether it can match the empty string"""
+    first = frozenset()
+    for op, av in items:
+        single = _char_set(op, av)
+        if single is not None:
+            return first | single, False
+        if op is sre_constants.SUBPATTERN or op is _ATOMIC:
+            chars, nullable = _first(av[-1] if op is sre_constants.SUBPATTERN else av)
+        elif op in _REPEATS or op is _POSSESSIVE:
+            chars, nullable = _first(av[2])
+            nullable = nullable or av[0] == 0
+        elif op is sre_constants.BRANCH:
+            starts = [_first(branch) for branch in av[1]]
+            chars = frozenset().union(*(chars for chars, _ in starts))
+            nullable = any(nullable for _, nullable in starts)
+        elif op is sre_constants.GROUPREF:
+            chars, nullable = _PROBES, True
+        else:
+            continue  # Anchors and lookarounds are zero-width
+        first |= chars
+        if not nullable:
+            return first, False
+    return first, True
+
+
+def _check_repeated(items):
+    """Reject repeat bodies that can split the same text into iterations in more than one way
+
+    A body made of fixed-width parts, whose alternatives each start with
+    different characters, matches every iteration in a single way.
+    """
+    for op, av in items:
+        if op in _REPEATS or op is _POSSESSIVE:
+            low, high, sub = av
+            if low != high:
+                raise RegexError("Nested repetition like (a+)+ or (ab?)* is not supported")
+            _check_repeated(sub)
+        elif op is sre_constants.SUBPATTERN:
+            _check_repeated(av[-1])
+        elif op is _ATOMIC:
+            _check_repeated(av)
+        elif op is sre_constants.BRANCH:
+            seen = frozenset()
+            for branch in av[1]:
+                first, nullable = _first(branch)
+                if nullable or first & seen:
+                    raise RegexError("Alternatives under a repeat must start with different characters, "
+                                     "unlike (a|ab)*")
+                seen |= first
+                _check_repeated(branch)
+
+
+def _check_backtracking(items, open_chars: FrozenSet[str] = frozenset()) -> FrozenSet[str]:
+    """Reject patterns the backtracking engine can take polynomial or exponential time on
+
+    open_chars are the characters a preceding variable-length repeat may
+    still extend over. A second variable-length repeat able to match one of
+    them makes the split between the two ambiguous, as in \\w*\\w*, so it is
+    rejected; a character neither can match closes the run. Returns the open
+    characters at the end of the sequence.
+    """
+    for op, av in items:
+        single = _char_set(op, av)
+        if single is not None:
+            if not single & open_chars:
+                open_chars = frozenset()
+        elif op is sre_constants.SUBPATTERN:
+            open_chars = _check_backtracking(av[-1], open_chars)
+        elif op is _ATOMIC:
+            open_chars = _check_backtracking(av, open_chars)
+        elif op in _REPEATS or op is _POSSESSIVE:
+            low, high, sub = av
+            if high == sre_constants.MAXREPEAT:
+                _check_repeated(sub)
+            if low == high:
+                for _ in range(min(low, 2)):
+                    open_chars = _check_backtracking(sub, open_chars)
+                continue
+            chars = _chars(sub)
+            if chars & open_chars:
+                raise RegexError("Adjacent repeats that can match the same characters, like \\w*\\w*, "
+                                 "are not supported")
+            _check_backtracking(sub)
+            open_chars |= chars
+        elif op is sre_constants.BRANCH:
+            open_chars = frozenset().union(*(_check_backtracking(branch, open_chars) for branch in av[1]))
+        elif op in _ASSERTS:
+            _check_backtracking(av[1])
+    return open_chars
+
+
+@lru_cache(maxsize=256)
+def compile_regex(pattern: str) -> CompiledRegex:
+    """Compile a user pattern and derive its trigram prefilter, cached per pattern"""
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise RegexError(f"Pattern is longer than {MAX_PATTERN_LENGTH} characters")
+    try:
+        parsed = sre_parse.parse(pattern)
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise RegexError(f"Invalid regular expression: {e}")
+    _check_backtracking(parsed)
+
+    runs: List[str] = []
+    plan = _literal_runs(parsed, runs)
+    if plan.matches_all:
+        # Without trigrams every file would be scanned
+        raise RegexError("Pattern needs a literal of at least three characters, like foo\\w+")
+    terms = list(dict.fromkeys(token for run in runs for token in tokenize(fold(run))))
+    return CompiledRegex(compiled, plan, terms)
+
+
+def scan_regex(compiled: CompiledRegex, segment: Segment, ids: Iterable[int], deleted: Set[int],
+               weights: List[float], average_length: float,
+               budget: ScanBudget) -> Generator[Tuple[float, int], None, bool]:
+    """Match a regex against candidate files of one segment, yielding (score, doc_id)
+
+    Matching is line oriented, so a single call into the regex engine never
+    sees more than MAX_LINE_LENGTH characters of one line and the budget is
+    checked as it goes. compile_regex only accepts patterns whose matching
+    time grows at most quadratically with that length. A longer line that
+    does not match within the bound sets budget.clipped, since a match
+    further along would be missed. Returns whether the budget cut the scan
+    short.
+    """
+    search = compiled.pattern.search
+    # Score of every blob scanned so far, None when the regex did not match
+    scanned: Dict[int, Optional[float]] = {}
+    for doc_id in ids:
+        if doc_id in deleted:
+            continue
+        blob_id = segment.blob_id(doc_id)
+        if blob_id in scanned:
+            if scanned[blob_id] is not None:
+                yield scanned[blob_id], doc_id
+            continue
+        if budget.exhausted:
+            return True
+
+        content = segment.content(doc_id)
+        budget.charge(len(content))
+        matching_lines = 0
+        for number, line in enumerate(content.split('\n'), 1):
+            if search(line, 0, MAX_LINE_LENGTH):
+                matching_lines += 1
+            elif len(line) > MAX_LINE_LENGTH:
+                budget.clipped = True
+            if (number % LINES_PER_CHECK == 0 or len(line) > LONG_LINE) and budget.exhausted:
+                return True
+        if not matching_lines:
+            scanned[blob_id] = None
+            continue
+
+        score = log1p(matching_lines)
+        if compiled.terms:
+            score += bm25(segment, doc_id, compiled.terms, weights, average_length)
+        scanned[blob_id] = score
+        yield score, doc_id
+    return False
+
+
+def regex_matches(index: CodeIndex, compiled: CompiledRegex, repositories: Optional[List[str]] = None,
+                  file_types: Optional[List[str]] = None, timeout: float = REGEX_TIMEOUT,
+                  max_bytes: int = MAX_SCAN_BYTES) -> Generator[Tuple[float, Segment, int], None, bool]:
+    """Run a regex over the candidate files that survive the trigram prefilter
+
+    Yields (score, segment, doc_id) as files match, in index order, and
+    returns whether the results are partial: the budget cut the scan short
+    or lines were too long to search in full.
+    """
+    budget = ScanBudget(timeout, max_bytes)
+    candidates = [(segment, segment.candidates(compiled.plan, repositories, file_types))
+                  for segment in index.segments]
+    weights = term_weights(index, compiled.terms, sum(len(ids) for _, ids in candidates))
+    average_length = index.average_length
+
+    for segment, ids in candidates:
+        deleted = index.tombstones.get(segment.name, frozenset())
+        scan = scan_regex(compiled, segment, ids, deleted, weights, average_length, budget)
+        while True:
+            try:
+                score, doc_id = next(scan)
+            except StopIteration as stop:
+                if stop.value:
+                    return True
+                break
+            yield score, segment, doc_id
+    return budget.clipped
+
+
+def regex_top_k(index: CodeIndex, compiled: CompiledRegex, repositories: Optional[List[str]] = None,
+                file_types: Optional[List[str]] = None, k: int = 20,
+                timeout: float = REGEX_TIMEOUT,
+                max_bytes: int = MAX_SCAN_BYTES) -> Tuple[int, List[Tuple[float, IndexedFile]], bool]:
+    """Keep the k best regex matches on a bounded heap
+
+    Returns the total matching files, the best (score, file) pairs and whether
+    they are partial.
+    """
+    best = TopK(k)
+    matches = regex_matches(index, compiled, repositories, file_types, timeout, max_bytes)
+    while True:
+        try:
+            score, segment, doc_id = next(matches)
+        except StopIteration as stop:
+            return best.total, best.results(), stop.value
+        best.push(score, segment, doc_id)
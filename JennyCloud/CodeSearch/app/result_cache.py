@@ -0,0 +1,108 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_TTL = 300.0
+
+
+def normalize_key(q: str, filetypes: Iterable[str], repo: str, *flags) -> Tuple:
+    """Build the cache key of a search so equivalent requests share an entry"""
+    types = tuple(sorted({ft.strip() for ft in filetypes if ft.strip()}))
+    return (q.strip(), types, repo.strip()) + flags
+
+
+class ResultCache:
+    """LRU cache of rendered search results, bounded by size and age
+
+    Values are sized with sys.getsizeof, so they should hold their data
+    inline, like strings or arrays. Every entry belongs to the index generation it was computed from; once
+    the index moves on, the whole cache is dropped on the next access, so a
+    re-index never serves stale results.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, ttl: float = DEFAULT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation: Optional[int] = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_generation(self, generation: int):
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.bytes = 0
+            self.generation = generation
+
+    def get(self, key: Hashable, generation: int) -> Optional[Any]:
+        """Return the cached value for the key at this index generation, if fresh"""
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, size, value = entry
+            if time.monotonic() > expires:
+                del self._entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, generation: int, value: Any):
+        """Store a value computed from the given index generation"""
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Results of an older snapshot that finished late are not kept
+            if self.generation is not None and generation < self.generation:
+                return
+            self._check_generation(generation)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "generation": self.generation,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,724 @@
+import asyncio
+import json
+import re
+from hashlib import blake2b
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from indexer import Indexer, file_type_for
+from fuzzy import MAX_SUGGESTIONS, correctable, max_edits, suggest
+from paging import PageCandidates, page_matches, page_weights
+from parallel_search import ShardedSearcher
+from query_plan import CompiledPlan, QueryPlan, compile_plan, compiled_plan_matches, parse_query
+from regex_search import MAX_SCAN_BYTES, compile_regex, regex_matches
+from result_cache import ResultCache
+from search_index import IndexedFile, MemorySegment, ScanBudget, fold
+from symbols import CLASS_KINDS, FUNCTION_KINDS, KIND_IDS, extract_symbols
+
+# Tables of the ManticoreSearch schema; the local engine answers the same requests
+CODE_TABLE = 'code'
+REPO_TABLE = 'code_repositories'
+SOURCE_FIELDS = ['repository', 'path', 'file_type', 'content']
+MAX_REPOSITORIES = 1000
+# Documents per /bulk request when ingesting a repository
+BULK_SIZE = 500
+# Documents per keyset page when reading back a repository
+SCAN_SIZE = 1000
+# Memory for the candidate ids of paged queries, kept so later pages skip the lookups
+CANDIDATE_CACHE_BYTES = 64 * 1024 * 1024
+CANDIDATE_CACHE_TTL = 600.0
+
+# Full-text fields holding definition names, per symbol operator
+SYMBOL_FIELDS = {'def': 'symbols', 'sym': 'symbols', 'class': 'class_symbols', 'function': 'function_symbols'}
+FIELD_OPERATORS = {'symbols': 'def', 'class_symbols': 'class', 'function_symbols': 'function'}
+PREFIX_QUERY = re.compile(r'^@symbols (.+)\*$')
+
+REGEX_SCRIPT = re.compile(r"^REGEX\(content, '((?:[^'\\]|\\.)*)'\)$", re.DOTALL)
+
+
+class BackendError(Exception):
+    pass
+
+
+class CursorExpired(BackendError):
+    """The index position a page was to resume from no longer exists"""
+
+
+class InvalidPosition(ValueError):
+    """A page position that no page of this backend could have returned"""
+
+
+# Requests follow the ManticoreSearch JSON protocol:
+#   {"index": ..., "query": {"bool": {"must": [...], "must_not": [...]}},
+#    "limit": k, "options": {"max_query_time": ms}}
+# with match_phrase clauses on content/path/symbol fields, bool.should for
+# OR groups, a query_string for symbol prefixes, "in" filters on
+# repository/file_type and a REGEX() script field for regex mode.
+
+def _phrase(field: str, text: str) -> Dict:
+    return {"match_phrase": {field: text}}
+
+
+def search_request(q: str, file_types: Optional[List[str]] = None, repositories: Optional[List[str]] = None,
+                   regex: bool = False, k: int = 20, timeout: float = 2.0) -> Dict[str, Any]:
+    """Translate a search box query and its filters into a Manticore search request
+
+    Raises RegexError for invalid patterns before anything is sent.
+    """
+    must: List[Dict] = []
+    must_not: List[Dict] = []
+    request: Dict[str, Any] = {
+        "index": CODE_TABLE,
+        "limit": k,
+        "_source": SOURCE_FIELDS,
+        "options": {"max_query_time": int(timeout * 1000)},
+    }
+
+    if regex:
+        compiled = compile_regex(q)
+        # Required literal tokens let the full-text index prefilter; REGEX() verifies
+        if compiled.terms:
+            tokens = ' '.join(term.decode('utf-8') for term in compiled.terms)
+            must.append({"match": {"content": {"query": tokens, "operator": "and"}}})
+        escaped = q.replace('\\', '\\\\').replace("'", "\\'")
+        request["script_fields"] = {"regex": {"script": {"inline": f"REGEX(content, '(?i){escaped}')"}}}
+        must.append({"equals": {"regex": 1}})
+    else:
+        plan = parse_query(q)
+        for clause in plan.clauses:
+            if len(clause) == 1:
+                must.append(_phrase("content", clause[0]))
+            else:
+                must.append({"bool": {"should": [_phrase("content", term) for term in clause]}})
+        must.extend(_phrase("path", path) for path in plan.paths)
+        for operator, name in plan.symbols:
+            if operator == 'sym':
+                must.append({"query_string": f"@symbols {name}*"})
+            else:
+                must.append(_phrase(SYMBOL_FIELDS[operator], name))
+        if plan.repositories:
+            must.append({"in": {"repository": plan.repositories}})
+        if plan.languages:
+            must.append({"in": {"file_type": plan.file_types}})
+        must_not.extend(_phrase("content", term) for term in plan.excluded)
+        must_not.extend(_phrase("path", path) for path in plan.excluded_paths)
+        if plan.excluded_repositories:
+            must_not.append({"in": {"repository": plan.excluded_repositories}})
+        if plan.excluded_languages:
+            must_not.append({"in": {"file_type": plan.excluded_types}})
+
+    if repositories:
+        must.append({"in": {"repository": repositories}})
+    if file_types:
+        must.append({"in": {"file_type": file_types}})
+
+    query: Dict[str, Any] = {"must": must or [{"match_all": {}}]}
+    if must_not:
+        query["must_not"] = must_not
+    request["query"] = {"bool": query}
+    return request
+
+
+def document_id(repository: str, path: str) -> int:
+    """Stable positive 63-bit document id of a file"""
+    digest = blake2b(f'{repository}\0{path}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+
+def code_document(repository: str, path: str, file_type: str, content: str) -> Dict[str, Any]:
+    """Manticore document of a file, with its definition names split by kind"""
+    definitions = extract_symbols(file_type, content)
+
+    def names(kinds=None) -> str:
+        return ' '.join(name for name, _, kind in definitions if kinds is None or KIND_IDS[kind] in kinds)
+
+    return {"repository": repository, "path": path, "file_type": file_type, "content": content,
+            "symbols": names(), "class_symbols": names(CLASS_KINDS), "function_symbols": names(FUNCTION_KINDS)}
+
+
+class SearchResponse:
+    """Total matches, the ranked (score, file) hits and whether they are partial"""
+
+    def __init__(self, total: int, hits: List[Tuple[float, IndexedFile]], truncated: bool = False):
+        self.total = total
+        self.hits = hits
+        self.truncated = truncated
+
+
+class SearchPage:
+    """One page of hits in index order and the opaque position of the next page"""
+
+    def __init__(self, hits: List[Tuple[float, IndexedFile]], position: Optional[Any] = None,
+                 truncated: bool = False):
+        self.hits = hits
+        self.position = position
+        self.truncated = truncated
+
+
+class HitStream:
+    """Async iterator over (score, file) hits; total and truncated are final once finished"""
+
+    def __init__(self, response: Optional[SearchResponse] = None):
+        self.total = response.total if response else 0
+        self.truncated = response.truncated if response else False
+        self._hits = iter(response.hits if response else ())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[float, IndexedFile]:
+        try:
+            return next(self._hits)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def finish(self):
+        """Account for the hits that will not be read"""
+
+
+class SearchBackend:
+    """Storage and query engine behind the CodeSearch endpoints"""
+
+    async def generation(self) -> int:
+        """Counter that changes whenever indexed content changes"""
+        raise NotImplementedError
+
+    async def repositories(self) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    async def search(self, request: Dict[str, Any]) -> SearchResponse:
+        raise NotImplementedError
+
+    async def stream(self, request: Dict[str, Any]) -> HitStream:
+        """Hits as soon as they are found; backends without streaming send one page"""
+        return HitStream(await self.search(request))
+
+    async def page(self, request: Dict[str, Any], position: Optional[Any] = None) -> SearchPage:
+        """Up to request["limit"] hits in a stable order, resuming where the previous page ended
+
+        The position is JSON-serializable and only meaningful to the backend
+        that returned it. Raises CursorExpired when it can no longer be resumed
+        and InvalidPosition when it does not fit the request.
+        """
+        raise NotImplementedError
+
+    def check_position(self, position: Any):
+        """Raise InvalidPosition unless position is shaped like the ones page returns"""
+        raise NotImplementedError
+
+    async def suggest(self, terms: List[str], limit: int = MAX_SUGGESTIONS) -> Dict[str, List[str]]:
+        """Likely intended spellings of the terms that match no document"""
+        raise NotImplementedError
+
+    async def index_repository(self, name: str, files: List[Dict[str, Any]], description: Optional[str] = None,
+                               replace: bool = True) -> Dict[str, int]:
+        raise NotImplementedError
+
+    async def delete_repository(self, name: str) -> int:
+        raise NotImplementedError
+
+    async def upsert_file(self, repository: str, path: str, file_type: str, content: str) -> bool:
+        raise NotImplementedError
+
+    async def delete_file(self, repository: str, path: str) -> bool:
+        raise NotImplementedError
+
+    async def maintain(self):
+        """Periodic background work such as segment merges"""
+
+    async def close(self):
+        pass
+
+
+def next_match(matches: Iterator):
+    """Advance a match generator, returning (match, None) or (None, its return value)"""
+    try:
+        return next(matches), None
+    except StopIteration as stop:
+        return None, stop.value
+
+
+def count_matches(matches: Iterator) -> Tuple[int, bool]:
+    """Exhaust a match generator, returning how many matches were left and its return value"""
+    count = 0
+    while True:
+        match, truncated = next_match(matches)
+        if match is None:
+            return count, bool(truncated)
+        count += 1
+
+
+class LocalHitStream(HitStream):
+    """Steps a match generator in a worker thread so the event loop stays free"""
+
+    def __init__(self, matches: Iterator):
+        super().__init__()
+        self._matches = matches
+
+    async def __anext__(self) -> Tuple[float, IndexedFile]:
+        match, truncated = await asyncio.to_thread(next_match, self._matches)
+        if match is None:
+            self.truncated = bool(truncated)
+            raise StopAsyncIteration
+        self.total += 1
+        score, segment, doc_id = match
+        return score, segment.file(doc_id)
+
+    async def finish(self):
+        remaining, truncated = await asyncio.to_thread(count_matches, self._matches)
+        self.total += remaining
+        self.truncated = self.truncated or truncated
+
+
+class LocalBackend(SearchBackend):
+    """In-process engine over the segment index that answers Manticore search requests"""
+
+    def __init__(self, indexer: Indexer, searcher: ShardedSearcher):
+        self.indexer = indexer
+        self.searcher = searcher
+        self.candidates = ResultCache(CANDIDATE_CACHE_BYTES, CANDIDATE_CACHE_TTL)
+
+    def _decode(self, request: Dict[str, Any]):
+        """Turn a search request back into a compiled plan or regex and its filters"""
+        query = request.get("query", {}).get("bool", {})
+        repositories: Optional[List[str]] = None
+        file_types: Optional[List[str]] = None
+        clauses: List[List[str]] = []
+        paths: List[str] = []
+        symbols: List[Tuple[str, str]] = []
+        regex = None
+
+        def narrow(current: Optional[List[str]], values: List[str]) -> List[str]:
+            return list(values) if current is None else [v for v in current if v in values]
+
+        for item in query.get("must", []):
+            if "match_phrase" in item:
+                (field, text), = item["match_phrase"].items()
+                if field == "content":
+                    clauses.append([text])
+                elif field in FIELD_OPERATORS:
+                    symbols.append((FIELD_OPERATORS[field], text))
+                else:
+                    paths.append(text)
+            elif "query_string" in item:
+                symbols.append(('sym', PREFIX_QUERY.match(item["query_string"]).group(1)))
+            elif "bool" in item:
+                clauses.append([phrase["match_phrase"]["content"] for phrase in item["bool"].get("should", [])])
+            elif "in" in item:
+                (field, values), = item["in"].items()
+                if field == "repository":
+                    repositories = narrow(repositories, values)
+                else:
+                    file_types = narrow(file_types, values)
+            elif "equals" in item and "regex" in item["equals"]:
+                script = request["script_fields"]["regex"]["script"]["inline"]
+                pattern = re.sub(r'\\(.)', r'\1', REGEX_SCRIPT.match(script).group(1))
+                regex = compile_regex(pattern[4:] if pattern.startswith('(?i)') else pattern)
+
+        if regex is not None:
+            return regex, repositories, file_types
+
+        compiled = compile_plan(QueryPlan(clauses=clauses, paths=paths, symbols=symbols))
+        compiled.repositories = repositories
+        compiled.file_types = file_types
+        for item in query.get("must_not", []):
+            if "match_phrase" in item:
+                (field, text), = item["match_phrase"].items()
+                target = compiled.excluded if field == "content" else compiled.excluded_paths
+                target.append(fold(text))
+            elif "in" in item:
+                (field, values), = item["in"].items()
+                target = compiled.excluded_repositories if field == "repository" else compiled.excluded_types
+                target.update(values)
+        return compiled, repositories, file_types
+
+    @staticmethod
+    def _timeout(request: Dict[str, Any]) -> float:
+        return request.get("options", {}).get("max_query_time", 2000) / 1000
+
+    async def generation(self) -> int:
+        return self.indexer.refresh().generation
+
+    async def repositories(self) -> List[Dict[str, str]]:
+        return self.indexer.refresh().repositories
+
+    async def search(self, request: Dict[str, Any]) -> SearchResponse:
+        query, repositories, file_types = self._decode(request)
+        if repositories == [] or file_types == []:
+            return SearchResponse(0, [])
+        is_regex = not isinstance(query, CompiledPlan)
+        total, hits, truncated = await self.searcher.top_k(
+            self.indexer.refresh(), query, repositories, file_types, request.get("limit", 20),
+            timeout=self._timeout(request), max_bytes=MAX_SCAN_BYTES if is_regex else None)
+        return SearchResponse(total, hits, truncated)
+
+    async def stream(self, request: Dict[str, Any]) -> HitStream:
+        query, repositories, file_types = self._decode(request)
+        if repositories == [] or file_types == []:
+            return HitStream()
+        index = self.indexer.refresh()
+        if isinstance(query, CompiledPlan):
+            return LocalHitStream(compiled_plan_matches(index, query))
+        return LocalHitStream(regex_matches(index, query, repositories, file_types,
+                                            self._timeout(request), MAX_SCAN_BYTES))
+
+    async def page(self, request: Dict[str, Any], position: Optional[Any] = None) -> SearchPage:
+        query, repositories, file_types = self._decode(request)
+        if repositories == [] or file_types == []:
+            return SearchPage([])
+        is_regex = not isinstance(query, CompiledPlan)
+        budget = ScanBudget(self._timeout(request), MAX_SCAN_BYTES if is_regex else None)
+        index = self.indexer.refresh()
+        # The query and its filters decide the candidates, not the page size
+        key = json.dumps(request.get("query"), sort_keys=True)
+        candidates = PageCandidates(index, query, repositories, file_types, self.candidates, key)
+
+        def collect() -> SearchPage:
+            # Weights ride along in the position so later pages score like the first
+            if position is None:
+                start, weights = None, page_weights(candidates)
+            else:
+                start, weights = (position["segment"], position["doc"]), position["weights"]
+                if len(weights) != len(query.terms):
+                    raise InvalidPosition("position weights do not match the query terms")
+            try:
+                hits, after, truncated = page_matches(candidates, start, weights, request.get("limit", 20), budget)
+            except KeyError:
+                raise CursorExpired("the index was compacted since this cursor was issued, restart the search")
+            following = None if after is None else {"segment": after[0], "doc": after[1], "weights": weights}
+            return SearchPage([(score, segment.file(doc_id)) for score, segment, doc_id in hits],
+                              following, truncated)
+        return await asyncio.to_thread(collect)
+
+    def check_position(self, position: Any):
+        if not (isinstance(position, dict) and set(position) == {"segment", "doc", "weights"}
+                and isinstance(position["segment"], str)
+                and isinstance(position["doc"], int) and not isinstance(position["doc"], bool)
+                and position["doc"] >= 0
+                and isinstance(position["weights"], list)
+                and all(isinstance(w, (int, float)) and not isinstance(w, bool) for w in position["weights"])):
+            raise InvalidPosition("expected a segment, doc and weights position")
+
+    async def suggest(self, terms: List[str], limit: int = MAX_SUGGESTIONS) -> Dict[str, List[str]]:
+        index = self.indexer.refresh()
+        return await asyncio.to_thread(suggest, index, terms, limit)
+
+    async def index_repository(self, name: str, files: List[Dict[str, Any]], description: Optional[str] = None,
+                               replace: bool = True) -> Dict[str, int]:
+        def apply():
+            with self.indexer.batch() as batch:
+                return batch.sync_repository(name, files, description, replace)
+        return await asyncio.to_thread(apply)
+
+    async def delete_repository(self, name: str) -> int:
+        def apply():
+            with self.indexer.batch() as batch:
+                return batch.delete_repository(name)
+        return await asyncio.to_thread(apply)
+
+    async def upsert_file(self, repository: str, path: str, file_type: str, content: str) -> bool:
+        def apply():
+            with self.indexer.batch() as batch:
+                return batch.upsert_file(repository, path, file_type, content)
+        return await asyncio.to_thread(apply)
+
+    async def delete_file(self, repository: str, path: str) -> bool:
+        def apply():
+            with self.indexer.batch() as batch:
+                return batch.delete_file(repository, path)
+        return await asyncio.to_thread(apply)
+
+    async def maintain(self):
+        await asyncio.to_thread(self.indexer.merge_all)
+
+    async def close(self):
+        self.searcher.shutdown()
+
+
+class HttpConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one host, with request pipelining"""
+
+    def __init__(self, host: str, port: int, size: int = 8, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        await self._slots.acquire()
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, connection: Tuple[asyncio.StreamReader, asyncio.StreamWriter], reusable: bool):
+        if reusable:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+        self._slots.release()
+
+    def _encode(self, method: str, path: str, body: bytes, content_type: str) -> bytes:
+        head = (f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+                f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                f'Connection: keep-alive\r\n\r\n')
+        return head.encode('latin-1') + body
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> Tuple[int, bytes, bool]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise BackendError("Connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, body, headers.get('connection', '').lower() != 'close'
+
+    async def pipeline(self, requests: List[Tuple[str, str, bytes, str]]) -> List[Tuple[int, bytes]]:
+        """Send several requests on one connection back to back, then read the responses in order"""
+        connection = await self._acquire()
+        reader, writer = connection
+        # Only a connection whose every response was read in full goes back to the pool
+        reusable = False
+        try:
+            writer.write(b''.join(self._encode(*request) for request in requests))
+            await writer.drain()
+            responses = []
+            keep_alive = True
+            for _ in requests:
+                status, body, keep = await asyncio.wait_for(self._read_response(reader), self.timeout)
+                keep_alive = keep_alive and keep
+                responses.append((status, body))
+            reusable = keep_alive
+            return responses
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, IndexError) as e:
+            raise BackendError(f"ManticoreSearch request failed: {e}")
+        finally:
+            self._release(connection, reusable)
+
+    async def request(self, method: str, path: str, body: bytes = b'',
+                      content_type: str = 'application/json') -> Tuple[int, bytes]:
+        return (await self.pipeline([(method, path, body, content_type)]))[0]
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+class ManticoreBackend(SearchBackend):
+    """ManticoreSearch over its HTTP JSON API
+
+    The generation only counts writes made through this process, so other
+    writers become visible to the result cache once its TTL runs out.
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 9308, pool_size: int = 8, timeout: float = 10.0):
+        self.pool = HttpConnectionPool(host, port, pool_size, timeout)
+        self._generation = 0
+        self._tables_ready = False
+
+    async def _json(self, path: str, payload: Any) -> Dict[str, Any]:
+        status, body = await self.pool.request('POST', path, json.dumps(payload).encode('utf-8'))
+        return self._decode_response(status, body)
+
+    @staticmethod
+    def _decode_response(status: int, body: bytes) -> Dict[str, Any]:
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            raise BackendError(f"ManticoreSearch returned status {status} with a non-JSON body")
+        if status >= 400 or (isinstance(data, dict) and data.get('error')):
+            error = data.get('error') if isinstance(data, dict) else data
+            raise BackendError(f"ManticoreSearch error {status}: {error}")
+        return data
+
+    async def _sql(self, statement: str) -> Dict[str, Any]:
+        status, body = await self.pool.request('POST', '/sql?mode=raw', f'query={quote(statement)}'.encode('utf-8'),
+                                               'application/x-www-form-urlencoded')
+        data = self._decode_response(status, body)
+        return data[0] if isinstance(data, list) and data else data
+
+    async def _ensure_tables(self):
+        if self._tables_ready:
+            return
+        # content is also a string attribute so REGEX() can verify it
+        await self._sql(f"CREATE TABLE IF NOT EXISTS {CODE_TABLE} (repository string, path text indexed stored, "
+                        f"file_type string, content text indexed attribute, symbols text indexed, "
+                        f"class_symbols text indexed, function_symbols text indexed) min_infix_len='3'")
+        await self._sql(f"CREATE TABLE IF NOT EXISTS {REPO_TABLE} (name string, description text stored)")
+        self._tables_ready = True
+
+    async def _bulk(self, operations: List[Dict[str, Any]]):
+        """Send operations as pipelined NDJSON /bulk requests of BULK_SIZE documents"""
+        requests = []
+        for start in range(0, len(operations), BULK_SIZE):
+            lines = '\n'.join(json.dumps(op) for op in operations[start:start + BULK_SIZE]) + '\n'
+            requests.append(('POST', '/bulk', lines.encode('utf-8'), 'application/x-ndjson'))
+        if not requests:
+            return
+        for status, body in await self.pool.pipeline(requests):
+            data = self._decode_response(status, body)
+            if isinstance(data, dict) and data.get('errors'):
+                raise BackendError(f"ManticoreSearch bulk request failed: {body[:200]!r}")
+
+    async def generation(self) -> int:
+        return self._generation
+
+    async def repositories(self) -> List[Dict[str, str]]:
+        await self._ensure_tables()
+        data = await self._json('/search', {"index": REPO_TABLE, "query": {"match_all": {}},
+                                            "limit": MAX_REPOSITORIES, "sort": [{"name": "asc"}]})
+        return [{"name": hit["_source"]["name"], "description": hit["_source"].get("description", "")}
+                for hit in data.get("hits", {}).get("hits", [])]
+
+    @staticmethod
+    def _load_hits(data: Dict[str, Any]) -> List[Tuple[float, IndexedFile]]:
+        # Hits are loaded into a scratch segment so context extraction works as for local files
+        segment = MemorySegment()
+        hits = []
+        for hit in data.get("hits", {}).get("hits", []):
+            source = hit["_source"]
+            indexed = segment.add_file(source["repository"], source["path"],
+                                       source.get("file_type") or file_type_for(source["path"]),
+                                       source.get("content", ""))
+            hits.append((float(hit.get("_score", 0)), indexed))
+        return hits
+
+    async def search(self, request: Dict[str, Any]) -> SearchResponse:
+        await self._ensure_tables()
+        data = await self._json('/search', request)
+        hits = self._load_hits(data)
+        total = data.get("hits", {}).get("total", len(hits))
+        return SearchResponse(total, hits, bool(data.get("timed_out")))
+
+    async def page(self, request: Dict[str, Any], position: Optional[Any] = None) -> SearchPage:
+        await self._ensure_tables()
+        # Keyset pagination on the document id: each page is a fresh range scan, never an offset
+        request = dict(request, sort=[{"id": "asc"}], track_scores=True)
+        if position is not None:
+            query = dict(request["query"]["bool"])
+            query["must"] = query["must"] + [{"range": {"id": {"gt": int(position)}}}]
+            request["query"] = {"bool": query}
+        data = await self._json('/search', request)
+        hits = self._load_hits(data)
+        raw = data.get("hits", {}).get("hits", [])
+        following = int(raw[-1]["_id"]) if raw and len(raw) >= request.get("limit", 20) else None
+        return SearchPage(hits, following, bool(data.get("timed_out")))
+
+    def check_position(self, position: Any):
+        if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+            raise InvalidPosition("expected a document id position")
+
+    async def suggest(self, terms: List[str], limit: int = MAX_SUGGESTIONS) -> Dict[str, List[str]]:
+        await self._ensure_tables()
+        corrections = {}
+        for term in dict.fromkeys(terms):
+            if not correctable(term):
+                continue
+            word = term.lower()
+            data = await self._sql(f"CALL SUGGEST('{word}', '{CODE_TABLE}', {limit + 1} AS limit, "
+                                   f"{max_edits(fold(word))} AS max_edits)")
+            rows = data.get("data", []) if isinstance(data, dict) else []
+            # The term itself comes back first at distance 0 when it is indexed
+            if any(int(row.get("distance", 1)) == 0 for row in rows):
+                continue
+            suggestions = [row["suggest"] for row in rows if row.get("suggest")][:limit]
+            if suggestions:
+                corrections[term] = suggestions
+        return corrections
+
+    async def _repository_files(self, name: str) -> Dict[str, Tuple[str, str]]:
+        """(file type, content) of every indexed file of a repository, by path"""
+        files = {}
+        last = -1
+        while True:
+            data = await self._json('/search', {
+                "index": CODE_TABLE, "limit": SCAN_SIZE, "sort": [{"id": "asc"}],
+                "_source": ["path", "file_type", "content"],
+                "query": {"bool": {"must": [{"equals": {"repository": name}}, {"range": {"id": {"gt": last}}}]}},
+            })
+            hits = data.get("hits", {}).get("hits", [])
+            for hit in hits:
+                source = hit["_source"]
+                files[source["path"]] = (source.get("file_type", ""), source.get("content", ""))
+            if len(hits) < SCAN_SIZE:
+                return files
+            last = int(hits[-1]["_id"])
+
+    async def index_repository(self, name: str, files: List[Dict[str, Any]], description: Optional[str] = None,
+                               replace: bool = True) -> Dict[str, int]:
+        """Bring a repository in line with files like LocalBackend does
+
+        Changed files are replaced document by document and stale ones deleted
+        afterwards, so searches never see the repository half empty.
+        """
+        await self._ensure_tables()
+        existing = await self._repository_files(name)
+        stale = set(existing)
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        operations = [{"replace": {"index": REPO_TABLE, "id": document_id(name, ''),
+                                   "doc": {"name": name, "description": description or ''}}}]
+        for file in files:
+            path = file["path"]
+            file_type = file.get("type") or file_type_for(path)
+            stale.discard(path)
+            if existing.get(path) == (file_type, file["content"]):
+                stats["unchanged"] += 1
+                continue
+            stats["updated" if path in existing else "added"] += 1
+            doc = code_document(name, path, file_type, file["content"])
+            operations.append({"replace": {"index": CODE_TABLE, "id": document_id(name, path), "doc": doc}})
+        if replace:
+            operations.extend({"delete": {"index": CODE_TABLE, "id": document_id(name, path)}} for path in stale)
+            stats["deleted"] = len(stale)
+        await self._bulk(operations)
+        self._generation += 1
+        return stats
+
+    async def delete_repository(self, name: str) -> int:
+        await self._ensure_tables()
+        data = await self._json('/delete', {"index": CODE_TABLE, "query": {"equals": {"repository": name}}})
+        await self._json('/delete', {"index": REPO_TABLE, "id": document_id(name, '')})
+        self._generation += 1
+        return int(data.get("deleted", 0))
+
+    async def upsert_file(self, repository: str, path: str, file_type: str, content: str) -> bool:
+        await self._ensure_tables()
+        await self._json('/replace', {"index": CODE_TABLE, "id": document_id(repository, path),
+                                      "doc": code_document(repository, path, file_type, content)})
+        self._generation += 1
+        return True
+
+    async def delete_file(self, repository: str, path: str) -> bool:
+        await self._ensure_tables()
+        data = await self._json('/delete', {"index": CODE_TABLE, "id": document_id(repository, path)})
+        self._generation += 1
+        return data.get("result") == "deleted" or bool(data.get("deleted"))
+
+    async def close(self):
+        await self.pool.close()
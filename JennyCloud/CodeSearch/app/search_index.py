@@ -0,0 +1,640 @@
+import re
+import time
+from hashlib import blake2b
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from symbols import KIND_IDS, extract_symbols
+
+
+@dataclass
+class IndexedFile:
+    doc_id: int
+    repository: str
+    path: str
+    file_type: str
+    segment: Any = field(default=None, repr=False, compare=False)
+
+    @property
+    def content(self) -> str:
+        return self.segment.content(self.doc_id)
+
+    @property
+    def folded(self):
+        return self.segment.folded(self.doc_id)
+
+
+def fold(text: str) -> bytes:
+    """Case-fold text into the byte form used for trigrams and matching"""
+    return text.lower().encode('utf-8')
+
+
+TOKEN_PATTERN = re.compile(rb'\w+')
+MIN_WORD_LENGTH = 3
+MAX_WORD_LENGTH = 64
+
+
+def tokenize(data: bytes) -> List[bytes]:
+    """Split a folded buffer into identifier-like tokens for relevance scoring"""
+    return TOKEN_PATTERN.findall(data)
+
+
+def is_vocabulary_word(token: bytes) -> bool:
+    """Whether a token is worth suggesting as a correction: an identifier of sane length"""
+    return MIN_WORD_LENGTH <= len(token) <= MAX_WORD_LENGTH and not token.isdigit()
+
+
+def extract_trigrams(data: bytes) -> set:
+    """Return the distinct byte trigrams of a folded buffer"""
+    return {data[i:i + 3] for i in range(len(data) - 2)}
+
+
+def content_hash(encoded: bytes) -> bytes:
+    """Address of a file body in the blob table of a segment"""
+    return blake2b(encoded, digest_size=16).digest()
+
+
+def new_segment_name() -> str:
+    """Return a unique file name for a new segment"""
+    return f'segment-{uuid.uuid4().hex[:16]}.jcs'
+
+
+def line_starts(data: bytes) -> array:
+    """Return the byte offset at which every line of a buffer starts"""
+    offsets = array('I', [0])
+    pos = data.find(b'\n')
+    while pos != -1:
+        offsets.append(pos + 1)
+        pos = data.find(b'\n', pos + 1)
+    return offsets
+
+
+def _intersect(candidates: List[int], postings) -> List[int]:
+    """Intersect a sorted candidate list with a sorted posting list"""
+    # Probe the larger list by bisection when the candidate set is small,
+    # otherwise a hash join is cheaper than len(candidates) binary searches.
+    if len(candidates) * 16 < len(postings):
+        result = []
+        size = len(postings)
+        for doc_id in candidates:
+            pos = bisect_left(postings, doc_id)
+            if pos < size and postings[pos] == doc_id:
+                result.append(doc_id)
+        return result
+    members = set(postings)
+    return [doc_id for doc_id in candidates if doc_id in members]
+
+
+@dataclass(frozen=True)
+class TrigramQuery:
+    """Boolean trigram requirement used to prune candidate files
+
+    An 'and' node needs every trigram and every child, an 'or' node needs any
+    child. An 'and' node with nothing in it matches every file.
+    """
+    op: str = 'and'
+    trigrams: frozenset = frozenset()
+    children: tuple = ()
+
+    @classmethod
+    def literal(cls, text: str) -> 'TrigramQuery':
+        return cls('and', frozenset(extract_trigrams(fold(text))))
+
+    @property
+    def matches_all(self) -> bool:
+        if self.op == 'or':
+            return not self.children or any(child.matches_all for child in self.children)
+        return not self.trigrams and all(child.matches_all for child in self.children)
+
+
+class ScanBudget:
+    """Wall-clock deadline and byte allowance shared by the scans of one query
+
+    The deadline is absolute wall time so it means the same thing in every
+    process a query is fanned out to. clipped records that a scan skipped
+    part of a file without running out, so its results are partial too.
+    """
+
+    def __init__(self, timeout: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.bytes_left = max_bytes
+        self.clipped = False
+
+    def charge(self, size: int):
+        if self.bytes_left is not None:
+            self.bytes_left -= size
+
+    @property
+    def exhausted(self) -> bool:
+        if self.bytes_left is not None and self.bytes_left < 0:
+            return True
+        return self.deadline is not None and time.time() > self.deadline
+
+
+class Segment:
+    """Read interface shared by in-memory and on-disk index segments
+
+    Doc ids name file locations, a (repository, path) each. File bodies are
+    stored once per distinct content as blobs: trigram postings, token
+    stats and symbols refer to blob ids, and every location points at its
+    blob, so a file copied across repositories is indexed and scanned once.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._bitmaps: Dict[tuple, int] = {}
+
+    @property
+    def num_files(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def num_blobs(self) -> int:
+        raise NotImplementedError
+
+    def blob_id(self, doc_id: int) -> int:
+        """Blob holding the content of a file"""
+        raise NotImplementedError
+
+    def blob_docs(self, blob_id: int):
+        """Sorted ids of the files whose content is a blob"""
+        raise NotImplementedError
+
+    def posting(self, trigram: bytes):
+        """Sorted blob ids containing a trigram, or None"""
+        raise NotImplementedError
+
+    def filter_ids(self, kind: str, key: str):
+        raise NotImplementedError
+
+    def file(self, doc_id: int) -> IndexedFile:
+        raise NotImplementedError
+
+    def file_key(self, doc_id: int) -> Tuple[str, str]:
+        raise NotImplementedError
+
+    def contains(self, doc_id: int, needle: bytes) -> bool:
+        raise NotImplementedError
+
+    def count(self, doc_id: int, needle: bytes) -> int:
+        raise NotImplementedError
+
+    def content_region(self, doc_id: int) -> Tuple[Any, int, int]:
+        """Return (buffer, start, end) locating a file's UTF-8 content"""
+        raise NotImplementedError
+
+    def folded_region(self, doc_id: int) -> Tuple[Any, int, int]:
+        """Return (buffer, start, end) locating a file's folded content"""
+        raise NotImplementedError
+
+    def line_offsets(self, doc_id: int):
+        """Return the line start table of a file's content"""
+        raise NotImplementedError
+
+    def folded_line_offsets(self, doc_id: int):
+        """Return the line start table of a file's folded content"""
+        raise NotImplementedError
+
+    def content(self, doc_id: int) -> str:
+        buffer, start, end = self.content_region(doc_id)
+        return str(buffer[start:end], 'utf-8')
+
+    def folded(self, doc_id: int):
+        buffer, start, end = self.folded_region(doc_id)
+        return buffer[start:end]
+
+    def line_count(self, doc_id: int) -> int:
+        return len(self.line_offsets(doc_id))
+
+    def match_lines(self, doc_id: int, needle: bytes, limit: Optional[int] = None) -> List[int]:
+        """Return the 0-based numbers of the lines containing needle
+
+        Matches are found in the folded buffer and mapped to lines by
+        bisecting the line table; the search resumes at the next line so
+        each line is reported once.
+        """
+        buffer, start, end = self.folded_region(doc_id)
+        offsets = self.folded_line_offsets(doc_id)
+        found = []
+        pos = buffer.find(needle, start, end)
+        while pos != -1:
+            line = bisect_right(offsets, pos - start) - 1
+            found.append(line)
+            if (limit and len(found) >= limit) or line + 1 >= len(offsets):
+                break
+            pos = buffer.find(needle, start + offsets[line + 1], end)
+        return found
+
+    def lines(self, doc_id: int, first: int = 0, last: Optional[int] = None) -> List[str]:
+        """Decode lines [first, last) straight out of the stored content"""
+        buffer, start, end = self.content_region(doc_id)
+        offsets = self.line_offsets(doc_id)
+        last = len(offsets) if last is None else min(last, len(offsets))
+        if first >= last:
+            return []
+        stop = start + offsets[last] if last < len(offsets) else end
+        text = str(buffer[start + offsets[first]:stop], 'utf-8')
+        return text.split('\n')[:last - first]
+
+    def doc_length(self, doc_id: int) -> int:
+        raise NotImplementedError
+
+    def document_frequency(self, token: bytes) -> int:
+        raise NotImplementedError
+
+    @property
+    def total_tokens(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def num_symbols(self) -> int:
+        raise NotImplementedError
+
+    def symbol_name(self, pos: int) -> bytes:
+        """Folded name of the pos-th symbol in name order"""
+        raise NotImplementedError
+
+    def symbol(self, pos: int) -> Tuple[int, int, int]:
+        """Return (blob_id, 1-based line, kind id) of the pos-th symbol in name order"""
+        raise NotImplementedError
+
+    def vocabulary(self) -> Iterator[Tuple[bytes, int]]:
+        """Yield (word, document frequency) for the words typo correction can suggest"""
+        raise NotImplementedError
+
+    def find_symbols(self, name: bytes, prefix: bool = False) -> Iterator[Tuple[bytes, int, int, int]]:
+        """Yield (name, blob_id, line, kind) of definitions named name, or starting with it
+
+        Symbols are sorted by folded name, so the matching run is found by
+        bisection in O(log n).
+        """
+        names = _SymbolNames(self)
+        start = bisect_left(names, name)
+        # 0xff never occurs in UTF-8, so it bounds every name with this prefix
+        end = bisect_left(names, name + b'\xff', start) if prefix else bisect_right(names, name, start)
+        for pos in range(start, end):
+            yield (names[pos],) + self.symbol(pos)
+
+    def _bitmap(self, kind: str, key: str) -> int:
+        """Return the cached bitmap of files for a repository or file type"""
+        bitmap = self._bitmaps.get((kind, key))
+        if bitmap is None:
+            bits = bytearray((self.num_files + 7) // 8)
+            for doc_id in self.filter_ids(kind, key):
+                bits[doc_id >> 3] |= 1 << (doc_id & 7)
+            bitmap = self._bitmaps[(kind, key)] = int.from_bytes(bits, 'little')
+        return bitmap
+
+    def filter_bitmap(self, repositories: Optional[List[str]] = None,
+                      file_types: Optional[List[str]] = None) -> Optional[int]:
+        """Combine repository and file type filters into one bitmap"""
+        bitmap = None
+        if repositories:
+            bitmap = 0
+            for name in repositories:
+                bitmap |= self._bitmap('repo', name)
+        if file_types:
+            types_bitmap = 0
+            for file_type in file_types:
+                types_bitmap |= self._bitmap('type', file_type)
+            bitmap = types_bitmap if bitmap is None else bitmap & types_bitmap
+        return bitmap
+
+    def expand_blobs(self, blob_ids: Iterable[int]) -> List[int]:
+        """Return the sorted ids of every file stored as one of the blobs"""
+        if self.num_blobs == self.num_files:
+            # Without duplicates blobs and files are numbered alike
+            return list(blob_ids)
+        doc_ids = []
+        for blob_id in blob_ids:
+            doc_ids.extend(self.blob_docs(blob_id))
+        doc_ids.sort()
+        return doc_ids
+
+    def evaluate(self, query: TrigramQuery) -> Optional[List[int]]:
+        """Return the sorted blob ids matching a trigram query, or None for every blob"""
+        if query.op == 'or':
+            results = []
+            for child in query.children:
+                result = self.evaluate(child)
+                if result is None:
+                    return None
+                results.append(result)
+            if not results:
+                return None
+            return sorted(set().union(*results))
+
+        posting_lists = []
+        for trigram in query.trigrams:
+            posting = self.posting(trigram)
+            if posting is None:
+                return []
+            posting_lists.append(posting)
+        for child in query.children:
+            result = self.evaluate(child)
+            if result is not None:
+                posting_lists.append(result)
+        if not posting_lists:
+            return None
+
+        posting_lists.sort(key=len)
+        result = list(posting_lists[0])
+        for posting in posting_lists[1:]:
+            if not result:
+                break
+            result = _intersect(result, posting)
+        return result
+
+    def candidates(self, query: Union[str, TrigramQuery], repositories: Optional[List[str]] = None,
+                   file_types: Optional[List[str]] = None, within: Optional[List[int]] = None) -> List[int]:
+        """Return ids of files that satisfy the trigram query and the filters
+
+        within restricts the result to a sorted list of ids found elsewhere,
+        such as the files defining a symbol.
+        """
+        bitmap = self.filter_bitmap(repositories, file_types)
+        if bitmap == 0:
+            return []
+
+        if isinstance(query, str):
+            query = TrigramQuery.literal(query)
+        result = self.evaluate(query)
+        if result is not None:
+            result = self.expand_blobs(result)
+        if within is not None:
+            result = list(within) if result is None else _intersect(list(within), result)
+        elif result is None:
+            # Queries shorter than a trigram fall back to the filtered corpus
+            result = list(range(self.num_files))
+
+        if bitmap is not None:
+            # Test membership against a byte view so each check is O(1)
+            mask = bitmap.to_bytes((self.num_files + 7) // 8 or 1, 'little')
+            result = [d for d in result if mask[d >> 3] & (1 << (d & 7))]
+        return result
+
+    def search(self, query: str, repositories: Optional[List[str]] = None,
+               file_types: Optional[List[str]] = None,
+               deleted: Set[int] = frozenset()) -> Iterator[IndexedFile]:
+        """Yield live files whose content contains the query, case-insensitively"""
+        needle = fold(query)
+        for doc_id in self.candidates(query, repositories, file_types):
+            if doc_id not in deleted and self.contains(doc_id, needle):
+                yield self.file(doc_id)
+
+
+class MemorySegment(Segment):
+    """Mutable segment that files are indexed into before being persisted"""
+
+    def __init__(self, name: Optional[str] = None):
+        super().__init__(name or new_segment_name())
+        self.files: List[IndexedFile] = []
+        self.blobs = array('I')
+        self.postings: Dict[bytes, array] = {}
+        self.repo_files: Dict[str, array] = {}
+        self.type_files: Dict[str, array] = {}
+        self.doc_lengths = array('I')
+        self.token_df: Dict[bytes, int] = {}
+        self._total_tokens = 0
+        self._blob_ids: Dict[bytes, int] = {}
+        self._blob_docs: List[array] = []
+        self._contents: List[str] = []
+        self._encoded: List[bytes] = []
+        self._folded: List[bytes] = []
+        self._lines: List[array] = []
+        self._folded_lines: List[array] = []
+        # (folded name, blob_id, line, kind id), sorted on first lookup
+        self.symbols: List[Tuple[bytes, int, int, int]] = []
+        self._symbols_sorted = True
+
+    @property
+    def num_files(self) -> int:
+        return len(self.files)
+
+    @property
+    def num_blobs(self) -> int:
+        return len(self._encoded)
+
+    @property
+    def total_tokens(self) -> int:
+        return self._total_tokens
+
+    def add_file(self, repository: str, path: str, file_type: str, content: str) -> IndexedFile:
+        """Index a single file and return its record
+
+        Content already stored in this segment is only referenced, not
+        indexed again.
+        """
+        doc_id = len(self.files)
+        indexed = IndexedFile(doc_id, repository, path, file_type, self)
+        encoded = content.encode('utf-8')
+        address = content_hash(encoded)
+        blob_id = self._blob_ids.get(address)
+        if blob_id is None:
+            blob_id = self._blob_ids[address] = self._add_blob(file_type, content, encoded)
+        self.files.append(indexed)
+        self.blobs.append(blob_id)
+        self._blob_docs[blob_id].append(doc_id)
+
+        self.repo_files.setdefault(repository, array('I')).append(doc_id)
+        self.type_files.setdefault(file_type, array('I')).append(doc_id)
+        self._bitmaps.clear()
+        return indexed
+
+    def _add_blob(self, file_type: str, content: str, encoded: bytes) -> int:
+        blob_id = len(self._encoded)
+        folded = fold(content)
+        self._blob_docs.append(array('I'))
+        self._contents.append(content)
+        self._encoded.append(encoded)
+        self._folded.append(folded)
+
+        # Line tables are built once here so rendering never re-splits content
+        lines = line_starts(encoded)
+        folded_lines = line_starts(folded)
+        self._lines.append(lines)
+        self._folded_lines.append(lines if folded_lines == lines else folded_lines)
+
+        # Blob ids grow monotonically so every posting list stays sorted
+        for trigram in extract_trigrams(folded):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                posting = self.postings[trigram] = array('I')
+            posting.append(blob_id)
+
+        # Length and document frequency stats feed BM25 at query time
+        tokens = tokenize(folded)
+        self.doc_lengths.append(len(tokens))
+        self._total_tokens += len(tokens)
+        for token in set(tokens):
+            self.token_df[token] = self.token_df.get(token, 0) + 1
+
+        for name, line, kind in extract_symbols(file_type, content):
+            self.symbols.append((fold(name), blob_id, line, KIND_IDS[kind]))
+            self._symbols_sorted = False
+        return blob_id
+
+    def blob_id(self, doc_id: int) -> int:
+        return self.blobs[doc_id]
+
+    def blob_docs(self, blob_id: int) -> array:
+        return self._blob_docs[blob_id]
+
+    def posting(self, trigram: bytes):
+        return self.postings.get(trigram)
+
+    def filter_ids(self, kind: str, key: str):
+        source = self.repo_files if kind == 'repo' else self.type_files
+        return source.get(key, ())
+
+    def file(self, doc_id: int) -> IndexedFile:
+        return self.files[doc_id]
+
+    def file_key(self, doc_id: int) -> Tuple[str, str]:
+        indexed = self.files[doc_id]
+        return indexed.repository, indexed.path
+
+    def contains(self, doc_id: int, needle: bytes) -> bool:
+        return needle in self._folded[self.blobs[doc_id]]
+
+    def count(self, doc_id: int, needle: bytes) -> int:
+        return self._folded[self.blobs[doc_id]].count(needle)
+
+    def content(self, doc_id: int) -> str:
+        return self._contents[self.blobs[doc_id]]
+
+    def folded(self, doc_id: int) -> bytes:
+        return self._folded[self.blobs[doc_id]]
+
+    def encoded(self, doc_id: int) -> bytes:
+        return self._encoded[self.blobs[doc_id]]
+
+    def blob_encoded(self, blob_id: int) -> bytes:
+        return self._encoded[blob_id]
+
+    def blob_folded(self, blob_id: int) -> bytes:
+        return self._folded[blob_id]
+
+    def blob_line_offsets(self, blob_id: int) -> array:
+        return self._lines[blob_id]
+
+    def blob_folded_line_offsets(self, blob_id: int) -> array:
+        return self._folded_lines[blob_id]
+
+    def content_region(self, doc_id: int) -> Tuple[bytes, int, int]:
+        encoded = self._encoded[self.blobs[doc_id]]
+        return encoded, 0, len(encoded)
+
+    def folded_region(self, doc_id: int) -> Tuple[bytes, int, int]:
+        folded = self._folded[self.blobs[doc_id]]
+        return folded, 0, len(folded)
+
+    def line_offsets(self, doc_id: int) -> array:
+        return self._lines[self.blobs[doc_id]]
+
+    def folded_line_offsets(self, doc_id: int) -> array:
+        return self._folded_lines[self.blobs[doc_id]]
+
+    def doc_length(self, doc_id: int) -> int:
+        return self.doc_lengths[self.blobs[doc_id]]
+
+    def document_frequency(self, token: bytes) -> int:
+        return self.token_df.get(token, 0)
+
+    def vocabulary(self) -> Iterator[Tuple[bytes, int]]:
+        for token, df in self.token_df.items():
+            if is_vocabulary_word(token):
+                yield token, df
+
+    def sorted_symbols(self) -> List[Tuple[bytes, int, int, int]]:
+        if not self._symbols_sorted:
+            self.symbols.sort()
+            self._symbols_sorted = True
+        return self.symbols
+
+    @property
+    def num_symbols(self) -> int:
+        return len(self.symbols)
+
+    def symbol_name(self, pos: int) -> bytes:
+        return self.sorted_symbols()[pos][0]
+
+    def symbol(self, pos: int) -> Tuple[int, int, int]:
+        return self.sorted_symbols()[pos][1:]
+
+
+class _SymbolNames:
+    """Sequence view of a segment's sorted symbol names, for bisect"""
+
+    def __init__(self, segment: Segment):
+        self.segment = segment
+
+    def __len__(self) -> int:
+        return self.segment.num_symbols
+
+    def __getitem__(self, pos: int) -> bytes:
+        return self.segment.symbol_name(pos)
+
+
+class CodeIndex:
+    """Immutable snapshot of the segments, tombstones and repositories of a corpus"""
+
+    def __init__(self, segments: Optional[List[Segment]] = None,
+                 repositories: Optional[List[Dict[str, str]]] = None,
+                 tombstones: Optional[Dict[str, Set[int]]] = None,
+                 generation: int = 0):
+        self.segments: List[Segment] = segments or []
+        self.repositories: List[Dict[str, str]] = repositories or []
+        self.tombstones: Dict[str, Set[int]] = tombstones or {}
+        self.generation = generation
+        self._locations: Optional[Dict[Tuple[str, str], Tuple[str, int]]] = None
+        self._average_length: Optional[float] = None
+
+    @property
+    def num_files(self) -> int:
+        """Number of live files across all segments"""
+        return sum(s.num_files - len(self.tombstones.get(s.name, ())) for s in self.segments)
+
+    @property
+    def total_files(self) -> int:
+        """Number of stored files, including tombstoned ones"""
+        return sum(segment.num_files for segment in self.segments)
+
+    @property
+    def total_blobs(self) -> int:
+        """Number of stored distinct file bodies, as used by BM25 stats"""
+        return sum(segment.num_blobs for segment in self.segments)
+
+    @property
+    def average_length(self) -> float:
+        """Average blob length in tokens across all segments"""
+        if self._average_length is None:
+            total_tokens = sum(segment.total_tokens for segment in self.segments)
+            self._average_length = total_tokens / max(self.total_blobs, 1) or 1.0
+        return self._average_length
+
+    def document_frequency(self, token: bytes) -> int:
+        """Number of blobs containing token, summed over segments"""
+        return sum(segment.document_frequency(token) for segment in self.segments)
+
+    def locations(self) -> Dict[Tuple[str, str], Tuple[str, int]]:
+        """Map every live (repository, path) to its (segment name, doc id)"""
+        if self._locations is None:
+            locations = {}
+            for segment in self.segments:
+                deleted = self.tombstones.get(segment.name, ())
+                for doc_id in range(segment.num_files):
+                    if doc_id not in deleted:
+                        locations[segment.file_key(doc_id)] = (segment.name, doc_id)
+            self._locations = locations
+        return self._locations
+
+    def search(self, query: str, repositories: Optional[List[str]] = None,
+               file_types: Optional[List[str]] = None) -> Iterator[IndexedFile]:
+        """Yield matching live files from every segment"""
+        for segment in self.segments:
+            deleted = self.tombstones.get(segment.name, frozenset())
+            yield from segment.search(query, repositories, file_types, deleted)
@@ -0,0 +1,369 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from search_index import CodeIndex, IndexedFile, MemorySegment, Segment
+
+# Segment file layout (little endian, every section 8-byte aligned):
+#   header    magic, file, blob, trigram, token, symbol and word counts, section offsets
+#   files     FILE_FIELDS uint64 per file location, see below
+#   blobs     BLOB_FIELDS uint64 per distinct file body, see below
+#   keys      sorted uint32 trigram keys
+#   entries   uint64 (posting offset, posting length) per trigram key
+#   postings  uint32 blob ids per trigram, then the doc ids of every blob and
+#             the per-repository and per-type lists
+#   lines     uint32 line start offsets
+#   lengths   uint32 token count per blob, the BM25 length norm input
+#   tokens    sorted uint64 token hashes
+#   dfs       uint32 blob frequency per token hash
+#   symbols   uint64 (name offset, name length, blob id, line << 8 | kind) per
+#             definition, sorted by folded name
+#   words     uint64 (word offset, word length, document frequency) per
+#             vocabulary word, sorted, for typo correction
+#   data      paths, contents and folded contents
+#   meta      JSON with repository/type names, their posting lists and token totals
+MAGIC = b'JCSEG005'
+HEADER = struct.Struct('<8sIIIIII13Q')
+SYMBOL_FIELDS = 4
+WORD_FIELDS = 3
+FILE_FIELDS = 5
+F_PATH_OFF, F_PATH_LEN, F_REPO, F_TYPE, F_BLOB = range(FILE_FIELDS)
+BLOB_FIELDS = 9
+(B_CONTENT_OFF, B_CONTENT_LEN, B_FOLDED_OFF, B_FOLDED_LEN, B_LINES_OFF, B_LINE_COUNT,
+ B_FOLDED_LINES_OFF, B_DOCS_OFF, B_DOC_COUNT) = range(BLOB_FIELDS)
+
+MANIFEST = 'manifest.json'
+
+
+def _trigram_key(trigram: bytes) -> int:
+    return int.from_bytes(trigram, 'big')
+
+
+def token_hash(token: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(token, digest_size=8).digest(), 'little')
+
+
+def _align(out, size: int = 8):
+    padding = -out.tell() % size
+    if padding:
+        out.write(b'\0' * padding)
+    return out.tell()
+
+
+def write_segment(segment: MemorySegment, path: str):
+    """Persist a segment as an immutable file, replacing path atomically"""
+    repos: Dict[str, int] = {}
+    types: Dict[str, int] = {}
+    records = array('Q')
+    line_tables = array('I')
+    data_chunks: List[bytes] = []
+    data_size = 0
+
+    def add_data(chunk: bytes) -> int:
+        nonlocal data_size
+        offset = data_size
+        data_chunks.append(chunk)
+        data_size += len(chunk)
+        return offset
+
+    for doc_id in range(segment.num_files):
+        indexed = segment.file(doc_id)
+        path_bytes = indexed.path.encode('utf-8')
+        records.extend((
+            add_data(path_bytes), len(path_bytes),
+            repos.setdefault(indexed.repository, len(repos)),
+            types.setdefault(indexed.file_type, len(types)),
+            segment.blob_id(doc_id),
+        ))
+
+    postings = array('I')
+    keys = array('I')
+    entries = array('Q')
+    for trigram in sorted(segment.postings):
+        posting = segment.postings[trigram]
+        keys.append(_trigram_key(trigram))
+        entries.extend((len(postings), len(posting)))
+        postings.extend(posting)
+
+    blobs = array('Q')
+    for blob_id in range(segment.num_blobs):
+        content = segment.blob_encoded(blob_id)
+        folded = segment.blob_folded(blob_id)
+        lines = segment.blob_line_offsets(blob_id)
+        folded_lines = segment.blob_folded_line_offsets(blob_id)
+        docs = segment.blob_docs(blob_id)
+
+        lines_off = len(line_tables)
+        line_tables.extend(lines)
+        folded_lines_off = lines_off
+        if folded_lines is not lines:
+            folded_lines_off = len(line_tables)
+            line_tables.extend(folded_lines)
+
+        blobs.extend((
+            add_data(content), len(content),
+            add_data(folded), len(folded),
+            lines_off, len(lines), folded_lines_off,
+            len(postings), len(docs),
+        ))
+        postings.extend(docs)
+
+    token_keys = array('Q')
+    token_dfs = array('I')
+    for key, df in sorted((token_hash(token), df) for token, df in segment.token_df.items()):
+        token_keys.append(key)
+        token_dfs.append(df)
+
+    # Symbol names live in the data section next to the contents
+    symbols = array('Q')
+    for name, blob_id, line, kind in segment.sorted_symbols():
+        symbols.extend((add_data(name), len(name), blob_id, line << 8 | kind))
+
+    words = array('Q')
+    for word, df in sorted(segment.vocabulary()):
+        words.extend((add_data(word), len(word), df))
+
+    meta = {"repositories": list(repos), "types": list(types), "repo_files": {}, "type_files": {},
+            "total_tokens": segment.total_tokens}
+    for kind, names in (('repo', repos), ('type', types)):
+        for name in names:
+            ids = segment.filter_ids(kind, name)
+            meta[kind + "_files"][name] = [len(postings), len(ids)]
+            postings.extend(ids)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as out:
+        out.write(b'\0' * HEADER.size)
+        offsets = []
+        for section in (records, blobs, keys, entries, postings, line_tables,
+                        segment.doc_lengths, token_keys, token_dfs, symbols, words):
+            offsets.append(_align(out))
+            section.tofile(out)
+        offsets.append(_align(out))
+        for chunk in data_chunks:
+            out.write(chunk)
+        offsets.append(_align(out))
+        out.write(json.dumps(meta).encode('utf-8'))
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, segment.num_files, segment.num_blobs, len(keys), len(token_keys),
+                              segment.num_symbols, len(words) // WORD_FIELDS, *offsets))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+
+
+class DiskSegment(Segment):
+    """Read-only segment served straight from a memory-mapped file"""
+
+    def __init__(self, path: str):
+        super().__init__(os.path.basename(path))
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+
+        (magic, self._num_files, self._num_blobs, num_keys, num_tokens, self._num_symbols,
+         num_words, *offsets) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a CodeSearch segment of this version, re-index the corpus")
+        (files_off, blobs_off, keys_off, entries_off, postings_off, lines_off, lengths_off,
+         token_keys_off, token_dfs_off, symbols_off, words_off, data_off, meta_off) = offsets
+
+        # Every table is a zero-copy view into the mapping
+        self._records = view[files_off:files_off + self._num_files * FILE_FIELDS * 8].cast('Q')
+        self._blobs = view[blobs_off:blobs_off + self._num_blobs * BLOB_FIELDS * 8].cast('Q')
+        self._keys = view[keys_off:keys_off + num_keys * 4].cast('I')
+        self._entries = view[entries_off:entries_off + num_keys * 16].cast('Q')
+        self._postings = view[postings_off:lines_off].cast('I')
+        self._lines = view[lines_off:lengths_off].cast('I')
+        self._lengths = view[lengths_off:lengths_off + self._num_blobs * 4].cast('I')
+        self._token_keys = view[token_keys_off:token_keys_off + num_tokens * 8].cast('Q')
+        self._token_dfs = view[token_dfs_off:token_dfs_off + num_tokens * 4].cast('I')
+        self._symbols = view[symbols_off:symbols_off + self._num_symbols * SYMBOL_FIELDS * 8].cast('Q')
+        self._words = view[words_off:words_off + num_words * WORD_FIELDS * 8].cast('Q')
+        self._data_off = data_off
+
+        meta = json.loads(bytes(view[meta_off:]).decode('utf-8'))
+        self._repos: List[str] = meta['repositories']
+        self._types: List[str] = meta['types']
+        self._filters = {'repo': meta['repo_files'], 'type': meta['type_files']}
+        self._total_tokens = meta['total_tokens']
+
+    @property
+    def num_files(self) -> int:
+        return self._num_files
+
+    @property
+    def num_blobs(self) -> int:
+        return self._num_blobs
+
+    @property
+    def repositories(self) -> List[str]:
+        return self._repos
+
+    @property
+    def total_tokens(self) -> int:
+        return self._total_tokens
+
+    def _field(self, doc_id: int, field: int) -> int:
+        return self._records[doc_id * FILE_FIELDS + field]
+
+    def _blob_field(self, doc_id: int, field: int) -> int:
+        return self._blobs[self._records[doc_id * FILE_FIELDS + F_BLOB] * BLOB_FIELDS + field]
+
+    def blob_id(self, doc_id: int) -> int:
+        return self._records[doc_id * FILE_FIELDS + F_BLOB]
+
+    def blob_docs(self, blob_id: int) -> memoryview:
+        base = blob_id * BLOB_FIELDS
+        offset = self._blobs[base + B_DOCS_OFF]
+        return self._postings[offset:offset + self._blobs[base + B_DOC_COUNT]]
+
+    def _bytes(self, offset: int, length: int) -> memoryview:
+        start = self._data_off + offset
+        return memoryview(self._mmap)[start:start + length]
+
+    def posting(self, trigram: bytes):
+        key = _trigram_key(trigram)
+        pos = bisect_left(self._keys, key)
+        if pos == len(self._keys) or self._keys[pos] != key:
+            return None
+        offset, length = self._entries[pos * 2], self._entries[pos * 2 + 1]
+        return self._postings[offset:offset + length]
+
+    def filter_ids(self, kind: str, key: str):
+        entry = self._filters[kind].get(key)
+        if entry is None:
+            return ()
+        offset, length = entry
+        return self._postings[offset:offset + length]
+
+    def line_offsets(self, doc_id: int) -> memoryview:
+        offset = self._blob_field(doc_id, B_LINES_OFF)
+        return self._lines[offset:offset + self._blob_field(doc_id, B_LINE_COUNT)]
+
+    def folded_line_offsets(self, doc_id: int) -> memoryview:
+        offset = self._blob_field(doc_id, B_FOLDED_LINES_OFF)
+        return self._lines[offset:offset + self._blob_field(doc_id, B_LINE_COUNT)]
+
+    def content_region(self, doc_id: int) -> Tuple[mmap.mmap, int, int]:
+        start = self._data_off + self._blob_field(doc_id, B_CONTENT_OFF)
+        return self._mmap, start, start + self._blob_field(doc_id, B_CONTENT_LEN)
+
+    def folded_region(self, doc_id: int) -> Tuple[mmap.mmap, int, int]:
+        start = self._data_off + self._blob_field(doc_id, B_FOLDED_OFF)
+        return self._mmap, start, start + self._blob_field(doc_id, B_FOLDED_LEN)
+
+    def folded(self, doc_id: int) -> memoryview:
+        return self._bytes(self._blob_field(doc_id, B_FOLDED_OFF), self._blob_field(doc_id, B_FOLDED_LEN))
+
+    def file_key(self, doc_id: int) -> Tuple[str, str]:
+        path = self._bytes(self._field(doc_id, F_PATH_OFF), self._field(doc_id, F_PATH_LEN))
+        return self._repos[self._field(doc_id, F_REPO)], str(path, 'utf-8')
+
+    def file(self, doc_id: int) -> IndexedFile:
+        base = doc_id * FILE_FIELDS
+        fields = self._records[base:base + FILE_FIELDS]
+        return IndexedFile(
+            doc_id,
+            self._repos[fields[F_REPO]],
+            str(self._bytes(fields[F_PATH_OFF], fields[F_PATH_LEN]), 'utf-8'),
+            self._types[fields[F_TYPE]],
+            self,
+        )
+
+    def contains(self, doc_id: int, needle: bytes) -> bool:
+        start = self._data_off + self._blob_field(doc_id, B_FOLDED_OFF)
+        end = start + self._blob_field(doc_id, B_FOLDED_LEN)
+        return self._mmap.find(needle, start, end) != -1
+
+    def count(self, doc_id: int, needle: bytes) -> int:
+        start = self._data_off + self._blob_field(doc_id, B_FOLDED_OFF)
+        end = start + self._blob_field(doc_id, B_FOLDED_LEN)
+        found = 0
+        pos = self._mmap.find(needle, start, end)
+        while pos != -1:
+            found += 1
+            pos = self._mmap.find(needle, pos + len(needle), end)
+        return found
+
+    def doc_length(self, doc_id: int) -> int:
+        return self._lengths[self.blob_id(doc_id)]
+
+    def document_frequency(self, token: bytes) -> int:
+        key = token_hash(token)
+        pos = bisect_left(self._token_keys, key)
+        if pos == len(self._token_keys) or self._token_keys[pos] != key:
+            return 0
+        return self._token_dfs[pos]
+
+    @property
+    def num_symbols(self) -> int:
+        return self._num_symbols
+
+    def symbol_name(self, pos: int) -> bytes:
+        base = pos * SYMBOL_FIELDS
+        return bytes(self._bytes(self._symbols[base], self._symbols[base + 1]))
+
+    def symbol(self, pos: int) -> Tuple[int, int, int]:
+        base = pos * SYMBOL_FIELDS
+        packed = self._symbols[base + 3]
+        return self._symbols[base + 2], packed >> 8, packed & 0xff
+
+    def vocabulary(self) -> Iterator[Tuple[bytes, int]]:
+        words = self._words
+        for base in range(0, len(words), WORD_FIELDS):
+            yield bytes(self._bytes(words[base], words[base + 1])), words[base + 2]
+
+
+def manifest_path(directory: str) -> str:
+    return os.path.join(directory, MANIFEST)
+
+
+def open_index(directory: str, cache: Optional[Dict[str, DiskSegment]] = None) -> Optional[CodeIndex]:
+    """Open the persisted index in directory, or return None if there is none
+
+    Segments already mapped in cache are reused, so reopening after a small
+    commit only maps the segments that are new.
+    """
+    path = manifest_path(directory)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    cache = cache if cache is not None else {}
+    segments = []
+    tombstones = {}
+    for entry in manifest['segments']:
+        name = entry['name']
+        segment = cache.get(name)
+        if segment is None:
+            segment = cache[name] = DiskSegment(os.path.join(directory, name))
+        segments.append(segment)
+        if entry.get('deleted'):
+            tombstones[name] = set(entry['deleted'])
+    return CodeIndex(segments, manifest['repositories'], tombstones, manifest.get('generation', 0))
+
+
+def write_manifest(index: CodeIndex, directory: str):
+    """Atomically publish the segment list, tombstones and repositories of a snapshot"""
+    manifest = {
+        "generation": index.generation,
+        "segments": [
+            {"name": segment.name, "deleted": sorted(index.tombstones.get(segment.name, ()))}
+            for segment in index.segments
+        ],
+        "repositories": index.repositories,
+    }
+    tmp_path = manifest_path(directory) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path(directory))
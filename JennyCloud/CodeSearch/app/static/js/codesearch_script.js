@@ -7,7 +7,7 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Update search when filters change
     document.addEventListener('change', function(e) {
-        if (e.target.matches('input[name="filetype"]')) {
+        if (e.target.matches('input[name="filetype"], input[name="regex"], input[name="fuzzy"], input[name="stream"]')) {
             triggerSearch();
         }
     });
@@ -26,6 +26,13 @@ document.addEventListener('DOMContentLoaded', function() {
             // Trigger search with selected repo
             triggerSearch();
         }
+        
+        // Run the suggested spelling of a query that found nothing
+        if (e.target.matches('.did-you-mean')) {
+            e.preventDefault();
+            document.getElementById('search-input').value = e.target.dataset.query;
+            triggerSearch();
+        }
     });
     
     // Handle theme toggle
@@ -88,6 +95,22 @@ function triggerSearch() {
         repo: repoFilter
     });
     
+    const regexToggle = document.getElementById('regex-toggle');
+    if (regexToggle && regexToggle.checked) {
+        params.set('regex', '1');
+    }
+    
+    const fuzzyToggle = document.getElementById('fuzzy-toggle');
+    if (fuzzyToggle && fuzzyToggle.checked) {
+        params.set('fuzzy', '1');
+    }
+    
+    const streamToggle = document.getElementById('stream-toggle');
+    if (streamToggle && streamToggle.checked) {
+        streamSearch(params);
+        return;
+    }
+    
     // Trigger HTMX request
     htmx.ajax('GET', `/search?${params.toString()}`, {
         target: '#search-results',
@@ -95,6 +118,47 @@ function triggerSearch() {
     });
 }
 
+let activeStream = null;
+
+// Render result cards as the server finds them instead of waiting for the full list
+function streamSearch(params) {
+    if (activeStream) {
+        activeStream.close();
+    }
+    
+    const results = document.getElementById('search-results');
+    results.innerHTML = '';
+    params.set('format', 'sse');
+    
+    const source = new EventSource(`/search/stream?${params.toString()}`);
+    activeStream = source;
+    
+    const append = function(e) {
+        results.insertAdjacentHTML('beforeend', e.data);
+        const card = results.lastElementChild;
+        if (card) {
+            card.querySelectorAll('pre code').forEach(block => {
+                hljs.highlightElement(block);
+            });
+        }
+    };
+    
+    source.addEventListener('result', append);
+    source.addEventListener('total', append);
+    source.addEventListener('done', () => source.close());
+    // Do not let the browser reconnect and replay the search
+    source.onerror = () => source.close();
+}
+
+// The search box itself also streams when streaming is enabled
+document.addEventListener('htmx:beforeRequest', function(e) {
+    const streamToggle = document.getElementById('stream-toggle');
+    if (e.target.id === 'search-input' && streamToggle && streamToggle.checked) {
+        e.preventDefault();
+        triggerSearch();
+    }
+});
+
 function getWelcomeMessage() {
     return `
         <div class="welcome-message">
@@ -107,7 +171,10 @@ function getWelcomeMessage() {
                     <li>Use <code>function:name</code> to search for specific functions</li>
                     <li>Use <code>class:name</code> to find class definitions</li>
                     <li>Use <code>file:name</code> to search by filename</li>
+                    <li>Use <code>def:Name</code> for any definition or <code>sym:Pre</code> to match definitions by prefix</li>
                     <li>Use quotes for exact matches: <code>"exact phrase"</code></li>
+                    <li>Narrow with <code>repo:name</code>, <code>lang:python</code> or <code>path:src</code></li>
+                    <li>Combine terms with <code>OR</code> and exclude with <code>-term</code></li>
                 </ul>
             </div>
         </div>
@@ -0,0 +1,146 @@
+import ast
+import re
+from typing import List, Optional, Tuple
+
+SYMBOL_KINDS = ('class', 'function', 'method', 'interface', 'type', 'enum')
+KIND_IDS = {kind: i for i, kind in enumerate(SYMBOL_KINDS)}
+CLASS_KINDS = frozenset(KIND_IDS[kind] for kind in ('class', 'interface', 'type', 'enum'))
+FUNCTION_KINDS = frozenset(KIND_IDS[kind] for kind in ('function', 'method'))
+
+JS_TYPES = frozenset(('js', 'jsx', 'mjs', 'cjs', 'ts', 'tsx'))
+TS_TYPES = frozenset(('ts', 'tsx'))
+
+JS_TOKEN = re.compile(r'''
+      (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+    | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?|`(?:[^`\\]|\\.)*`?)
+    | (?P<name>[A-Za-z_$][\w$]*)
+    | (?P<punct>=>|[{}()=;:])
+''', re.S | re.X)
+
+# Names followed by ( in a class body that are not method definitions
+JS_NOT_METHODS = frozenset(('if', 'for', 'while', 'switch', 'catch', 'function', 'return', 'super', 'await'))
+
+Symbol = Tuple[str, int, str]
+
+
+def _python_symbols(content: str) -> List[Symbol]:
+    # Deeply nested code is valid Python the parser still gives up on
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return []
+
+    symbols: List[Symbol] = []
+    # Walked with an explicit stack, since a tree the parser managed can still be too deep to recurse
+    stack = [(tree, False)]
+    while stack:
+        node, in_class = stack.pop()
+        if isinstance(node, ast.ClassDef):
+            symbols.append((node.name, node.lineno, 'class'))
+            in_class = True
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbols.append((node.name, node.lineno, 'method' if in_class else 'function'))
+            in_class = False
+        stack.extend((child, in_class) for child in reversed(list(ast.iter_child_nodes(node))))
+    return symbols
+
+
+def _js_tokens(content: str) -> List[Tuple[str, str, int]]:
+    """Names and structural punctuation with their 1-based lines; comments and strings dropped"""
+    tokens = []
+    line = 1
+    pos = 0
+    for match in JS_TOKEN.finditer(content):
+        line += content.count('\n', pos, match.start())
+        pos = match.start()
+        kind = match.lastgroup
+        if kind in ('name', 'punct'):
+            tokens.append((kind, match.group(), line))
+    return tokens
+
+
+def _js_symbols(content: str, typescript: bool) -> List[Symbol]:
+    tokens = _js_tokens(content)
+    symbols: List[Symbol] = []
+    depth = 0
+    class_depths: List[int] = []
+    pending_class = False
+
+    def value(i: int) -> Optional[str]:
+        return tokens[i][1] if i < len(tokens) else None
+
+    def is_name(i: int) -> bool:
+        return i < len(tokens) and tokens[i][0] == 'name'
+
+    def arrow_or_function(i: int) -> bool:
+        # i points just past "=": async? (function | name => | (...) =>)
+        if value(i) == 'async':
+            i += 1
+        if value(i) == 'function':
+            return True
+        if is_name(i) and value(i + 1) == '=>':
+            return True
+        if value(i) == '(':
+            nesting = 0
+            while i < len(tokens):
+                if value(i) == '(':
+                    nesting += 1
+                elif value(i) == ')':
+                    nesting -= 1
+                    if nesting == 0:
+                        break
+                i += 1
+            if typescript and value(i + 1) == ':':
+                # Return type annotation between ) and =>
+                i += 2
+                while is_name(i):
+                    i += 1
+                return value(i) == '=>'
+            return value(i + 1) == '=>'
+        return False
+
+    for i, (kind, text, line) in enumerate(tokens):
+        if text == '{':
+            depth += 1
+            if pending_class:
+                class_depths.append(depth)
+                pending_class = False
+            continue
+        if text == '}':
+            if class_depths and class_depths[-1] == depth:
+                class_depths.pop()
+            depth -= 1
+            continue
+        if kind != 'name':
+            continue
+
+        in_class_body = bool(class_depths) and class_depths[-1] == depth
+        if text == 'class' and is_name(i + 1):
+            symbols.append((value(i + 1), tokens[i + 1][2], 'class'))
+            pending_class = True
+        elif text == 'function' and is_name(i + 1):
+            symbols.append((value(i + 1), tokens[i + 1][2], 'function'))
+        elif text in ('const', 'let', 'var') and is_name(i + 1) and value(i + 2) == '=' and arrow_or_function(i + 3):
+            symbols.append((value(i + 1), tokens[i + 1][2], 'function'))
+        elif typescript and text in ('interface', 'enum') and is_name(i + 1):
+            symbols.append((value(i + 1), tokens[i + 1][2], text))
+        elif typescript and text == 'type' and is_name(i + 1) and value(i + 2) == '=':
+            symbols.append((value(i + 1), tokens[i + 1][2], 'type'))
+        elif in_class_body and text not in JS_NOT_METHODS:
+            if value(i + 1) == '(' or (value(i + 1) == '=' and arrow_or_function(i + 2)):
+                symbols.append((text, line, 'method'))
+    return symbols
+
+
+def extract_symbols(file_type: str, content: str) -> List[Symbol]:
+    """Return the (name, line, kind) definitions of a source file, lines 1-based
+
+    Python files are parsed with ast; JavaScript and TypeScript go through a
+    lightweight tokenizer that recognizes classes, functions, arrow function
+    bindings and methods. Other file types have no symbols.
+    """
+    if file_type == 'py':
+        return _python_symbols(content)
+    if file_type in JS_TYPES:
+        return _js_symbols(content, file_type in TS_TYPES)
+    return []
@@ -0,0 +1,109 @@
+import base64
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+import codesearch
+import paging
+from conftest import APP_DIR
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(codesearch, "INDEX_DIR", str(tmp_path))
+    # Templates and static files are looked up relative to the app
+    monkeypatch.chdir(APP_DIR)
+    with TestClient(codesearch.app) as client:
+        yield client
+
+
+def cursor_for(payload) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def read_cursor(cursor: str):
+    return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+
+
+def test_importing_the_app_writes_nothing(tmp_path):
+    index_dir = tmp_path / 'index'
+    env = dict(os.environ, CODESEARCH_INDEX_DIR=str(index_dir))
+    subprocess.run([sys.executable, '-c', 'import codesearch'], cwd=APP_DIR, env=env, check=True)
+    assert not index_dir.exists()
+
+
+def test_pages_follow_cursors(client):
+    first = client.get('/api/search', params={'q': 'def', 'limit': 1}).json()
+    assert len(first['results']) == 1
+    second = client.get('/api/search', params={'q': 'def', 'limit': 1, 'cursor': first['next_cursor']})
+    assert second.status_code == 200
+    assert second.json()['results'] != first['results']
+
+
+def test_deeper_pages_reuse_the_candidates_of_the_first(client, monkeypatch):
+    lookups = []
+    original = paging.segment_candidates
+
+    def counted(segment, *args):
+        lookups.append(segment.name)
+        return original(segment, *args)
+
+    monkeypatch.setattr(paging, 'segment_candidates', counted)
+    page = client.get('/api/search', params={'q': 'def', 'limit': 1}).json()
+    segments = len(codesearch.backend.indexer.refresh().segments)
+    # Once per segment, shared by the weights and the matches
+    assert len(lookups) == segments
+    seen = [page['results']]
+    while page['next_cursor']:
+        page = client.get('/api/search', params={'q': 'def', 'limit': 1, 'cursor': page['next_cursor']}).json()
+        seen.append(page['results'])
+    assert len(seen) > 2
+    assert len(lookups) == segments
+
+
+@pytest.mark.parametrize('position', [
+    5,
+    [1, 2],
+    None,
+    {'segment': 1, 'doc': 0, 'weights': []},
+    {'segment': 'segment-x', 'doc': 'x', 'weights': []},
+    {'segment': 'segment-x', 'doc': 0, 'weights': ['a']},
+])
+def test_misshapen_cursor_positions_are_rejected(client, position):
+    fingerprint = read_cursor(client.get('/api/search', params={'q': 'def', 'limit': 1}).json()['next_cursor'])['q']
+    response = client.get('/api/search', params={'q': 'def', 'limit': 1,
+                                                 'cursor': cursor_for({'q': fingerprint, 'p': position})})
+    assert response.status_code == 400
+
+
+def test_cursor_weights_must_fit_the_query(client):
+    cursor = read_cursor(client.get('/api/search', params={'q': 'def', 'limit': 1}).json()['next_cursor'])
+    cursor['p']['weights'] = cursor['p']['weights'] * 3
+    response = client.get('/api/search', params={'q': 'def', 'limit': 1, 'cursor': cursor_for(cursor)})
+    assert response.status_code == 400
+
+
+def test_cursor_of_another_search_is_rejected(client):
+    cursor = client.get('/api/search', params={'q': 'def', 'limit': 1}).json()['next_cursor']
+    response = client.get('/api/search', params={'q': 'class', 'limit': 1, 'cursor': cursor})
+    assert response.status_code == 400
+
+
+def test_client_supplied_names_are_escaped(client):
+    path = '<img src=x onerror=alert(1)>.py'
+    ingest = {'description': '<script>alert(2)</script>', 'files': [{'path': path, 'content': 'escapeprobe = 1\n'}]}
+    assert client.put('/repositories/"><b onclick=alert(3)>repo', json=ingest).status_code == 200
+
+    results = client.get('/search', params={'q': 'escapeprobe'}).text
+    assert '&lt;img src=x onerror=alert(1)&gt;.py' in results
+    assert '&quot;&gt;&lt;b onclick=alert(3)&gt;repo' in results
+    assert '<img' not in results
+
+    repositories = client.get('/repositories').text
+    assert 'data-repo="&quot;&gt;&lt;b onclick=alert(3)&gt;repo"' in repositories
+    assert '&lt;script&gt;alert(2)&lt;/script&gt;' in repositories
+    assert '<script>' not in repositories and '<b ' not in repositories
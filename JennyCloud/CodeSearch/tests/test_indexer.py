@@ -0,0 +1,124 @@
+import pytest
+
+from indexer import Indexer
+from search_index import MemorySegment
+from segment_store import DiskSegment, open_index, write_segment
+
+FILES = [
+    ("api", "src/client.py", "py", "def fetch_user(user_id):\n    return get('/users/%s' % user_id)\n"),
+    ("api", "src/server.js", "js", "function handleRequest(req) {\n  return fetchUser(req.id);\n}\n"),
+    ("web", "app/main.py", "py", "class Handler:\n    def fetch(self):\n        pass\n"),
+    ("web", "app/dup.py", "py", "class Handler:\n    def fetch(self):\n        pass\n"),
+]
+
+
+def search_paths(index, query, **filters):
+    return sorted(indexed.path for indexed in index.search(query, **filters))
+
+
+def test_segment_round_trip(tmp_path):
+    memory = MemorySegment()
+    for repository, path, file_type, content in FILES:
+        memory.add_file(repository, path, file_type, content)
+    write_segment(memory, str(tmp_path / memory.name))
+    disk = DiskSegment(str(tmp_path / memory.name))
+
+    assert disk.name == memory.name
+    assert disk.num_files == memory.num_files
+    # Identical bodies are stored once
+    assert disk.num_blobs == memory.num_blobs == 3
+    assert disk.total_tokens == memory.total_tokens
+    for doc_id, (repository, path, file_type, content) in enumerate(FILES):
+        indexed = disk.file(doc_id)
+        assert (indexed.repository, indexed.path, indexed.file_type, indexed.content) == \
+            (repository, path, file_type, content)
+        assert disk.file_key(doc_id) == (repository, path)
+        assert list(disk.line_offsets(doc_id)) == list(memory.line_offsets(doc_id))
+        assert disk.doc_length(doc_id) == memory.doc_length(doc_id)
+    assert sorted(disk.filter_ids('repo', 'web')) == [2, 3]
+    assert sorted(disk.candidates('fetch')) == sorted(memory.candidates('fetch'))
+    assert sorted(disk.vocabulary()) == sorted(memory.vocabulary())
+    assert [disk.symbol_name(pos) for pos in range(disk.num_symbols)] == \
+        [memory.symbol_name(pos) for pos in range(memory.num_symbols)]
+
+
+def test_batch_commits_a_new_generation(tmp_path):
+    indexer = Indexer(str(tmp_path))
+    with indexer.batch() as batch:
+        for repository, path, file_type, content in FILES:
+            batch.upsert_file(repository, path, file_type, content)
+    index = indexer.refresh()
+    assert index.generation == 1
+    assert index.num_files == 4
+    assert search_paths(index, 'handleRequest') == ['src/server.js']
+
+    # Another process sees the same snapshot on disk
+    reopened = open_index(str(tmp_path))
+    assert reopened.generation == 1
+    assert search_paths(reopened, 'fetch_user') == ['src/client.py']
+
+
+def test_sync_repository_touches_only_changes(tmp_path):
+    indexer = Indexer(str(tmp_path))
+    with indexer.batch() as batch:
+        for repository, path, file_type, content in FILES:
+            batch.upsert_file(repository, path, file_type, content)
+    with indexer.batch() as batch:
+        stats = batch.sync_repository("api", [
+            {"path": "src/client.py", "content": FILES[0][3]},
+            {"path": "src/new.py", "content": "def added(): pass\n"},
+        ])
+    assert stats == {"added": 1, "updated": 0, "unchanged": 1, "deleted": 1}
+    index = indexer.refresh()
+    assert search_paths(index, 'handleRequest') == []
+    assert search_paths(index, 'added') == ['src/new.py']
+    assert index.num_files == 4
+
+
+def test_failed_batch_leaves_the_live_snapshot_alone(tmp_path):
+    indexer = Indexer(str(tmp_path))
+    with indexer.batch() as batch:
+        batch.upsert_file(*FILES[0])
+    before = indexer.refresh()
+    locations = dict(before.locations())
+
+    with pytest.raises(RuntimeError):
+        with indexer.batch() as batch:
+            batch.upsert_file("api", "src/client.py", "py", "changed\n")
+            batch.delete_file("api", "src/client.py")
+            batch.upsert_file(*FILES[1])
+            raise RuntimeError("ingest failed")
+
+    index = indexer.refresh()
+    assert index is before
+    assert index.generation == 1
+    assert index.locations() == locations
+    assert search_paths(index, 'fetch_user') == ['src/client.py']
+
+
+def test_merge_keeps_live_files_and_deletes(tmp_path):
+    indexer = Indexer(str(tmp_path), merge_factor=2)
+    for repository, path, file_type, content in FILES:
+        with indexer.batch() as batch:
+            batch.upsert_file(repository, path, file_type, content)
+    with indexer.batch() as batch:
+        batch.delete_file("web", "app/dup.py")
+    before = indexer.refresh()
+    before_locations = dict(before.locations())
+    segments = len(before.segments)
+
+    assert indexer.merge_all() > 0
+    index = indexer.refresh()
+    assert len(index.segments) < segments
+    assert index.num_files == 3
+    assert search_paths(index, 'class Handler') == ['app/main.py']
+    assert set(index.locations()) == {("api", "src/client.py"), ("api", "src/server.js"), ("web", "app/main.py")}
+    # The previous snapshot still resolves its own segments
+    assert before.locations() == before_locations
+
+    # Edits after a merge replace the merged copy
+    with indexer.batch() as batch:
+        assert batch.upsert_file("web", "app/main.py", "py", "class Renamed:\n    pass\n")
+    index = indexer.refresh()
+    assert search_paths(index, 'class Handler') == []
+    assert search_paths(index, 'Renamed') == ['app/main.py']
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from regex_search import MAX_LINE_LENGTH, RegexError, compile_regex, regex_top_k
+from search_index import CodeIndex, MemorySegment
+
+
+@pytest.mark.parametrize('pattern', [
+    r'(a|a)*b',
+    r'(\w|\w)*!',
+    r'\w*\w*\w*\w*\w*!',
+    r'(a+)+b',
+    r'foo(x\w?)*!',
+    r'foo\w*x\w*!',
+    r'foo(\w*){20}!',
+    r'(?:ab|a)*abc',
+])
+def test_rejects_catastrophic_backtracking(pattern):
+    with pytest.raises(RegexError):
+        compile_regex(pattern)
+
+
+@pytest.mark.parametrize('pattern', [r'\w+', r'[a-z]+!', r'.*'])
+def test_rejects_patterns_without_a_trigram_prefilter(pattern):
+    with pytest.raises(RegexError, match='three characters'):
+        compile_regex(pattern)
+
+
+@pytest.mark.parametrize('pattern', [
+    r'fetch\w+\(',
+    r'class \w+Handler',
+    r'foo.*bar',
+    r'(foo|bar)+baz',
+    r'import\s+\w+',
+    r'foo\d{1,3}\.\d{1,3}',
+    r'https?://\S+',
+])
+def test_accepts_common_patterns(pattern):
+    assert not compile_regex(pattern).plan.matches_all
+
+
+@pytest.mark.parametrize('pattern, line', [
+    (r'foo.*bar', 'foo' * 40000),
+    (r'(foo|bar)+baz', 'foobar' * 20000),
+    (r'fetch\w+\(', 'fetch' * 40000),
+])
+def test_accepted_patterns_match_long_lines_quickly(pattern, line):
+    compiled = compile_regex(pattern).pattern
+    started = time.perf_counter()
+    compiled.search(line, 0, MAX_LINE_LENGTH)
+    assert time.perf_counter() - started < 1.0
+
+
+def test_invalid_pattern():
+    with pytest.raises(RegexError, match='Invalid'):
+        compile_regex('foo(')
+
+
+def test_matches_past_the_line_bound_mark_the_results_partial():
+    segment = MemorySegment()
+    segment.add_file('web', 'near.min.js', 'js', 'needle_early();' + 'x' * MAX_LINE_LENGTH)
+    segment.add_file('web', 'far.min.js', 'js', 'x' * MAX_LINE_LENGTH + 'needle_late();')
+    segment.add_file('web', 'short.js', 'js', 'needle_here();\n')
+    index = CodeIndex([segment])
+
+    total, hits, partial = regex_top_k(index, compile_regex(r'needle_\w+\('))
+    assert sorted(indexed.path for _, indexed in hits) == ['near.min.js', 'short.js']
+    assert partial
+
+    # Long lines that match within the bound leave nothing unsearched
+    total, hits, partial = regex_top_k(index, compile_regex(r'needle_early\('))
+    assert total == 1 and not partial
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import pytest
+
+from search_backend import CODE_TABLE, BackendError, HttpConnectionPool, ManticoreBackend, document_id
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def serve(handler):
+    server = await asyncio.start_server(handler, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def read_request(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = int([line for line in head.split(b'\r\n') if line.lower().startswith(b'content-length')][0].split(b':')[1])
+    return head, await reader.readexactly(length)
+
+
+def test_pool_reuses_connections_that_answered_in_full():
+    async def scenario():
+        connections = []
+
+        async def handler(reader, writer):
+            connections.append(writer)
+            while True:
+                try:
+                    await read_request(reader)
+                except asyncio.IncompleteReadError:
+                    return
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+                await writer.drain()
+
+        server, port = await serve(handler)
+        pool = HttpConnectionPool('127.0.0.1', port, size=1)
+        for _ in range(3):
+            assert await pool.request('POST', '/search') == (200, b'{}')
+        await pool.close()
+        server.close()
+        return len(connections)
+
+    assert run(scenario()) == 1
+
+
+def test_pool_drops_a_connection_whose_response_broke_off():
+    async def scenario():
+        connections = []
+
+        async def handler(reader, writer):
+            connections.append(writer)
+            await read_request(reader)
+            if len(connections) == 1:
+                # Promise more body than is sent, then stall
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n{"partial"')
+                await writer.drain()
+                await asyncio.sleep(1)
+                return
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}')
+            await writer.drain()
+
+        server, port = await serve(handler)
+        pool = HttpConnectionPool('127.0.0.1', port, size=1, timeout=0.2)
+        with pytest.raises(BackendError):
+            await pool.request('POST', '/search')
+        # The next request must not read the rest of the broken response
+        assert await pool.request('POST', '/search') == (200, b'{}')
+        await pool.close()
+        server.close()
+        return len(connections)
+
+    assert run(scenario()) == 2
+
+
+class RecordingManticore(ManticoreBackend):
+    """Manticore backend answering from a dict of stored documents instead of a server"""
+
+    def __init__(self, documents):
+        super().__init__()
+        self._tables_ready = True
+        self.documents = documents
+        self.operations = []
+
+    async def _json(self, path, payload):
+        assert path == '/search'
+        hits = [{"_id": str(doc_id), "_source": doc} for doc_id, doc in sorted(self.documents.items())]
+        return {"hits": {"hits": hits}}
+
+    async def _bulk(self, operations):
+        self.operations.extend(operations)
+
+
+def test_manticore_sync_replaces_in_place_and_reports_local_stats():
+    documents = {
+        document_id("api", "keep.py"): {"path": "keep.py", "file_type": "py", "content": "same\n"},
+        document_id("api", "edit.py"): {"path": "edit.py", "file_type": "py", "content": "old\n"},
+        document_id("api", "gone.py"): {"path": "gone.py", "file_type": "py", "content": "gone\n"},
+    }
+    backend = RecordingManticore(documents)
+    stats = run(backend.index_repository("api", [
+        {"path": "keep.py", "content": "same\n"},
+        {"path": "edit.py", "content": "new\n"},
+        {"path": "new.py", "content": "added\n"},
+    ]))
+    assert stats == {"added": 1, "updated": 1, "unchanged": 1, "deleted": 1}
+
+    kinds = [next(iter(op)) for op in backend.operations]
+    # Nothing is deleted wholesale, and stale files go only after the new ones are in
+    assert kinds == ["replace", "replace", "replace", "delete"]
+    replaced = {op["replace"]["doc"]["path"] for op in backend.operations[1:3]}
+    assert replaced == {"edit.py", "new.py"}
+    assert backend.operations[3] == {"delete": {"index": CODE_TABLE, "id": document_id("api", "gone.py")}}
+
+
+def test_manticore_sync_keeps_missing_files_without_replace():
+    documents = {document_id("api", "gone.py"): {"path": "gone.py", "file_type": "py", "content": "gone\n"}}
+    backend = RecordingManticore(documents)
+    stats = run(backend.index_repository("api", [], replace=False))
+    assert stats == {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+    assert all("delete" not in op for op in backend.operations)
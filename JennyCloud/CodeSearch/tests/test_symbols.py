@@ -0,0 +1,33 @@
+from symbols import _python_symbols, extract_symbols
+
+
+def test_python_definitions_in_source_order():
+    source = "class B:\n    class C:\n        def d(self): pass\n    def e(self): pass\n\nasync def f(): pass\n"
+    assert _python_symbols(source) == [
+        ('B', 1, 'class'), ('C', 2, 'class'), ('d', 3, 'method'), ('e', 4, 'method'), ('f', 6, 'function'),
+    ]
+
+
+def test_nested_function_in_method_is_a_function():
+    source = "class A:\n    def m(self):\n        def inner(): pass\n"
+    assert _python_symbols(source) == [('A', 1, 'class'), ('m', 2, 'method'), ('inner', 3, 'function')]
+
+
+def test_malformed_python_has_no_symbols():
+    assert _python_symbols("def f(:\n") == []
+    assert _python_symbols("x = 1\0") == []
+
+
+def test_deeply_nested_python_has_no_symbols():
+    # Valid Python the parser runs out of stack on
+    assert _python_symbols("def f(): pass\nx = " + " + ".join(["a"] * 3000)) == []
+    assert _python_symbols("x = " + "(" * 1000 + "1" + ")" * 1000) == []
+
+
+def test_javascript_definitions():
+    source = "class Store {\n  load() {}\n}\nfunction save() {}\nconst run = () => 1;\n"
+    names = [(name, kind) for name, _, kind in extract_symbols('js', source)]
+    assert ('Store', 'class') in names
+    assert ('load', 'method') in names
+    assert ('save', 'function') in names
+    assert ('run', 'function') in names
@@ -0,0 +1,106 @@
+import asyncio
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from notes_store import NoteEdit, NotesStore, note_key
+
+# Seconds an edit may wait in memory before it is written
+FLUSH_INTERVAL = 1.0
+# Notes with pending edits that trigger a flush without waiting for the interval
+MAX_PENDING = 500
+
+
+class WriteBehindBuffer:
+    """Coalesces note edits in memory and writes them in per-partition batches
+
+    Only the latest content and color of a note are kept, so a burst of
+    autosaves from fast typing costs one write per flush. Reads pass their
+    notes through overlay() to see edits that are not written yet.
+    """
+
+    def __init__(self, store: NotesStore, interval: float = FLUSH_INTERVAL, max_pending: int = MAX_PENDING):
+        self.store = store
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: Dict[uuid.UUID, NoteEdit] = {}
+        # Edits taken by the flush in progress, still visible to reads until written
+        self.in_flight: Dict[uuid.UUID, NoteEdit] = {}
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._early: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._timer = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Notes autosave flush failed, retrying: {e}")
+
+    def stage(self, note_id: uuid.UUID, content: Optional[str] = None, color: Optional[str] = None,
+              now: Optional[datetime] = None):
+        """Record an edit; raises ValueError for ids that cannot name a note
+
+        Times are naive UTC, like the creation times note ids carry.
+        """
+        note_key(note_id)
+        edit = NoteEdit(now or datetime.utcnow(), content, color)
+        previous = self.pending.get(note_id)
+        self.pending[note_id] = previous.merge(edit) if previous else edit
+        if len(self.pending) >= self.max_pending and (self._early is None or self._early.done()):
+            self._early = asyncio.create_task(self.flush())
+            self._early.add_done_callback(self._flushed_early)
+
+    def _flushed_early(self, task: asyncio.Task):
+        # Nothing awaits the early flush; its edits stay pending for the timer to retry
+        if not task.cancelled() and task.exception():
+            print(f"Notes autosave flush failed, retrying: {task.exception()}")
+
+    async def flush(self):
+        """Write every pending edit; edits that fail stay pending under any newer ones"""
+        async with self._lock:
+            if not self.pending:
+                return
+            edits, self.pending = self.pending, {}
+            self.in_flight = edits
+            try:
+                await self.store.apply_edits(edits)
+            except Exception:
+                for note_id, edit in edits.items():
+                    newer = self.pending.get(note_id)
+                    self.pending[note_id] = edit.merge(newer) if newer else edit
+                raise
+            finally:
+                self.in_flight = {}
+
+    async def discard(self, note_id: uuid.UUID):
+        """Drop the edits of a note about to be deleted, so no flush recreates its row"""
+        self.pending.pop(note_id, None)
+        # A flush already writing the note has to land before the delete does
+        async with self._lock:
+            self.pending.pop(note_id, None)
+
+    def overlay(self, note: Dict[str, Any]) -> Dict[str, Any]:
+        """Apply the unwritten edits of a note to a note record read from the store"""
+        note_id = uuid.UUID(note['id'])
+        for edits in (self.in_flight, self.pending):
+            edit = edits.get(note_id)
+            if edit is None:
+                continue
+            if edit.content is not None:
+                note['content'] = edit.content
+            if edit.color is not None:
+                note['color'] = edit.color
+            note['updated_at'] = edit.updated_at
+        return note
+
+    async def close(self):
+        """Stop the flush timer and write whatever is still pending"""
+        for task in (self._timer, self._early):
+            if task is not None:
+                task.cancel()
+        await self.flush()
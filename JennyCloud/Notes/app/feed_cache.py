@@ -0,0 +1,200 @@
+import json
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from hashlib import blake2b
+from typing import Dict, Optional
+
+DEFAULT_TTL = 30.0
+DEFAULT_MAX_PAGES = 256
+# Key of the newest page, the only one a share changes
+FIRST_PAGE = ''
+
+
+@dataclass
+class FeedPage:
+    """A rendered page of the public feed with its HTTP validators"""
+    html: str
+    etag: str
+    # Unix time of the newest share on the page, whole seconds like the header
+    last_modified: int
+
+    def headers(self) -> Dict[str, str]:
+        return {
+            "ETag": self.etag,
+            "Last-Modified": format_datetime(datetime.fromtimestamp(self.last_modified, timezone.utc), usegmt=True),
+            # Browsers keep the page but revalidate it on every visit
+            "Cache-Control": "no-cache",
+        }
+
+    def not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        """Whether the request's conditional headers show the client already has this page"""
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags or 'W/' + self.etag in tags
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return since is not None and since.timestamp() >= self.last_modified
+        return False
+
+
+def render_page(html: str, last_modified: Optional[datetime]) -> FeedPage:
+    """Build a feed page, tagging it with a hash of its HTML so every worker agrees on the ETag"""
+    etag = '"%s"' % blake2b(html.encode('utf-8'), digest_size=16).hexdigest()
+    seconds = int((last_modified - datetime(1970, 1, 1)).total_seconds()) if last_modified else 0
+    return FeedPage(html, etag, seconds)
+
+
+class FeedBackend:
+    """Where rendered feed pages are kept between requests
+
+    The backend also holds the feed version, bumped by every share, so a
+    page rendered before a share is refused by whichever process stores it.
+    """
+
+    async def get(self, key: str) -> Optional[FeedPage]:
+        raise NotImplementedError
+
+    async def version(self) -> int:
+        raise NotImplementedError
+
+    async def put(self, key: str, version: int, page: FeedPage):
+        """Store a page, unless the feed has moved past the version it was rendered at"""
+        raise NotImplementedError
+
+    async def invalidate(self, key: str):
+        """Bump the version and drop the page that a share changed"""
+        raise NotImplementedError
+
+
+class MemoryFeedBackend(FeedBackend):
+    """LRU of feed pages in this process
+
+    Shares made through other workers are not seen here, so entries expire
+    after the TTL to bound how stale the feed can get.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_pages: int = DEFAULT_MAX_PAGES):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._version = 0
+        self._pages: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[FeedPage]:
+        entry = self._pages.get(key)
+        if entry is None:
+            return None
+        expires, page = entry
+        if time.monotonic() > expires:
+            del self._pages[key]
+            return None
+        self._pages.move_to_end(key)
+        return page
+
+    async def version(self) -> int:
+        return self._version
+
+    async def put(self, key: str, version: int, page: FeedPage):
+        if version != self._version:
+            return
+        self._pages[key] = (time.monotonic() + self.ttl, page)
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.max_pages:
+            self._pages.popitem(last=False)
+
+    async def invalidate(self, key: str):
+        self._version += 1
+        self._pages.pop(key, None)
+
+
+# Stores a page only while the version key still holds the version it was rendered at
+PUT_IF_CURRENT = """
+if (redis.call('GET', KEYS[1]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class RedisFeedBackend(FeedBackend):
+    """Feed pages in Redis, shared by every worker so one share invalidates them all
+
+    The version is a Redis counter, and pages are stored by a script that
+    compares it first, so a worker that rendered before another worker's
+    share cannot write its stale page back.
+    """
+
+    def __init__(self, url: str, ttl: float = DEFAULT_TTL, prefix: str = 'notes:feed:'):
+        # Only needed when this backend is selected
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.version_key = prefix + 'version'
+        self._put_if_current = self.client.register_script(PUT_IF_CURRENT)
+
+    async def get(self, key: str) -> Optional[FeedPage]:
+        data = await self.client.get(self.prefix + key)
+        return FeedPage(**json.loads(data)) if data else None
+
+    async def version(self) -> int:
+        return int(await self.client.get(self.version_key) or 0)
+
+    async def put(self, key: str, version: int, page: FeedPage):
+        await self._put_if_current(keys=[self.version_key, self.prefix + key],
+                                   args=[version, json.dumps(asdict(page)), max(1, int(self.ttl))])
+
+    async def invalidate(self, key: str):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.incr(self.version_key)
+            pipe.delete(self.prefix + key)
+            await pipe.execute()
+
+
+class FeedCache:
+    """Rendered public feed pages, keyed by cursor
+
+    A share only adds a note to the top of the feed. Later pages resume
+    after fixed rows and do not change, so only the first page is dropped.
+    Renders read the version before the feed; the backend refuses pages
+    whose version a share has since bumped.
+    """
+
+    def __init__(self, backend: FeedBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[FeedPage]:
+        page = await self.backend.get(key)
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    async def version(self) -> int:
+        return await self.backend.version()
+
+    async def put(self, key: str, version: int, page: FeedPage):
+        """Store a page rendered from the feed as it was at the given version"""
+        await self.backend.put(key, version, page)
+
+    async def shared(self):
+        """Account for a note added to the feed"""
+        await self.backend.invalidate(FIRST_PAGE)
+
+    async def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "version": await self.backend.version(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
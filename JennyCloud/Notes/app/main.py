@@ -1,12 +1,18 @@
 from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from cassandra.cluster import Cluster
-from cassandra.auth import PlainTextAuthProvider
+from autosave import WriteBehindBuffer
+from feed_cache import FeedCache, MemoryFeedBackend, RedisFeedBackend, render_page
+from note_events import NoteEvents
+from note_search import NoteIndex
+from notes_store import MemoryNotesStore, NotesStore, Position, note_id_at, note_key, run_bounded
+import asyncio
+import base64
+import binascii
 import uuid
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 import json
 import os
 
@@ -16,95 +22,283 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# ScyllaDB connection
-def get_db_session():
-    # Configure for local ScyllaDB - adjust for your setup
-    cluster = Cluster(['127.0.0.1'], port=9042)
-    session = cluster.connect()
-    
-    # Create keyspace if not exists
-    session.execute("""
-        CREATE KEYSPACE IF NOT EXISTS jennycloud 
-        WITH replication = {'class': 'SimpleStrategy', 'replication_factor': 1}
-    """)
-    
-    session.set_keyspace('jennycloud')
-    
-    # Create tables if not exist
-    session.execute("""
-        CREATE TABLE IF NOT EXISTS notes (
-            id UUID PRIMARY KEY,
-            content TEXT,
-            color TEXT,
-            is_public BOOLEAN,
-            created_at TIMESTAMP,
-            updated_at TIMESTAMP
-        )
-    """)
-    
-    session.execute("""
-        CREATE TABLE IF NOT EXISTS public_notes (
-            id UUID PRIMARY KEY,
-            content TEXT,
-            color TEXT,
-            shared_at TIMESTAMP
-        )
-    """)
-    
-    return session
-
-session = get_db_session()
+# "scylla", or "memory" to run without a database
+NOTES_STORE = os.environ.get("NOTES_STORE", "scylla")
+SCYLLA_HOSTS = os.environ.get("NOTES_SCYLLA_HOSTS", "127.0.0.1").split(",")
+SCYLLA_PORT = int(os.environ.get("NOTES_SCYLLA_PORT", "9042"))
+SCYLLA_LOCAL_DC = os.environ.get("NOTES_SCYLLA_DC") or None
+NOTES_KEYSPACE = os.environ.get("NOTES_KEYSPACE", "jennycloud")
+# Turn off with several workers and run `python scylla_store.py migrate` on deploy instead
+SCYLLA_AUTO_MIGRATE = os.environ.get("NOTES_AUTO_MIGRATE", "1") == "1"
+# Notes rendered per infinite-scroll page
+PAGE_SIZE = 30
+# Notes rendered for a search
+SEARCH_LIMIT = 50
+# Seconds between keepalives on an idle event stream, so dead boards are noticed
+EVENTS_KEEPALIVE = 15.0
+# Note writes an import keeps in flight at once
+IMPORT_WINDOW = 128
+# Longest accepted import line, in bytes
+MAX_IMPORT_LINE = 1 << 20
+# Failed import lines reported back in detail
+MAX_IMPORT_ERRORS = 20
+# Notes a single bulk request may act on
+MAX_BULK = 500
+# "memory" keeps the public feed per worker; a redis:// URL shares it between workers
+FEED_CACHE = os.environ.get("NOTES_FEED_CACHE", "memory")
+FEED_CACHE_TTL = float(os.environ.get("NOTES_FEED_CACHE_TTL", "30"))
+
+def build_store() -> NotesStore:
+    """Create the notes store selected by NOTES_STORE"""
+    if NOTES_STORE == "memory":
+        return MemoryNotesStore()
+    # The driver is only loaded when Scylla is used
+    from scylla_store import ScyllaNotesStore
+    return ScyllaNotesStore(SCYLLA_HOSTS, SCYLLA_PORT, NOTES_KEYSPACE, SCYLLA_LOCAL_DC, SCYLLA_AUTO_MIGRATE)
+
+store = build_store()
+autosave = WriteBehindBuffer(store)
+
+def build_feed_cache() -> FeedCache:
+    """Create the public feed cache selected by NOTES_FEED_CACHE"""
+    if FEED_CACHE.startswith("redis://") or FEED_CACHE.startswith("rediss://"):
+        return FeedCache(RedisFeedBackend(FEED_CACHE, FEED_CACHE_TTL))
+    return FeedCache(MemoryFeedBackend(FEED_CACHE_TTL))
+
+feed_cache = build_feed_cache()
+note_index = NoteIndex()
+note_events = NoteEvents()
+
+def encode_cursor(position: Optional[Position]) -> Optional[str]:
+    if position is None:
+        return None
+    bucket, paging_state = position
+    payload = {"b": bucket, "s": paging_state.hex() if paging_state else None}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Position]:
+    """Position a listing cursor points at; HTTP 400 for anything malformed"""
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        paging_state = bytes.fromhex(payload["s"]) if payload["s"] else None
+        if not isinstance(payload["b"], str):
+            raise ValueError("bucket")
+        return payload["b"], paging_state
+    except (binascii.Error, ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor: %s" % e)
+
+def sse_event(event: str, data: str) -> str:
+    """Format a server-sent event, one data field per line"""
+    lines = ''.join(f'data: {line}\n' for line in data.split('\n'))
+    return f'event: {event}\n{lines}\n'
+
+def publish_created(note: dict):
+    # Boards insert the rendered card as is
+    html = templates.get_template("note_card.html").render({"note": note, "editable": True})
+    note_events.publish("created", id=note['id'], html=html)
+
+async def read_bulk_ids(request: Request) -> List[str]:
+    """Distinct ids of a bulk request body, {"ids": [...]}, in order; HTTP 400 for anything else"""
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Expected a JSON body")
+    ids = payload.get("ids") if isinstance(payload, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(note_id, str) for note_id in ids):
+        raise HTTPException(status_code=400, detail='Expected {"ids": [...]}')
+    if len(ids) > MAX_BULK:
+        raise HTTPException(status_code=400, detail="At most %d notes at a time" % MAX_BULK)
+    return list(dict.fromkeys(ids))
+
+def split_bulk_ids(ids: List[str]) -> Tuple[Dict[str, uuid.UUID], Dict[str, dict]]:
+    """Valid note ids of a bulk request, and the results of the invalid ones"""
+    valid = {}
+    results = {}
+    for note_id in ids:
+        try:
+            valid[note_id] = note_key(uuid.UUID(note_id))[2]
+        except ValueError as e:
+            results[note_id] = {"id": note_id, "success": False, "error": str(e)}
+    return valid, results
+
+def export_line(note: dict) -> str:
+    fields = {key: note[key] for key in ('id', 'content', 'color', 'is_public')}
+    fields['created_at'] = note['created_at'].isoformat()
+    fields['updated_at'] = note['updated_at'].isoformat() if note['updated_at'] else None
+    return json.dumps(fields) + '\n'
+
+def parse_time(value) -> Optional[datetime]:
+    """Naive UTC time of an ISO 8601 string, None when absent"""
+    if value is None:
+        return None
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def parse_import(line: bytes) -> dict:
+    """Note record of an import line; notes without a time-based id get one for their creation time"""
+    fields = json.loads(line)
+    if not isinstance(fields, dict):
+        raise ValueError("Expected a JSON object")
+    content = fields.get('content') or ''
+    color = fields.get('color') or 'default'
+    if not isinstance(content, str) or not isinstance(color, str):
+        raise ValueError("content and color must be strings")
+    created_at = parse_time(fields.get('created_at')) or datetime.utcnow()
+    note_uuid = uuid.UUID(fields['id']) if fields.get('id') else None
+    if note_uuid is None or note_uuid.version != 1:
+        note_uuid = note_id_at(created_at)
+    return {
+        'id': str(note_uuid),
+        'content': content,
+        'color': color,
+        'is_public': bool(fields.get('is_public')),
+        'updated_at': parse_time(fields.get('updated_at')) or created_at
+    }
+
+async def ndjson_lines(chunks):
+    """Number and text of the non-blank lines of a streamed body"""
+    buffer = b''
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line
+        if len(buffer) > MAX_IMPORT_LINE:
+            raise HTTPException(status_code=413, detail="Line %d is too long" % (line_no + 1))
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+@app.on_event("startup")
+async def start_store():
+    # Connecting happens in the background; requests that arrive first wait for it
+    await store.start()
+    autosave.start()
+    asyncio.create_task(rebuild_note_index())
+
+async def rebuild_note_index():
+    """Index every stored note; notes changed meanwhile are indexed by their handlers"""
+    note_index.begin_rebuild()
+    try:
+        async for notes in store.scan_notes():
+            for note in notes:
+                note = autosave.overlay(note)
+                note_index.load(uuid.UUID(note['id']), note['content'])
+    except Exception as e:
+        print(f"Notes search index rebuild failed: {e}")
+    finally:
+        note_index.end_rebuild()
+
+@app.on_event("shutdown")
+async def close_store():
+    await autosave.close()
+    await store.close()
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.get("/notes")
-async def get_notes(request: Request):
-    rows = session.execute("SELECT * FROM notes ORDER BY created_at DESC")
-    notes = []
-    for row in rows:
-        notes.append({
-            'id': str(row.id),
-            'content': row.content,
-            'color': row.color or 'default',
-            'is_public': row.is_public or False,
-            'created_at': row.created_at,
-            'updated_at': row.updated_at
-        })
-    return templates.TemplateResponse("notes_list.html", {"request": request, "notes": notes})
+async def get_notes(request: Request, cursor: Optional[str] = None):
+    # Later pages are appended by the infinite scroll, without the list chrome
+    template = "notes_page.html" if cursor else "notes_list.html"
+    notes, position = await store.list_notes(decode_cursor(cursor), PAGE_SIZE)
+    notes = [autosave.overlay(note) for note in notes]
+    return templates.TemplateResponse(template, {"request": request, "notes": notes,
+                                                 "next_cursor": encode_cursor(position)})
+
+@app.get("/notes/events")
+async def stream_note_events(request: Request):
+    """Push note deltas to an open board as server-sent events"""
+    subscription = note_events.subscribe()
+
+    async def body():
+        try:
+            while not await request.is_disconnected():
+                delta = await subscription.next(EVENTS_KEEPALIVE)
+                yield sse_event(*delta) if delta else ": keepalive\n\n"
+        finally:
+            note_events.unsubscribe(subscription)
+
+    # Keep proxies from buffering the stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(body(), media_type="text/event-stream", headers=headers)
+
+@app.get("/notes/events/stats")
+async def note_events_stats():
+    """Report connected boards and deltas published"""
+    return note_events.stats()
+
+@app.get("/notes/export")
+async def export_notes():
+    """Stream every note as NDJSON, holding no more than a couple of store pages"""
+    async def body():
+        async for notes in store.scan_notes():
+            yield ''.join(export_line(autosave.overlay(note)) for note in notes)
+
+    headers = {"Content-Disposition": 'attachment; filename="notes.ndjson"'}
+    return StreamingResponse(body(), media_type="application/x-ndjson", headers=headers)
+
+@app.post("/notes/import")
+async def import_notes(request: Request):
+    """Store the notes of an NDJSON upload, one note per line, as it streams in"""
+    result = {"imported": 0, "failed": 0, "errors": []}
+
+    async def import_line(line_no: int, line: bytes):
+        try:
+            note = await store.put_note(parse_import(line))
+        except Exception as e:
+            result["failed"] += 1
+            if len(result["errors"]) < MAX_IMPORT_ERRORS:
+                result["errors"].append({"line": line_no, "error": str(e)})
+            return
+        result["imported"] += 1
+        note_index.put(uuid.UUID(note['id']), note['content'])
+
+    async def jobs():
+        async for line_no, line in ndjson_lines(request.stream()):
+            yield import_line(line_no, line)
+
+    # The upload is only read as fast as the store takes the writes
+    await run_bounded(jobs(), IMPORT_WINDOW)
+    if result["imported"]:
+        # One reload instead of a delta per imported note
+        note_events.publish("resync")
+    return result
+
+@app.get("/notes/search")
+async def search_notes(request: Request, q: str = ""):
+    if not q.strip():
+        notes, position = await store.list_notes(None, PAGE_SIZE)
+        notes = [autosave.overlay(note) for note in notes]
+        return templates.TemplateResponse("notes_page.html", {"request": request, "notes": notes,
+                                                              "next_cursor": encode_cursor(position)})
+    hits, truncated = note_index.search(q, SEARCH_LIMIT)
+    found = await asyncio.gather(*(store.get_note(note_id) for _, note_id in hits))
+    notes = [autosave.overlay(note) for note in found if note is not None]
+    return templates.TemplateResponse("notes_search.html", {"request": request, "notes": notes, "q": q,
+                                                            "truncated": truncated})
 
 @app.post("/notes")
 async def create_note(request: Request):
-    note_id = uuid.uuid4()
-    now = datetime.now()
-    
-    session.execute("""
-        INSERT INTO notes (id, content, color, is_public, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (note_id, '', 'default', False, now, now))
-    
-    note = {
-        'id': str(note_id),
-        'content': '',
-        'color': 'default',
-        'is_public': False,
-        'created_at': now,
-        'updated_at': now
-    }
-    
+    note = await store.create_note('', 'default')
+    note_index.put(uuid.UUID(note['id']), note['content'])
+    publish_created(note)
     return templates.TemplateResponse("note_card.html", {"request": request, "note": note, "editable": True})
 
 @app.put("/notes/{note_id}")
 async def update_note(note_id: str, content: str = Form(...)):
     try:
         note_uuid = uuid.UUID(note_id)
-        now = datetime.now()
-        
-        session.execute("""
-            UPDATE notes SET content = ?, updated_at = ? WHERE id = ?
-        """, (content, now, note_uuid))
-        
+        autosave.stage(note_uuid, content=content)
+        note_index.put(note_uuid, content)
+        note_events.publish("updated", id=str(note_uuid), content=content)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -113,12 +307,8 @@ async def update_note(note_id: str, content: str = Form(...)):
 async def update_note_color(note_id: str, color: str = Form(...)):
     try:
         note_uuid = uuid.UUID(note_id)
-        now = datetime.now()
-        
-        session.execute("""
-            UPDATE notes SET color = ?, updated_at = ? WHERE id = ?
-        """, (color, now, note_uuid))
-        
+        autosave.stage(note_uuid, color=color)
+        note_events.publish("color", id=str(note_uuid), color=color)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -127,7 +317,10 @@ async def update_note_color(note_id: str, color: str = Form(...)):
 async def delete_note(note_id: str):
     try:
         note_uuid = uuid.UUID(note_id)
-        session.execute("DELETE FROM notes WHERE id = ?", (note_uuid,))
+        await autosave.discard(note_uuid)
+        await store.delete_note(note_uuid)
+        note_index.remove(note_uuid)
+        note_events.publish("deleted", id=str(note_uuid))
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -136,59 +329,110 @@ async def delete_note(note_id: str):
 async def share_note(request: Request, note_id: str):
     try:
         note_uuid = uuid.UUID(note_id)
-        
-        # Get the note
-        row = session.execute("SELECT * FROM notes WHERE id = ?", (note_uuid,)).one()
-        if not row:
-            raise HTTPException(status_code=404, detail="Note not found")
-        
-        # Mark as public
-        session.execute("UPDATE notes SET is_public = ? WHERE id = ?", (True, note_uuid))
-        
-        # Add to public notes
-        session.execute("""
-            INSERT INTO public_notes (id, content, color, shared_at)
-            VALUES (?, ?, ?, ?)
-        """, (note_uuid, row.content, row.color, datetime.now()))
-        
-        return {"success": True}
+        # The public copy has to carry the latest edits
+        await autosave.flush()
+        shared = await store.share_note(note_uuid)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not shared:
+        raise HTTPException(status_code=404, detail="Note not found")
+    await feed_cache.shared()
+    note_events.publish("shared", id=str(note_uuid))
+    return {"success": True}
+
+@app.post("/notes/share")
+async def share_notes(request: Request):
+    """Share several notes at once, reporting the result of each"""
+    ids = await read_bulk_ids(request)
+    valid, results = split_bulk_ids(ids)
+    try:
+        await autosave.flush()
+        shared = await store.share_notes(list(dict.fromkeys(valid.values())))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for note_id, note_uuid in valid.items():
+        if shared[note_uuid]:
+            results[note_id] = {"id": note_id, "success": True}
+            note_events.publish("shared", id=str(note_uuid))
+        else:
+            results[note_id] = {"id": note_id, "success": False, "error": "Note not found"}
+    if any(shared.values()):
+        await feed_cache.shared()
+    return {"results": [results[note_id] for note_id in ids]}
+
+@app.post("/notes/delete")
+async def delete_notes(request: Request):
+    """Delete several notes at once, reporting the result of each"""
+    ids = await read_bulk_ids(request)
+    valid, results = split_bulk_ids(ids)
+    try:
+        await asyncio.gather(*(autosave.discard(note_uuid) for note_uuid in valid.values()))
+        deleted = await store.delete_notes(list(dict.fromkeys(valid.values())))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    for note_id, note_uuid in valid.items():
+        if not deleted[note_uuid]:
+            results[note_id] = {"id": note_id, "success": False, "error": "Note not found"}
+            continue
+        note_index.remove(note_uuid)
+        note_events.publish("deleted", id=str(note_uuid))
+        results[note_id] = {"id": note_id, "success": True}
+    return {"results": [results[note_id] for note_id in ids]}
 
 @app.get("/public-notes")
-async def get_public_notes(request: Request):
-    rows = session.execute("SELECT * FROM public_notes ORDER BY shared_at DESC")
-    notes = []
-    for row in rows:
-        notes.append({
-            'id': str(row.id),
-            'content': row.content,
-            'color': row.color or 'default',
-            'shared_at': row.shared_at
-        })
-    return templates.TemplateResponse("public_notes_list.html", {"request": request, "notes": notes})
+async def get_public_notes(request: Request, cursor: Optional[str] = None):
+    # The feed only changes on share, so pages are rendered once and revalidated by ETag
+    key = cursor or ''
+    page = await feed_cache.get(key)
+    if page is None:
+        version = await feed_cache.version()
+        template = "public_notes_page.html" if cursor else "public_notes_list.html"
+        notes, position = await store.list_public_notes(decode_cursor(cursor), PAGE_SIZE)
+        html = templates.get_template(template).render({"request": request, "notes": notes,
+                                                        "next_cursor": encode_cursor(position)})
+        newest = max((note['shared_at'] for note in notes if note['shared_at']), default=None)
+        page = render_page(html, newest)
+        await feed_cache.put(key, version, page)
+    if page.not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        return Response(status_code=304, headers=page.headers())
+    return HTMLResponse(page.html, headers=page.headers())
+
+@app.get("/public-notes/cache")
+async def public_notes_cache_stats():
+    """Report public feed cache statistics"""
+    return await feed_cache.stats()
 
 @app.post("/notes/{note_id}/copy")
 async def copy_note_to_board(request: Request, note_id: str):
     try:
-        # Get the public note
         note_uuid = uuid.UUID(note_id)
-        row = session.execute("SELECT * FROM public_notes WHERE id = ?", (note_uuid,)).one()
-        if not row:
-            raise HTTPException(status_code=404, detail="Public note not found")
-        
-        # Create new note in personal notes
-        new_id = uuid.uuid4()
-        now = datetime.now()
-        
-        session.execute("""
-            INSERT INTO notes (id, content, color, is_public, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (new_id, row.content, row.color, False, now, now))
-        
-        return {"success": True}
+        note = await store.copy_public_note(note_uuid)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if note is None:
+        raise HTTPException(status_code=404, detail="Public note not found")
+    note_index.put(uuid.UUID(note['id']), note['content'])
+    publish_created(note)
+    return {"success": True}
+
+@app.post("/notes/copy")
+async def copy_notes_to_board(request: Request):
+    """Copy several public notes to the board at once, reporting the new note of each"""
+    ids = await read_bulk_ids(request)
+    valid, results = split_bulk_ids(ids)
+    try:
+        copies = await store.copy_public_notes(list(dict.fromkeys(valid.values())))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    for note_id, public_uuid in valid.items():
+        note = copies[public_uuid]
+        if note is None:
+            results[note_id] = {"id": note_id, "success": False, "error": "Public note not found"}
+            continue
+        note_index.put(uuid.UUID(note['id']), note['content'])
+        publish_created(note)
+        results[note_id] = {"id": note_id, "success": True, "note_id": note['id']}
+    return {"results": [results[note_id] for note_id in ids]}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,65 @@
+import asyncio
+import json
+from typing import Any, Dict, Optional, Set
+
+# Deltas a board may fall behind by before it is told to reload instead
+QUEUE_SIZE = 256
+# Sent in place of the dropped deltas of a board that fell behind
+RESYNC = ("resync", "{}")
+
+
+class Subscription:
+    """The pending deltas of one connected board"""
+
+    def __init__(self, size: int):
+        self.queue: "asyncio.Queue" = asyncio.Queue(size)
+
+    def offer(self, event: str, data: str):
+        try:
+            self.queue.put_nowait((event, data))
+        except asyncio.QueueFull:
+            # A slow board costs a reload, never memory or the publisher's time
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+    async def next(self, timeout: float) -> Optional[tuple]:
+        """The next (event, data) delta, or None when nothing happened for timeout seconds"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class NoteEvents:
+    """Fans note deltas out to every connected board
+
+    Publishing never waits: each board has a bounded queue, and one that
+    falls QUEUE_SIZE deltas behind has them replaced by a single resync.
+    """
+
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: Set[Subscription] = set()
+        self.published = 0
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    def publish(self, event: str, **fields: Any):
+        """Send a delta such as created, updated, color, deleted or shared to every board"""
+        data = json.dumps(fields, default=str)
+        self.published += 1
+        for subscription in self.subscribers:
+            subscription.offer(event, data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+        }
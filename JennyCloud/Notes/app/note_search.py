@@ -0,0 +1,187 @@
+import heapq
+import math
+import re
+import uuid
+from bisect import bisect_left, insort
+from itertools import islice
+from typing import Dict, List, Set, Tuple
+
+WORD = re.compile(r'\w+')
+# Words a prefix may expand to; the most common ones are kept
+MAX_EXPANSIONS = 32
+# Postings scored to find the candidates of a query, newest first, so a
+# one-letter prefix costs no more than a selective word; searches that hit
+# it say so, so the user knows to type more
+MAX_SCORED = 8000
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return WORD.findall(text.lower())
+
+
+class NoteIndex:
+    """Inverted index over note content for as-you-type search
+
+    Every query word matches the words it is a prefix of, looked up in a
+    sorted vocabulary, and a note has to match every query word. Hits are
+    ranked by BM25, taking the best expansion of each query word. Queries
+    matching more than MAX_SCORED postings only rank the most recently
+    indexed of them, and are reported as truncated.
+
+    While a rebuild scans the store, notes changed through the app are
+    remembered, so the scan cannot overwrite them with what it read earlier.
+    """
+
+    def __init__(self):
+        # Notes are numbered as they are indexed; ints hash much faster than UUIDs
+        self.ids: Dict[int, uuid.UUID] = {}
+        self.docs: Dict[uuid.UUID, int] = {}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.vocabulary: List[str] = []
+        # Distinct words and length of every indexed note, to unindex it later
+        self.words: Dict[int, Tuple[str, ...]] = {}
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+        self.rebuilding = False
+        self._next_doc = 0
+        self._changed: Set[uuid.UUID] = set()
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def _add(self, note_id: uuid.UUID, content: str):
+        doc = self._next_doc
+        self._next_doc += 1
+        words = tokenize(content)
+        counts: Dict[str, int] = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                insort(self.vocabulary, word)
+            postings[doc] = count
+        self.ids[doc] = note_id
+        self.docs[note_id] = doc
+        self.words[doc] = tuple(counts)
+        self.lengths[doc] = len(words)
+        self.total_length += len(words)
+
+    def _remove(self, note_id: uuid.UUID):
+        doc = self.docs.pop(note_id, None)
+        if doc is None:
+            return
+        for word in self.words.pop(doc):
+            postings = self.postings[word]
+            del postings[doc]
+            if not postings:
+                del self.postings[word]
+                del self.vocabulary[bisect_left(self.vocabulary, word)]
+        del self.ids[doc]
+        self.total_length -= self.lengths.pop(doc)
+
+    def begin_rebuild(self):
+        self.rebuilding = True
+        self._changed.clear()
+
+    def end_rebuild(self):
+        self.rebuilding = False
+        self._changed.clear()
+
+    def load(self, note_id: uuid.UUID, content: str):
+        """Index a note read by a rebuild, unless the app changed it since"""
+        if note_id not in self._changed and note_id not in self.docs:
+            self._add(note_id, content or '')
+
+    def put(self, note_id: uuid.UUID, content: str):
+        """Index the current content of a note"""
+        if self.rebuilding:
+            self._changed.add(note_id)
+        self._remove(note_id)
+        self._add(note_id, content or '')
+
+    def remove(self, note_id: uuid.UUID):
+        if self.rebuilding:
+            self._changed.add(note_id)
+        self._remove(note_id)
+
+    def expand(self, prefix: str) -> List[str]:
+        """Indexed words starting with prefix: the word itself, then the most common"""
+        start = bisect_left(self.vocabulary, prefix)
+        end = bisect_left(self.vocabulary, prefix + '\U0010ffff', start)
+        words = self.vocabulary[start:end]
+        if len(words) <= MAX_EXPANSIONS:
+            return sorted(words, key=lambda w: (w != prefix, -len(self.postings[w])))
+        ranked = heapq.nlargest(MAX_EXPANSIONS, words, key=lambda w: len(self.postings[w]))
+        if words[0] == prefix and prefix not in ranked:
+            ranked = [prefix] + ranked[:-1]
+        return sorted(ranked, key=lambda w: (w != prefix, -len(self.postings[w])))
+
+    def search(self, q: str, limit: int = 20) -> Tuple[List[Tuple[float, uuid.UUID]], bool]:
+        """Return the best (score, note id) matches of every word of the query
+
+        Along with them comes whether only the latest MAX_SCORED candidates
+        were ranked, so older matches may be missing.
+        """
+        terms = list(dict.fromkeys(tokenize(q)))
+        if not terms or not self.docs:
+            return [], False
+        notes = len(self.docs)
+        average = self.total_length / notes or 1.0
+
+        lengths = self.lengths
+
+        def weight(postings: Dict[int, int], doc: int, idf: float) -> float:
+            tf = postings[doc]
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / average)
+            return idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        expanded = []
+        for term in terms:
+            words = self.expand(term)
+            if not words:
+                return [], False
+            postings = [self.postings[word] for word in words]
+            idfs = [math.log(1 + (notes - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+            expanded.append((sum(len(p) for p in postings), postings, idfs))
+        # The rarest term picks the candidates; the others only score those
+        expanded.sort(key=lambda e: e[0])
+
+        candidates, postings, idfs = expanded[0]
+        truncated = candidates > MAX_SCORED
+        totals: Dict[int, float] = {}
+        budget = MAX_SCORED
+        for word_postings, idf in zip(postings, idfs):
+            # Postings keep indexing order, so the latest written notes come last
+            for doc in islice(reversed(word_postings), budget):
+                score = weight(word_postings, doc, idf)
+                if score > totals.get(doc, 0.0):
+                    totals[doc] = score
+            budget -= len(word_postings)
+            if budget <= 0:
+                break
+
+        for size, postings, idfs in expanded[1:]:
+            best: Dict[int, float] = {}
+            if size < len(totals) * len(postings):
+                for word_postings, idf in zip(postings, idfs):
+                    for doc in word_postings:
+                        if doc in totals:
+                            score = weight(word_postings, doc, idf)
+                            if score > best.get(doc, 0.0):
+                                best[doc] = score
+            else:
+                for doc in totals:
+                    for word_postings, idf in zip(postings, idfs):
+                        if doc in word_postings:
+                            score = weight(word_postings, doc, idf)
+                            if score > best.get(doc, 0.0):
+                                best[doc] = score
+            totals = {doc: totals[doc] + score for doc, score in best.items()}
+            if not totals:
+                return [], truncated
+        best = heapq.nlargest(limit, ((score, doc) for doc, score in totals.items()))
+        return [(score, self.ids[doc]) for score, doc in best], truncated
@@ -0,0 +1,277 @@
+import asyncio
+import random
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+
+# Notes per page when scanning a whole board
+SCAN_PAGE = 1000
+
+# Where a listing page starts: a bucket and a store-specific resume token inside
+# it (None for the top of the bucket)
+Position = Tuple[str, Optional[bytes]]
+
+_EPOCH = datetime(1970, 1, 1)
+# 100ns intervals between the UUID epoch (1582-10-15) and the Unix epoch
+_UUID_EPOCH_TICKS = 0x01b21dd213814000
+
+
+@dataclass
+class NoteEdit:
+    """Latest unwritten content and color of a note; None leaves a field as it is"""
+    updated_at: datetime
+    content: Optional[str] = None
+    color: Optional[str] = None
+
+    def merge(self, newer: "NoteEdit") -> "NoteEdit":
+        return NoteEdit(newer.updated_at,
+                        newer.content if newer.content is not None else self.content,
+                        newer.color if newer.color is not None else self.color)
+
+
+def new_note_id() -> uuid.UUID:
+    return uuid.uuid1()
+
+
+def note_id_at(moment: datetime, seed: Optional[uuid.UUID] = None) -> uuid.UUID:
+    """Time-based note id for a note created at the given UTC time, for imported notes
+
+    With a seed the clock sequence and node come from it instead of being
+    random, so the same moment and seed always give the same id.
+    """
+    delta = moment - _EPOCH
+    ticks = _UUID_EPOCH_TICKS + (delta.days * 86400 + delta.seconds) * 10 ** 7 + delta.microseconds * 10
+    clock_seq = seed.clock_seq if seed is not None else random.getrandbits(14)
+    # The node has the multicast bit set, as RFC 4122 suggests when there is no MAC
+    node = (seed.node if seed is not None else random.getrandbits(48)) | 0x010000000000
+    return uuid.UUID(fields=(ticks & 0xffffffff, (ticks >> 32) & 0xffff, (ticks >> 48) & 0x0fff | 0x1000,
+                             (clock_seq >> 8) | 0x80, clock_seq & 0xff, node))
+
+
+def id_time(note_id: uuid.UUID) -> datetime:
+    """Time a note id was minted at, truncated to the millisecond like a Scylla timestamp"""
+    if note_id.version != 1:
+        raise ValueError("Not a note id: %s" % note_id)
+    return _EPOCH + timedelta(milliseconds=(note_id.time - _UUID_EPOCH_TICKS) // 10000)
+
+
+def bucket_for(moment: datetime) -> str:
+    return moment.strftime('%Y-%m')
+
+
+def note_key(note_id: uuid.UUID) -> Tuple[str, datetime, uuid.UUID]:
+    """Partition and clustering key of a note (or public note) with this id"""
+    moment = id_time(note_id)
+    return bucket_for(moment), moment, note_id
+
+
+async def run_bounded(jobs: AsyncIterator[Awaitable], window: int):
+    """Await jobs as they come, with at most window of them in flight
+
+    Jobs are only pulled from the iterator when there is room, so a large
+    stream of writes holds a constant number of them in memory. Jobs have to
+    handle their own errors.
+    """
+    pending = set()
+    async for job in jobs:
+        if len(pending) >= window:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.ensure_future(job))
+    if pending:
+        await asyncio.wait(pending)
+
+
+class NotesStore:
+    """Storage behind the Notes endpoints
+
+    Notes are dicts shaped like the templates expect, with string ids;
+    listings are newest first and resume at an opaque Position.
+    """
+
+    async def start(self):
+        """Begin connecting; must not wait for the storage to become reachable"""
+
+    async def close(self):
+        pass
+
+    async def list_notes(self, start: Optional[Position], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        """Up to limit notes and the position of the next page, None at the end"""
+        raise NotImplementedError
+
+    def scan_notes(self) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Every note, a page at a time, in no particular order"""
+        raise NotImplementedError
+
+    async def get_note(self, note_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def create_note(self, content: str, color: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def put_note(self, note: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a complete note under its own id, replacing any note with that id
+
+        The creation time is the one the id carries.
+        """
+        raise NotImplementedError
+
+    async def apply_edits(self, edits: Dict[uuid.UUID, NoteEdit]):
+        """Write buffered content and color edits"""
+        raise NotImplementedError
+
+    async def delete_note(self, note_id: uuid.UUID):
+        raise NotImplementedError
+
+    async def share_note(self, note_id: uuid.UUID) -> bool:
+        """Publish a note to the public board; False when the note does not exist
+
+        A note that is already public is left as it is, so sharing it again
+        adds no second entry to the feed.
+        """
+        raise NotImplementedError
+
+    async def delete_notes(self, note_ids: List[uuid.UUID]) -> Dict[uuid.UUID, bool]:
+        """Delete several notes at once; whether each of them existed"""
+        notes = await asyncio.gather(*(self.get_note(note_id) for note_id in note_ids))
+        found = [note_id for note_id, note in zip(note_ids, notes) if note is not None]
+        await asyncio.gather(*(self.delete_note(note_id) for note_id in found))
+        return {note_id: note is not None for note_id, note in zip(note_ids, notes)}
+
+    async def share_notes(self, note_ids: List[uuid.UUID]) -> Dict[uuid.UUID, bool]:
+        """Publish several notes at once; whether each of them existed"""
+        shared = await asyncio.gather(*(self.share_note(note_id) for note_id in note_ids))
+        return dict(zip(note_ids, shared))
+
+    async def list_public_notes(self, start: Optional[Position],
+                                limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        raise NotImplementedError
+
+    async def get_public_note(self, public_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def copy_public_note(self, public_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        """Copy a public note into the personal board; None when it does not exist"""
+        public = await self.get_public_note(public_id)
+        if public is None:
+            return None
+        return await self.create_note(public['content'], public['color'])
+
+    async def copy_public_notes(self, public_ids: List[uuid.UUID]) -> Dict[uuid.UUID, Optional[Dict[str, Any]]]:
+        """Copy several public notes at once; the new note of each, None for those that do not exist"""
+        copies = await asyncio.gather(*(self.copy_public_note(public_id) for public_id in public_ids))
+        return dict(zip(public_ids, copies))
+
+
+def _order_key(note_id: uuid.UUID) -> Tuple[int, int, str]:
+    # Newest millisecond first, then ascending timeuuid, like the Scylla clustering order
+    return -(note_id.time // 10000), note_id.time, note_id.hex
+
+
+class _Board:
+    """Records of one board kept in listing order"""
+
+    def __init__(self):
+        self.records: Dict[uuid.UUID, Dict[str, Any]] = {}
+        self.order: List[Tuple[int, int, str, uuid.UUID]] = []
+
+    def add(self, note_id: uuid.UUID, record: Dict[str, Any]):
+        if note_id not in self.records:
+            insort(self.order, _order_key(note_id) + (note_id,))
+        self.records[note_id] = record
+
+    def remove(self, note_id: uuid.UUID):
+        if self.records.pop(note_id, None) is not None:
+            self.order.pop(bisect_left(self.order, _order_key(note_id) + (note_id,)))
+
+    def page(self, start: Optional[Position], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        # The resume token is the id of the last note served, which need not exist any more
+        first = 0
+        if start is not None and start[1]:
+            last = uuid.UUID(bytes=start[1])
+            first = bisect_right(self.order, _order_key(last) + (last,))
+        entries = self.order[first:first + limit]
+        items = [dict(self.records[entry[-1]]) for entry in entries]
+        if first + limit >= len(self.order) or not entries:
+            return items, None
+        last = entries[-1][-1]
+        return items, (bucket_for(id_time(last)), last.bytes)
+
+
+class MemoryNotesStore(NotesStore):
+    """Notes held in process memory, for tests, benchmarks and running without Scylla"""
+
+    def __init__(self):
+        self.notes = _Board()
+        self.public = _Board()
+
+    async def list_notes(self, start: Optional[Position], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        return self.notes.page(start, limit)
+
+    async def scan_notes(self) -> AsyncIterator[List[Dict[str, Any]]]:
+        notes = list(self.notes.records.values())
+        for i in range(0, len(notes), SCAN_PAGE):
+            yield [dict(note) for note in notes[i:i + SCAN_PAGE]]
+
+    async def get_note(self, note_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        note = self.notes.records.get(note_id)
+        return dict(note) if note else None
+
+    async def create_note(self, content: str, color: str) -> Dict[str, Any]:
+        _, created_at, note_id = note_key(new_note_id())
+        note = {
+            'id': str(note_id),
+            'content': content,
+            'color': color,
+            'is_public': False,
+            'created_at': created_at,
+            'updated_at': created_at
+        }
+        self.notes.add(note_id, note)
+        return dict(note)
+
+    async def put_note(self, note: Dict[str, Any]) -> Dict[str, Any]:
+        _, created_at, note_id = note_key(uuid.UUID(note['id']))
+        note = dict(note, id=str(note_id), created_at=created_at)
+        self.notes.add(note_id, note)
+        return dict(note)
+
+    async def apply_edits(self, edits: Dict[uuid.UUID, NoteEdit]):
+        for note_id, edit in edits.items():
+            note = self.notes.records.get(note_id)
+            if note is None:
+                continue
+            if edit.content is not None:
+                note['content'] = edit.content
+            if edit.color is not None:
+                note['color'] = edit.color
+            note['updated_at'] = edit.updated_at
+
+    async def delete_note(self, note_id: uuid.UUID):
+        self.notes.remove(note_id)
+
+    async def share_note(self, note_id: uuid.UUID) -> bool:
+        note = self.notes.records.get(note_id)
+        if note is None:
+            return False
+        if note['is_public']:
+            return True
+        note['is_public'] = True
+        _, shared_at, public_id = note_key(new_note_id())
+        self.public.add(public_id, {
+            'id': str(public_id),
+            'note_id': note['id'],
+            'content': note['content'],
+            'color': note['color'],
+            'shared_at': shared_at
+        })
+        return True
+
+    async def list_public_notes(self, start: Optional[Position],
+                                limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        return self.public.page(start, limit)
+
+    async def get_public_note(self, public_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        note = self.public.records.get(public_id)
+        return dict(note) if note else None
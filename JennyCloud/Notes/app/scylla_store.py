@@ -0,0 +1,525 @@
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Set, Tuple
+
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, Cluster, ExecutionProfile, ResponseFuture, ResultSet, Session
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cassandra.query import BatchStatement, BatchType
+
+from notes_store import SCAN_PAGE, NoteEdit, NotesStore, Position, new_note_id, note_id_at, note_key
+
+# Notes are partitioned by the month they were created (or shared) in, newest
+# first inside a partition, so a listing reads a few partitions in clustering
+# order instead of scanning the table. Note ids are time-based UUIDs, which
+# makes every note's partition and clustering key derivable from its id.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS notes_by_month (
+        bucket TEXT,
+        created_at TIMESTAMP,
+        id TIMEUUID,
+        content TEXT,
+        color TEXT,
+        is_public BOOLEAN,
+        updated_at TIMESTAMP,
+        PRIMARY KEY ((bucket), created_at, id)
+    ) WITH CLUSTERING ORDER BY (created_at DESC, id ASC)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS public_notes_by_month (
+        bucket TEXT,
+        shared_at TIMESTAMP,
+        id TIMEUUID,
+        note_id UUID,
+        content TEXT,
+        color TEXT,
+        PRIMARY KEY ((bucket), shared_at, id)
+    ) WITH CLUSTERING ORDER BY (shared_at DESC, id ASC)
+    """,
+    # The months that hold notes, per board, so listings know where to read next
+    """
+    CREATE TABLE IF NOT EXISTS note_buckets (
+        board TEXT,
+        bucket TEXT,
+        PRIMARY KEY ((board), bucket)
+    ) WITH CLUSTERING ORDER BY (bucket DESC)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name TEXT PRIMARY KEY,
+        applied_at TIMESTAMP
+    )
+    """,
+]
+# Recorded in schema_migrations once the schema above is in place
+SCHEMA_VERSION = 'bucketed_notes'
+# Claimed in schema_migrations by the one process copying the legacy tables; it
+# expires, so a process that dies mid-copy does not hold the others off forever
+MIGRATION_CLAIM = SCHEMA_VERSION + '_claim'
+MIGRATION_CLAIM_TTL = 600
+# Seconds a process waits for another one's migration before giving up
+MIGRATION_WAIT = 120
+# Time given to legacy rows that carry none, so reruns mint the same ids for them
+LEGACY_UNDATED = datetime(1970, 1, 1)
+
+NOTES_BOARD = 'notes'
+PUBLIC_BOARD = 'public'
+# Sorts after every real bucket, for reading from the newest one
+LATEST_BUCKET = '9999-12'
+
+NOTE_KEY = "bucket = ? AND created_at = ? AND id = ?"
+PUBLIC_KEY = "bucket = ? AND shared_at = ? AND id = ?"
+
+# Every statement the app runs, prepared once when the store connects
+STATEMENTS = {
+    'insert_note': "INSERT INTO notes_by_month (bucket, created_at, id, content, color, is_public, updated_at) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)",
+    'update_note': "UPDATE notes_by_month SET content = ?, color = ?, updated_at = ? WHERE " + NOTE_KEY,
+    'update_content': "UPDATE notes_by_month SET content = ?, updated_at = ? WHERE " + NOTE_KEY,
+    'update_color': "UPDATE notes_by_month SET color = ?, updated_at = ? WHERE " + NOTE_KEY,
+    'delete_note': "DELETE FROM notes_by_month WHERE " + NOTE_KEY,
+    'select_note': "SELECT * FROM notes_by_month WHERE " + NOTE_KEY,
+    'select_notes': "SELECT * FROM notes_by_month WHERE bucket = ?",
+    # A lightweight transaction, so only one of several concurrent shares publishes the note
+    'claim_public': "UPDATE notes_by_month SET is_public = true WHERE " + NOTE_KEY + " IF is_public = false",
+    'insert_public_note': "INSERT INTO public_notes_by_month (bucket, shared_at, id, note_id, content, color) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+    'select_public_note': "SELECT * FROM public_notes_by_month WHERE " + PUBLIC_KEY,
+    'select_public_notes': "SELECT * FROM public_notes_by_month WHERE bucket = ?",
+    'insert_bucket': "INSERT INTO note_buckets (board, bucket) VALUES (?, ?)",
+    'select_buckets': "SELECT bucket FROM note_buckets WHERE board = ? AND bucket <= ?",
+}
+
+# Statements per unlogged batch when writing buffered edits
+MAX_BATCH = 50
+
+
+def as_future(response_future: ResponseFuture) -> "asyncio.Future[ResultSet]":
+    """Wrap a driver ResponseFuture in an asyncio future of the current loop
+
+    The driver calls back on its own I/O thread, so the result is handed to
+    the event loop with call_soon_threadsafe instead of set directly.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result):
+        if not future.done():
+            future.set_result(result)
+
+    def reject(error):
+        if not future.done():
+            future.set_exception(error)
+
+    def on_rows(_rows):
+        # The response is complete here, so result() returns without waiting
+        loop.call_soon_threadsafe(resolve, response_future.result())
+
+    def on_error(error):
+        loop.call_soon_threadsafe(reject, error)
+
+    response_future.add_callbacks(on_rows, on_error)
+    return future
+
+
+def note_record(row) -> Optional[Dict[str, Any]]:
+    """The note of a row, None for a row an edit recreated after its note was deleted
+
+    UPDATE is an upsert, so such a row has the edited columns but never
+    is_public, which only inserts write.
+    """
+    if row.is_public is None:
+        return None
+    return {
+        'id': str(row.id),
+        'content': row.content,
+        'color': row.color or 'default',
+        'is_public': row.is_public,
+        'created_at': row.created_at,
+        'updated_at': row.updated_at
+    }
+
+
+def public_note_record(row) -> Dict[str, Any]:
+    return {
+        'id': str(row.id),
+        'note_id': str(row.note_id) if row.note_id else None,
+        'content': row.content,
+        'color': row.color or 'default',
+        'shared_at': row.shared_at
+    }
+
+
+def connect(hosts: List[str], port: int = 9042, local_dc: Optional[str] = None,
+            request_timeout: float = 10.0) -> Session:
+    """Open a session that routes every statement to a replica of its partition
+
+    Protocol v3+ multiplexes thousands of requests over each connection, so
+    one connection per host (one per shard with scylla-driver) is the pool.
+    """
+    profile = ExecutionProfile(
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy(local_dc=local_dc)),
+        request_timeout=request_timeout,
+    )
+    cluster = Cluster(hosts, port=port, execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    return cluster.connect()
+
+
+def schema_applied(session: Session, keyspace: str) -> bool:
+    """Whether the current schema is already recorded, checked without any DDL"""
+    table = session.execute("SELECT table_name FROM system_schema.tables WHERE keyspace_name = %s "
+                            "AND table_name = 'schema_migrations'", (keyspace,)).one()
+    if table is None:
+        return False
+    return session.execute("SELECT name FROM %s.schema_migrations WHERE name = %%s" % keyspace,
+                           (SCHEMA_VERSION,)).one() is not None
+
+
+def migrate(session: Session, keyspace: str):
+    """Create the keyspace and tables and copy notes over from the first schema
+
+    Workers starting together all get here; the copy is claimed with a
+    lightweight transaction, and the others wait for it to be recorded.
+    """
+    session.execute("""
+        CREATE KEYSPACE IF NOT EXISTS %s
+        WITH replication = {'class': 'SimpleStrategy', 'replication_factor': 1}
+    """ % keyspace)
+    session.set_keyspace(keyspace)
+    for statement in SCHEMA:
+        session.execute(statement)
+    claimed = session.execute("INSERT INTO schema_migrations (name, applied_at) VALUES (%%s, %%s) "
+                              "IF NOT EXISTS USING TTL %d" % MIGRATION_CLAIM_TTL,
+                              (MIGRATION_CLAIM, datetime.utcnow())).was_applied
+    if not claimed:
+        wait_for_migration(session, keyspace)
+        return
+    migrate_legacy_tables(session)
+    session.execute("INSERT INTO schema_migrations (name, applied_at) VALUES (%s, %s)",
+                    (SCHEMA_VERSION, datetime.utcnow()))
+    session.execute("DELETE FROM schema_migrations WHERE name = %s IF EXISTS", (MIGRATION_CLAIM,))
+
+
+def wait_for_migration(session: Session, keyspace: str):
+    deadline = time.monotonic() + MIGRATION_WAIT
+    while not schema_applied(session, keyspace):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Keyspace {keyspace} is still being migrated by another process")
+        time.sleep(1)
+
+
+def migrate_legacy_tables(session: Session):
+    """Copy notes from the id-keyed tables of the first schema into the bucketed ones
+
+    Legacy ids are random UUIDs, so copied notes get time-based ids minted
+    from their original timestamps, seeded by the legacy id. A copy that is
+    interrupted and run again overwrites the same rows instead of adding
+    duplicates.
+    """
+    done = session.execute("SELECT name FROM schema_migrations WHERE name = %s", (SCHEMA_VERSION,)).one()
+    if done:
+        return
+    tables = {row.table_name for row in session.execute(
+        "SELECT table_name FROM system_schema.tables WHERE keyspace_name = %s", (session.keyspace,))}
+    insert_note = session.prepare(STATEMENTS['insert_note'])
+    insert_public = session.prepare(STATEMENTS['insert_public_note'])
+    insert_bucket = session.prepare(STATEMENTS['insert_bucket'])
+
+    if 'notes' in tables:
+        for row in session.execute("SELECT * FROM notes"):
+            bucket, created_at, note_id = note_key(note_id_at(row.created_at or LEGACY_UNDATED, row.id))
+            session.execute(insert_note, (bucket, created_at, note_id, row.content, row.color,
+                                          row.is_public or False, row.updated_at or created_at))
+            session.execute(insert_bucket, (NOTES_BOARD, bucket))
+    if 'public_notes' in tables:
+        for row in session.execute("SELECT * FROM public_notes"):
+            bucket, shared_at, public_id = note_key(note_id_at(row.shared_at or LEGACY_UNDATED, row.id))
+            session.execute(insert_public, (bucket, shared_at, public_id, None, row.content, row.color))
+            session.execute(insert_bucket, (PUBLIC_BOARD, bucket))
+
+
+class ScyllaNotesStore(NotesStore):
+    """Notes in ScyllaDB over prepared statements, awaited without blocking the event loop
+
+    The cluster is connected in a background thread on first use, so a
+    worker accepts traffic before Scylla is reachable. Workers only apply
+    the schema when it is not recorded yet; with auto_migrate off they
+    expect `python scylla_store.py migrate` to have been run.
+    """
+
+    def __init__(self, hosts: List[str], port: int = 9042, keyspace: str = 'jennycloud',
+                 local_dc: Optional[str] = None, auto_migrate: bool = True):
+        self.hosts = hosts
+        self.port = port
+        self.keyspace = keyspace
+        self.local_dc = local_dc
+        self.auto_migrate = auto_migrate
+        self.session: Optional[Session] = None
+        self.statements = {}
+        # Buckets known to be recorded, so busy months cost no extra write per note
+        self.buckets: Set[Tuple[str, str]] = set()
+        self._connecting: Optional[asyncio.Future] = None
+
+    def _connect(self) -> Session:
+        session = connect(self.hosts, self.port, self.local_dc)
+        try:
+            if not schema_applied(session, self.keyspace):
+                if not self.auto_migrate:
+                    raise RuntimeError(f"Keyspace {self.keyspace} has no notes schema; "
+                                       f"run python scylla_store.py migrate")
+                migrate(session, self.keyspace)
+            session.set_keyspace(self.keyspace)
+            self.statements = {name: session.prepare(cql) for name, cql in STATEMENTS.items()}
+        except Exception:
+            session.cluster.shutdown()
+            raise
+        return session
+
+    def _ready(self) -> asyncio.Future:
+        # A failed attempt is retried by the next request
+        if self._connecting is None or (self._connecting.done() and self._connecting.exception()):
+            self._connecting = asyncio.ensure_future(asyncio.to_thread(self._connect))
+            self._connecting.add_done_callback(self._connected)
+        return self._connecting
+
+    def _connected(self, future: asyncio.Future):
+        if future.exception():
+            print(f"Notes could not connect to ScyllaDB: {future.exception()}")
+        else:
+            self.session = future.result()
+
+    async def start(self):
+        self._ready()
+
+    async def close(self):
+        if self.session is not None:
+            await asyncio.to_thread(self.session.cluster.shutdown)
+
+    async def execute(self, name: str, params: Sequence = (), paging_state: Optional[bytes] = None,
+                      fetch_size: Optional[int] = None) -> ResultSet:
+        session = await self._ready()
+        statement = self.statements[name].bind(params)
+        if fetch_size is not None:
+            statement.fetch_size = fetch_size
+        return await as_future(session.execute_async(statement, paging_state=paging_state))
+
+    async def record_bucket(self, board: str, bucket: str):
+        if (board, bucket) not in self.buckets:
+            await self.execute('insert_bucket', (board, bucket))
+            self.buckets.add((board, bucket))
+
+    async def fetch_all(self, name: str, params: Sequence = ()) -> List[Any]:
+        """Collect every page of a query, awaiting each page instead of letting iteration block"""
+        result = await self.execute(name, params)
+        rows = list(result.current_rows)
+        while result.paging_state is not None:
+            result = await self.execute(name, params, result.paging_state)
+            rows.extend(result.current_rows)
+        return rows
+
+    async def page(self, board: str, name: str, record: Callable[[Any], Optional[Dict[str, Any]]],
+                   start: Optional[Position], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        """Read up to limit rows of a board newest first, resuming at a position
+
+        Buckets are read in order, each through the driver's paging state, so
+        a page costs one or two partition reads however deep it is. Rows the
+        record function turns into None are skipped. Returns the records and
+        the position of the next page, None at the end.
+        """
+        bucket, paging_state = start if start is not None else (LATEST_BUCKET, None)
+        buckets = [row.bucket for row in await self.fetch_all('select_buckets', (board, bucket))]
+        items: List[Dict[str, Any]] = []
+        for i, bucket in enumerate(buckets):
+            while len(items) < limit:
+                result = await self.execute(name, (bucket,), paging_state, limit - len(items))
+                items.extend(item for item in map(record, result.current_rows) if item is not None)
+                paging_state = result.paging_state
+                if paging_state is None:
+                    break
+            if len(items) >= limit:
+                if paging_state is not None:
+                    return items, (bucket, paging_state)
+                return items, (buckets[i + 1], None) if i + 1 < len(buckets) else None
+        return items, None
+
+    async def list_notes(self, start: Optional[Position], limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        return await self.page(NOTES_BOARD, 'select_notes', note_record, start, limit)
+
+    async def scan_notes(self) -> AsyncIterator[List[Dict[str, Any]]]:
+        # Partition by partition, so the scan never asks for a token range
+        buckets = [row.bucket for row in await self.fetch_all('select_buckets', (NOTES_BOARD, LATEST_BUCKET))]
+        for bucket in buckets:
+            result = await self.execute('select_notes', (bucket,), None, SCAN_PAGE)
+            while True:
+                # Read the next page while this one is consumed, holding two pages at most
+                ahead = None
+                if result.paging_state is not None:
+                    ahead = asyncio.ensure_future(self.execute('select_notes', (bucket,), result.paging_state, SCAN_PAGE))
+                notes = [note for note in map(note_record, result.current_rows) if note is not None]
+                if notes:
+                    yield notes
+                if ahead is None:
+                    break
+                result = await ahead
+
+    async def get_note(self, note_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        row = (await self.execute('select_note', note_key(note_id))).one()
+        return note_record(row) if row else None
+
+    async def create_note(self, content: str, color: str) -> Dict[str, Any]:
+        bucket, created_at, note_id = note_key(new_note_id())
+        await asyncio.gather(
+            self.execute('insert_note', (bucket, created_at, note_id, content, color, False, created_at)),
+            self.record_bucket(NOTES_BOARD, bucket),
+        )
+        return {
+            'id': str(note_id),
+            'content': content,
+            'color': color,
+            'is_public': False,
+            'created_at': created_at,
+            'updated_at': created_at
+        }
+
+    async def put_note(self, note: Dict[str, Any]) -> Dict[str, Any]:
+        bucket, created_at, note_id = note_key(uuid.UUID(note['id']))
+        await asyncio.gather(
+            self.execute('insert_note', (bucket, created_at, note_id, note['content'], note['color'],
+                                         note['is_public'], note['updated_at'] or created_at)),
+            self.record_bucket(NOTES_BOARD, bucket),
+        )
+        return dict(note, id=str(note_id), created_at=created_at)
+
+    async def write_batches(self, writes: Iterable[Tuple[Hashable, str, Sequence]]):
+        """Run (partition, statement, params) writes as unlogged batches, each confined to one partition"""
+        session = await self._ready()
+        batches: Dict[Hashable, List[BatchStatement]] = {}
+        for partition_key, name, params in writes:
+            partition = batches.setdefault(partition_key, [])
+            if not partition or len(partition[-1]) >= MAX_BATCH:
+                partition.append(BatchStatement(batch_type=BatchType.UNLOGGED))
+            partition[-1].add(self.statements[name], params)
+        await asyncio.gather(*(as_future(session.execute_async(batch))
+                               for partition in batches.values() for batch in partition))
+
+    async def apply_edits(self, edits: Dict[uuid.UUID, NoteEdit]):
+        # Edits of notes that do not exist would upsert rows for them, so they are dropped
+        notes = await asyncio.gather(*(self.get_note(note_id) for note_id in edits))
+        writes = []
+        for (note_id, edit), note in zip(edits.items(), notes):
+            if note is None:
+                continue
+            key = note_key(note_id)
+            if edit.content is not None and edit.color is not None:
+                statement, params = 'update_note', (edit.content, edit.color, edit.updated_at) + key
+            elif edit.content is not None:
+                statement, params = 'update_content', (edit.content, edit.updated_at) + key
+            else:
+                statement, params = 'update_color', (edit.color, edit.updated_at) + key
+            writes.append(((NOTES_BOARD, key[0]), statement, params))
+        await self.write_batches(writes)
+
+    async def delete_note(self, note_id: uuid.UUID):
+        await self.execute('delete_note', note_key(note_id))
+
+    async def claim_public(self, note_id: uuid.UUID) -> bool:
+        """Mark a note public; False when it already was, by this share or a concurrent one"""
+        return (await self.execute('claim_public', note_key(note_id))).was_applied
+
+    async def share_note(self, note_id: uuid.UUID) -> bool:
+        note = await self.get_note(note_id)
+        if note is None:
+            return False
+        if note['is_public'] or not await self.claim_public(note_id):
+            return True
+        bucket, shared_at, public_id = note_key(new_note_id())
+        await asyncio.gather(
+            self.execute('insert_public_note', (bucket, shared_at, public_id, note_id, note['content'], note['color'])),
+            self.record_bucket(PUBLIC_BOARD, bucket),
+        )
+        return True
+
+    async def delete_notes(self, note_ids: List[uuid.UUID]) -> Dict[uuid.UUID, bool]:
+        notes = await asyncio.gather(*(self.get_note(note_id) for note_id in note_ids))
+        # Every id is deleted, which also clears rows an edit left behind
+        keys = [note_key(note_id) for note_id in note_ids]
+        await self.write_batches(((NOTES_BOARD, key[0]), 'delete_note', key) for key in keys)
+        return {note_id: note is not None for note_id, note in zip(note_ids, notes)}
+
+    async def share_notes(self, note_ids: List[uuid.UUID]) -> Dict[uuid.UUID, bool]:
+        notes = await asyncio.gather(*(self.get_note(note_id) for note_id in note_ids))
+        private = [(note_id, note) for note_id, note in zip(note_ids, notes) if note is not None and not note['is_public']]
+        # Conditional writes cannot share a batch with plain ones, so each note is claimed on its own
+        claimed = await asyncio.gather(*(self.claim_public(note_id) for note_id, _ in private))
+        writes = []
+        buckets = set()
+        for (note_id, note), won in zip(private, claimed):
+            if not won:
+                continue
+            bucket, shared_at, public_id = note_key(new_note_id())
+            writes.append(((PUBLIC_BOARD, bucket), 'insert_public_note',
+                           (bucket, shared_at, public_id, note_id, note['content'], note['color'])))
+            buckets.add(bucket)
+        await asyncio.gather(self.write_batches(writes),
+                             *(self.record_bucket(PUBLIC_BOARD, bucket) for bucket in buckets))
+        return {note_id: note is not None for note_id, note in zip(note_ids, notes)}
+
+    async def copy_public_notes(self, public_ids: List[uuid.UUID]) -> Dict[uuid.UUID, Optional[Dict[str, Any]]]:
+        publics = await asyncio.gather(*(self.get_public_note(public_id) for public_id in public_ids))
+        copies: Dict[uuid.UUID, Optional[Dict[str, Any]]] = {}
+        writes = []
+        buckets = set()
+        for public_id, public in zip(public_ids, publics):
+            if public is None:
+                copies[public_id] = None
+                continue
+            bucket, created_at, note_id = note_key(new_note_id())
+            writes.append(((NOTES_BOARD, bucket), 'insert_note',
+                           (bucket, created_at, note_id, public['content'], public['color'], False, created_at)))
+            buckets.add(bucket)
+            copies[public_id] = {
+                'id': str(note_id),
+                'content': public['content'],
+                'color': public['color'],
+                'is_public': False,
+                'created_at': created_at,
+                'updated_at': created_at
+            }
+        await asyncio.gather(self.write_batches(writes),
+                             *(self.record_bucket(NOTES_BOARD, bucket) for bucket in buckets))
+        return copies
+
+    async def list_public_notes(self, start: Optional[Position],
+                                limit: int) -> Tuple[List[Dict[str, Any]], Optional[Position]]:
+        return await self.page(PUBLIC_BOARD, 'select_public_notes', public_note_record, start, limit)
+
+    async def get_public_note(self, public_id: uuid.UUID) -> Optional[Dict[str, Any]]:
+        row = (await self.execute('select_public_note', note_key(public_id))).one()
+        return public_note_record(row) if row else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the Notes schema in ScyllaDB")
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument('--hosts', default=os.environ.get("NOTES_SCYLLA_HOSTS", "127.0.0.1"))
+    parser.add_argument('--port', type=int, default=int(os.environ.get("NOTES_SCYLLA_PORT", "9042")))
+    parser.add_argument('--keyspace', default=os.environ.get("NOTES_KEYSPACE", "jennycloud"))
+    args = parser.parse_args()
+
+    session = connect(args.hosts.split(','), args.port)
+    try:
+        if schema_applied(session, args.keyspace):
+            print("schema up to date")
+        else:
+            migrate(session, args.keyspace)
+            print("schema migrated")
+    finally:
+        session.cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
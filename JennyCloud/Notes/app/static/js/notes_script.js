@@ -134,3 +134,70 @@ document.addEventListener('input', (e) => {
         e.target.dataset.originalContent = e.target.textContent;
     }
 });
+
+// Live sync: apply the changes other tabs and devices make to the board
+function findNoteCard(noteId) {
+    return document.querySelector(`#notes-container .note-card[data-id="${noteId}"]`);
+}
+
+const noteEvents = new EventSource('/notes/events');
+
+noteEvents.addEventListener('created', (e) => {
+    const delta = JSON.parse(e.data);
+    const container = document.getElementById('notes-container');
+    if (!container || findNoteCard(delta.id)) return;
+    container.insertAdjacentHTML('afterbegin', delta.html);
+    htmx.process(container.firstElementChild);
+});
+
+noteEvents.addEventListener('updated', (e) => {
+    const delta = JSON.parse(e.data);
+    const card = findNoteCard(delta.id);
+    if (!card) return;
+    const contentEl = card.querySelector('.note-content');
+    // Never overwrite a note while it is being typed in
+    if (contentEl === document.activeElement || contentEl.contentEditable !== 'true') return;
+    contentEl.textContent = delta.content;
+    contentEl.dataset.originalContent = delta.content;
+});
+
+noteEvents.addEventListener('color', (e) => {
+    const delta = JSON.parse(e.data);
+    const card = findNoteCard(delta.id);
+    if (card) {
+        card.style.setProperty('--note-bg', `var(--note-color-${delta.color})`);
+    }
+});
+
+noteEvents.addEventListener('deleted', (e) => {
+    const card = findNoteCard(JSON.parse(e.data).id);
+    if (card) card.remove();
+});
+
+noteEvents.addEventListener('shared', (e) => {
+    const card = findNoteCard(JSON.parse(e.data).id);
+    const shareBtn = card && card.querySelector('.note-card-share-btn');
+    if (shareBtn) {
+        shareBtn.classList.add('shared');
+        shareBtn.title = 'Shared to public forum';
+        shareBtn.removeAttribute('hx-post');
+    }
+});
+
+// Deltas were dropped because this board fell behind, so reload it
+noteEvents.addEventListener('resync', () => {
+    if (document.getElementById('notes-container')) {
+        htmx.ajax('GET', '/notes', {target: '#content'});
+    }
+});
+
+// The created delta of a note made here can arrive before the note itself
+document.addEventListener('htmx:afterSwap', (e) => {
+    if (e.detail.requestConfig.verb === 'post' && e.detail.requestConfig.path === '/notes') {
+        const card = e.detail.target.querySelector('.note-card');
+        if (!card) return;
+        document.querySelectorAll(`#notes-container .note-card[data-id="${card.dataset.id}"]`).forEach(other => {
+            if (other !== card) other.remove();
+        });
+    }
+});
@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import APP_DIR
+
+
+@pytest.fixture
+def main(monkeypatch):
+    # Static files and templates are looked up relative to the app
+    monkeypatch.chdir(APP_DIR)
+    import main
+    from autosave import WriteBehindBuffer
+    from note_events import NoteEvents
+    from note_search import NoteIndex
+    from notes_store import MemoryNotesStore
+
+    store = MemoryNotesStore()
+    monkeypatch.setattr(main, "store", store)
+    monkeypatch.setattr(main, "autosave", WriteBehindBuffer(store))
+    monkeypatch.setattr(main, "note_index", NoteIndex())
+    monkeypatch.setattr(main, "note_events", NoteEvents())
+    return main
+
+
+@pytest.fixture
+def client(main):
+    with TestClient(main.app) as client:
+        yield client
+
+
+def create_notes(main, *contents):
+    async def create():
+        return [(await main.store.create_note(content, 'default'))['id'] for content in contents]
+    return asyncio.run(create())
+
+
+def results_by_id(response):
+    assert response.status_code == 200
+    return {result['id']: result for result in response.json()['results']}
+
+
+def test_bulk_share_reports_each_note(main, client):
+    shared, again = create_notes(main, 'one', 'two')
+    client.post('/notes/%s/share' % again)
+    missing = str(uuid.uuid1())
+    results = results_by_id(client.post('/notes/share', json={'ids': [shared, again, missing, 'junk']}))
+
+    assert results[shared] == {'id': shared, 'success': True}
+    assert results[again] == {'id': again, 'success': True}
+    assert results[missing] == {'id': missing, 'success': False, 'error': 'Note not found'}
+    assert results['junk']['success'] is False
+    assert len(main.store.public.records) == 2
+
+
+def test_bulk_delete_reports_missing_notes(main, client):
+    existing = create_notes(main, 'one', 'two')
+    missing = str(uuid.uuid1())
+    published = main.note_events.published
+    results = results_by_id(client.post('/notes/delete', json={'ids': existing + [missing]}))
+
+    assert [results[note_id]['success'] for note_id in existing] == [True, True]
+    assert results[missing] == {'id': missing, 'success': False, 'error': 'Note not found'}
+    assert main.store.notes.records == {}
+    # Only the notes that existed are announced as deleted
+    assert main.note_events.published - published == 2
+
+
+def test_bulk_copy_reports_the_new_notes(main, client):
+    note_id, = create_notes(main, 'shared text')
+    client.post('/notes/%s/share' % note_id)
+    public_id = next(iter(main.store.public.records))
+    missing = str(uuid.uuid1())
+    results = results_by_id(client.post('/notes/copy', json={'ids': [str(public_id), missing]}))
+
+    copy = results[str(public_id)]
+    assert copy['success'] and copy['note_id'] != note_id
+    assert main.store.notes.records[uuid.UUID(copy['note_id'])]['content'] == 'shared text'
+    assert results[missing] == {'id': missing, 'success': False, 'error': 'Public note not found'}
+
+
+@pytest.mark.parametrize('body', [[1], {'ids': [1]}, {'ids': 'abc'}, {'ids': ['a'] * 501}])
+def test_bulk_requests_need_a_list_of_ids(client, body):
+    assert client.post('/notes/delete', json=body).status_code == 400
+
+
+def test_event_stats_count_published_deltas(main, client):
+    before = client.get('/notes/events/stats').json()
+    assert before == {'subscribers': 0, 'published': 0}
+    client.post('/notes')
+    assert client.get('/notes/events/stats').json()['published'] == 1
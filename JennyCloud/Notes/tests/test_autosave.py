@@ -0,0 +1,37 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from autosave import WriteBehindBuffer
+from notes_store import MemoryNotesStore, new_note_id
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class FailingStore(MemoryNotesStore):
+    async def apply_edits(self, edits):
+        raise RuntimeError("store down")
+
+
+def test_edits_are_stamped_in_utc():
+    async def scenario():
+        buffer = WriteBehindBuffer(MemoryNotesStore())
+        note_id = new_note_id()
+        buffer.stage(note_id, content='hi')
+        return buffer.pending[note_id].updated_at
+
+    assert abs(run(scenario()) - datetime.utcnow()) < timedelta(seconds=5)
+
+
+def test_failed_early_flush_is_reported_and_kept(capsys):
+    async def scenario():
+        buffer = WriteBehindBuffer(FailingStore(), max_pending=2)
+        for i in range(2):
+            buffer.stage(new_note_id(), content='note %d' % i)
+        await asyncio.wait([buffer._early])
+        return buffer
+
+    buffer = run(scenario())
+    assert "Notes autosave flush failed, retrying: store down" in capsys.readouterr().out
+    assert len(buffer.pending) == 2
@@ -0,0 +1,39 @@
+import asyncio
+
+from feed_cache import FIRST_PAGE, FeedCache, MemoryFeedBackend, render_page
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_a_page_rendered_before_a_share_is_not_stored():
+    async def scenario():
+        cache = FeedCache(MemoryFeedBackend())
+        version = await cache.version()
+        stale = render_page('<p>before</p>', None)
+        await cache.shared()
+        await cache.put(FIRST_PAGE, version, stale)
+        refused = await cache.get(FIRST_PAGE)
+
+        fresh = render_page('<p>after</p>', None)
+        await cache.put(FIRST_PAGE, await cache.version(), fresh)
+        return refused, await cache.get(FIRST_PAGE), fresh
+
+    refused, stored, fresh = run(scenario())
+    assert refused is None
+    assert stored == fresh
+
+
+def test_sharing_drops_only_the_first_page():
+    async def scenario():
+        cache = FeedCache(MemoryFeedBackend())
+        version = await cache.version()
+        await cache.put(FIRST_PAGE, version, render_page('<p>top</p>', None))
+        await cache.put('older', version, render_page('<p>older</p>', None))
+        await cache.shared()
+        return await cache.get(FIRST_PAGE), await cache.get('older'), await cache.stats()
+
+    first, older, stats = run(scenario())
+    assert first is None and older is not None
+    assert stats['version'] == 1
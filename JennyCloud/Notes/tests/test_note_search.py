@@ -0,0 +1,28 @@
+import note_search
+from note_search import NoteIndex
+from notes_store import new_note_id
+
+
+def test_ranking_finds_every_word_by_prefix():
+    index = NoteIndex()
+    apples, pears = new_note_id(), new_note_id()
+    index.put(apples, 'green apples and red apples')
+    index.put(pears, 'pears and apricots')
+    hits, truncated = index.search('ap')
+    assert [note_id for _, note_id in hits] == [apples, pears]
+    assert not truncated
+    assert index.search('pe ap')[0][0][1] == pears
+
+
+def test_searches_past_the_scoring_budget_say_so(monkeypatch):
+    monkeypatch.setattr(note_search, 'MAX_SCORED', 3)
+    index = NoteIndex()
+    notes = [new_note_id() for _ in range(5)]
+    for note_id in notes:
+        index.put(note_id, 'common word')
+    hits, truncated = index.search('common', limit=10)
+    assert truncated
+    # Only the latest indexed notes are ranked
+    assert {note_id for _, note_id in hits} == set(notes[-3:])
+    assert index.search('common word', limit=10)[1]
+    assert not index.search('missing')[1]
@@ -0,0 +1,116 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from notes_store import MemoryNotesStore, NoteEdit, note_id_at
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_sharing_twice_publishes_once():
+    async def scenario():
+        store = MemoryNotesStore()
+        note = await store.create_note('hello', 'yellow')
+        note_id = uuid.UUID(note['id'])
+        assert await store.share_note(note_id)
+        assert await store.share_note(note_id)
+        assert (await store.get_note(note_id))['is_public']
+        public, _ = await store.list_public_notes(None, 10)
+        return note, public
+
+    note, public = run(scenario())
+    assert [(entry['note_id'], entry['content']) for entry in public] == [(note['id'], 'hello')]
+
+
+def test_bulk_share_skips_notes_already_public():
+    async def scenario():
+        store = MemoryNotesStore()
+        notes = [uuid.UUID((await store.create_note('note %d' % i, 'blue'))['id']) for i in range(3)]
+        await store.share_note(notes[0])
+        missing = uuid.uuid1()
+        shared = await store.share_notes(notes + [missing])
+        public, _ = await store.list_public_notes(None, 10)
+        return notes, missing, shared, public
+
+    notes, missing, shared, public = run(scenario())
+    assert shared == {notes[0]: True, notes[1]: True, notes[2]: True, missing: False}
+    assert sorted(note['note_id'] for note in public) == sorted(str(note_id) for note_id in notes)
+
+
+def test_listing_pages_newest_first_and_resumes_past_deleted_notes():
+    async def scenario():
+        store = MemoryNotesStore()
+        # Spread over two months, so pages cross a bucket
+        created = [note_id_at(datetime(2024, 1, 28) + timedelta(days=i)) for i in range(5)]
+        for note_id in created:
+            await store.put_note({'id': str(note_id), 'content': '', 'color': 'red', 'is_public': False,
+                                  'updated_at': None})
+        first, position = await store.list_notes(None, 2)
+        # The note a cursor points at may be gone by the time the next page is asked for
+        await store.delete_note(uuid.UUID(first[-1]['id']))
+        second, position = await store.list_notes(position, 2)
+        third, end = await store.list_notes(position, 2)
+        return created, [first, second, third], end
+
+    created, pages, end = run(scenario())
+    newest_first = [str(note_id) for note_id in reversed(created)]
+    assert [[note['id'] for note in page] for page in pages] == [newest_first[:2], newest_first[2:4], newest_first[4:]]
+    assert end is None
+
+
+def test_put_note_keeps_the_id_and_its_time():
+    async def scenario():
+        store = MemoryNotesStore()
+        note_id = note_id_at(datetime(2020, 2, 29, 12, 30))
+        await store.put_note({'id': str(note_id), 'content': 'leap', 'color': 'green', 'is_public': False,
+                              'created_at': None, 'updated_at': datetime(2021, 1, 1)})
+        return await store.get_note(note_id)
+
+    note = run(scenario())
+    assert note['created_at'] == datetime(2020, 2, 29, 12, 30)
+    assert (note['content'], note['updated_at']) == ('leap', datetime(2021, 1, 1))
+
+
+def test_edits_change_only_the_given_fields():
+    async def scenario():
+        store = MemoryNotesStore()
+        note_id = uuid.UUID((await store.create_note('draft', 'red'))['id'])
+        moment = datetime(2030, 1, 1)
+        await store.apply_edits({note_id: NoteEdit(moment, color='blue'), uuid.uuid1(): NoteEdit(moment, 'lost')})
+        return await store.get_note(note_id), len(store.notes.records)
+
+    note, count = run(scenario())
+    assert (note['content'], note['color'], note['updated_at']) == ('draft', 'blue', datetime(2030, 1, 1))
+    assert count == 1
+
+
+def test_copying_a_public_note_makes_a_private_one():
+    async def scenario():
+        store = MemoryNotesStore()
+        note_id = uuid.UUID((await store.create_note('idea', 'pink'))['id'])
+        await store.share_note(note_id)
+        public_id = next(iter(store.public.records))
+        missing = uuid.uuid1()
+        return note_id, await store.copy_public_notes([public_id, missing]), public_id, missing
+
+    note_id, copies, public_id, missing = run(scenario())
+    copy = copies[public_id]
+    assert copies[missing] is None
+    assert copy['id'] != str(note_id)
+    assert (copy['content'], copy['color'], copy['is_public']) == ('idea', 'pink', False)
+
+
+def test_an_edit_arriving_after_a_delete_does_not_bring_the_note_back():
+    async def scenario():
+        store = MemoryNotesStore()
+        note_id = uuid.UUID((await store.create_note('doomed', 'red'))['id'])
+        await store.delete_note(note_id)
+        await store.apply_edits({note_id: NoteEdit(datetime.utcnow(), 'typed in another tab')})
+        notes, _ = await store.list_notes(None, 10)
+        return await store.get_note(note_id), notes, await store.delete_notes([note_id])
+
+    note, notes, deleted = run(scenario())
+    assert note is None and notes == []
+    assert list(deleted.values()) == [False]